@@ -20,63 +20,118 @@ from urllib.request import urlopen
 from zipfile import ZipFile
 from io import BytesIO
 
-def set_reproducibility(seed):
-  random.seed(seed)
-  np.random.seed(seed)
-  rng = np.random.default_rng(seed)
-  torch.manual_seed(seed)
-  os.environ['TF_DETERMINISTIC_OPS'] = '1'
-
-class EarlyStopping(object):
-    def __init__(self, mode='min', min_delta=0, patience=2, percentage=False):
-        self.mode = mode
-        self.min_delta = min_delta
-        self.patience = patience
-        self.best = None
-        self.num_bad_epochs = 0
-        self.is_better = None
-        self._init_is_better(mode, min_delta, percentage)
-
-        if patience == 0:
-            self.is_better = lambda a, b: True
-            self.step = lambda a: False
-
-    def step(self, metrics):
-        if self.best is None:
-            self.best = metrics
-            return False
-
-        if np.isnan(metrics):
-            return True
-
-        if self.is_better(metrics, self.best):
-            self.num_bad_epochs = 0
-            self.best = metrics
-        else:
-            self.num_bad_epochs += 1
-
-        if self.num_bad_epochs >= self.patience:
-            print('terminating because of early stopping!')
-            return True
-        return False
-
-    def _init_is_better(self, mode, min_delta, percentage):
-        if mode not in {'min', 'max'}:
-            raise ValueError('mode ' + mode + ' is unknown!')
-        if not percentage:
-            if mode == 'min':
-                self.is_better = lambda a, best: a < best - min_delta
-            if mode == 'max':
-                self.is_better = lambda a, best: a > best + min_delta
-        else:
-            if mode == 'min':
-                self.is_better = lambda a, best: a < best - (
-                            best * min_delta / 100)
-            if mode == 'max':
-                self.is_better = lambda a, best: a > best + (
-                            best * min_delta / 100)
+from hate_speech.training import set_reproducibility, EarlyStopping
+
+import io
+import time
+
+def quantize_model(model):
+  # int8 dynamic quantization of every Linear layer (encoder and classification head)
+  model = model.cpu().eval()
+  return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+def load_quantized_model(model, path):
+  # model must be a freshly built fp32 Model with the same architecture used for the saved one
+  quantized_model = quantize_model(model)
+  quantized_model.load_state_dict(torch.load(path, map_location='cpu'))
+  return quantized_model
+
+def model_size_mb(model):
+  buffer = io.BytesIO()
+  torch.save(model.state_dict(), buffer)
+  return buffer.getbuffer().nbytes / 1e6
+
+def measure_latency(model, data_loader, num_batches=20, warmup=2):
+  model.eval()
+  timings, num_examples = [], 0
+
+  with torch.no_grad():
+    for i, batch in enumerate(data_loader):
+      if i >= num_batches + warmup:
+        break
+      ids, mask = batch[0], batch[1]
+
+      start = time.perf_counter()
+      model(ids, mask)
+      elapsed = time.perf_counter() - start
+
+      if i >= warmup:
+        timings.append(elapsed)
+        num_examples += len(ids)
+
+  return {'ms_per_batch': 1000 * np.mean(timings), 'examples_per_sec': num_examples / np.sum(timings)}
+
+def export_model(model, data_loader, path, token_level=False, opset_version=14):
+  # token_level: logits are (batch, seq_len, num_labels) as in Task C, otherwise (batch, 1)
+  model = model.cpu().eval()
+  ids, mask = data_loader.dataset.tensors[0][:2], data_loader.dataset.tensors[1][:2]
 
-!pip install transformers
+  with torch.no_grad():
+    traced = torch.jit.trace(model, (ids, mask))
+  traced.save(path + '.pt')
+
+  output_axes = {0: 'batch', 1: 'sequence'} if token_level else {0: 'batch'}
+  torch.onnx.export(model, (ids, mask), path + '.onnx',
+                    input_names=['input_ids', 'attention_mask'], output_names=['logits'],
+                    dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                  'attention_mask': {0: 'batch', 1: 'sequence'},
+                                  'logits': output_axes},
+                    opset_version=opset_version)
+
+  return path + '.pt', path + '.onnx'
+
+def load_exported_model(path):
+  # returns a callable (input_ids, attention_mask) -> logits for either export format
+  if path.endswith('.onnx'):
+    import onnxruntime
+
+    session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+    def run(input_ids, attention_mask):
+      logits, = session.run(None, {'input_ids': input_ids.numpy(), 'attention_mask': attention_mask.numpy()})
+      return torch.from_numpy(logits)
+    return run
+
+  return torch.jit.load(path, map_location='cpu').eval()
+
+def check_export_parity(model, exported_paths, data_loader, num_batches=5, atol=1e-4):
+  model = model.cpu().eval()
+  runners = {path: load_exported_model(path) for path in exported_paths}
+  max_diff = {path: 0.0 for path in exported_paths}
+
+  with torch.no_grad():
+    for i, batch in enumerate(data_loader):
+      if i >= num_batches:
+        break
+      ids, mask = batch[0], batch[1]
+      expected = model(ids, mask)
+      for path, run in runners.items():
+        max_diff[path] = max(max_diff[path], (run(ids, mask) - expected).abs().max().item())
+
+  for path, diff in max_diff.items():
+    print(f"{path}: max abs diff {diff:.2e} {'OK' if diff <= atol else 'MISMATCH'}")
+  return max_diff
+
+def benchmark_export(model, exported_paths, data_loader, batch_sizes=(1, 8, 64), repeats=10):
+  model = model.cpu().eval()
+  runners = {'eager': model}
+  runners.update({path: load_exported_model(path) for path in exported_paths})
+  input_ids, attention_mask = data_loader.dataset.tensors[0], data_loader.dataset.tensors[1]
+
+  rows = []
+  with torch.no_grad():
+    for batch_size in batch_sizes:
+      ids, mask = input_ids[:batch_size], attention_mask[:batch_size]
+      for name, run in runners.items():
+        run(ids, mask)  # warmup
+        start = time.perf_counter()
+        for _ in range(repeats):
+          run(ids, mask)
+        elapsed = (time.perf_counter() - start) / repeats
+        rows.append({'runtime': name, 'batch_size': len(ids), 'ms_per_batch': 1000 * elapsed, 'examples_per_sec': len(ids) / elapsed})
+
+  return pd.DataFrame(rows)
+
+!pip install -e .
 
 """# Download"""
 
@@ -135,56 +190,14 @@ plt.show()
 ## Preprocessing
 """
 
-from sklearn.model_selection import train_test_split
-from nltk.corpus import stopwords
-from nltk.stem import SnowballStemmer
-import nltk
-nltk.download('stopwords')
-import re
-
-def preprocessing(subset_len=None):
-  if subset_len:
-    subset_len = min(len(dev_df), subset_len)
-    # Randomly subset
-    temp_dev_df = dev_df.sample(n=subset_len)
-  else:
-    temp_dev_df = dev_df
-
-  # Split dev_df into train and val
-  X_train, X_val, y_train, y_val = train_test_split(temp_dev_df['text'], temp_dev_df['hs'], test_size=0.2)
-
-  X_test = test_df['text']
-  y_test = test_df['hs']
-
-  X_test_news = test_df_news['text']
-  y_test_news = test_df_news['hs']
-
-  sw = stopwords.words('italian')
-  stemmer = SnowballStemmer("italian")
+from hate_speech import training
+from hate_speech.inference import get_preprocess_tweet
 
-  def preprocess_tweet(tweet):
-    # convert to lowercase
-    tweet = tweet.lower()
-    # remove URLs
-    tweet = tweet.replace('url', '')
-    # remove mentions
-    tweet = re.sub(r'@\w+', '', tweet)
-    # remove non-alphanumeric characters
-    tweet = re.sub(r'[^\w\s]', ' ', tweet)
-    # remove duplicate whitespace and stopwords
-    tweet = ' '.join([word for word in tweet.split() if not word in sw])
+preprocess_tweet = get_preprocess_tweet('italian')
 
-    return tweet
-
-  X_train = X_train.apply(preprocess_tweet)
-
-  X_val = X_val.apply(preprocess_tweet)
-
-  X_test = X_test.apply(preprocess_tweet)
-
-  X_test_news = X_test_news.apply(preprocess_tweet)
-
-  return X_train, X_val, y_train, y_val, X_test, X_test_news, y_test, y_test_news,
+def preprocessing(subset_len=None, near_duplicates=None):
+  # training.preprocessing on the corpora downloaded above
+  return training.preprocessing(dev_df, test_df, test_df_news, subset_len, near_duplicates, preprocess_tweet)
 
 from sklearn.model_selection import train_test_split
 import pandas as pd
@@ -283,30 +296,8 @@ plt.show()
 
 """## Tokenization"""
 
-import torch
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
 from transformers import BertTokenizer
-
-def tokenization(X, y, batch_size, tokenizer=None):
-  if tokenizer is None:
-      tokenizer = BertTokenizer.from_pretrained("dbmdz/bert-base-italian-uncased")
-
-  max_length = 256
-
-  encoding = tokenizer.batch_encode_plus(list(X), max_length=max_length, padding=True, truncation=True)
-
-  input_ids = torch.tensor(encoding['input_ids'])
-  attention_mask = torch.tensor(encoding['attention_mask'])
-
-  inputs = torch.tensor(input_ids)
-  mask = torch.tensor(attention_mask)
-  labels = torch.tensor(list(y))
-
-  data = TensorDataset(inputs, mask, labels)
-  sampler = RandomSampler(data)
-  dataloader = DataLoader(data, sampler=sampler, batch_size=batch_size)
-
-  return dataloader
+from hate_speech.training import tokenization
 
 """## Model & functions"""
 
@@ -323,85 +314,17 @@ class Model(torch.nn.Module):
     self.linear = torch.nn.Linear(768, 1)
 
   def forward(self, input_ids, attention_mask):
-    outputs = self.bert(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device))
+    outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
     pooled_output = outputs.pooler_output
     pooled_output = self.dropout(pooled_output)
     logits = self.linear(pooled_output)
     return logits
 
 from tqdm import tqdm
-
-def train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs):
-  early_stopping = EarlyStopping(patience=int(num_epochs * 0.1))
-  train_losses = []
-  val_losses = []
-  reports = []
-  for epoch in range(num_epochs):
-    print(f"Epoch {epoch+1}")
-
-    # Train on training set
-    train_loss = train_fn(train_dataloader, model, criterion, optimizer)
-
-    # Evaluate on validation set
-    val_loss, report = val_fn(val_dataloader, model, criterion)
-
-    train_losses.append(train_loss)
-    val_losses.append(val_loss)
-    reports.append(report)
-
-    # Check early stopping
-    if early_stopping.step(val_losses[-1]):
-      break
-
-  return train_losses, val_losses, reports
-
-def train_fn(data_loader, model, criterion, optimizer):
-  # Train on training set
-  model.train()
-  train_loss = 0
-
-  for batch in tqdm(data_loader):
-    ids, mask, labels = batch
-    optimizer.zero_grad()
-
-    # Forward pass
-    outputs = model(ids.to(device), mask.to(device))
-    outputs = outputs.squeeze()
-    loss = criterion(outputs.cpu(), labels.type_as(outputs).cpu())
-    train_loss += loss.item()
-
-    # Backward pass
-    loss.backward()
-    optimizer.step()
-
-  return train_loss / len(data_loader)
-
-from sklearn.metrics import classification_report
-
-def val_fn(data_loader, model, criterion):
-  model.eval()
-  val_loss, predictions, true_labels = 0, [], []
-
-  with torch.no_grad():
-    for batch in tqdm(data_loader):
-      ids, mask, labels = batch
-      labels = labels.unsqueeze(1)
-
-      # Forward pass
-      outputs = model(ids.to(device), mask.to(device))
-      loss = criterion(outputs.cpu(), labels.float().cpu())
-      val_loss += loss.item()
-
-      preds = (torch.sigmoid(outputs) > 0.5).float()
-      predictions.append(preds)
-      true_labels.append(labels)
-
-  predictions = torch.cat(predictions, dim=0)
-  true_labels = torch.cat(true_labels, dim=0)
-  val_loss /= len(data_loader)
-  report = classification_report(true_labels.cpu(), predictions.cpu(), labels=[0, 1], zero_division=0, output_dict=True)
-
-  return val_loss, report
+from hate_speech.metrics import StreamingReport, best_threshold
+from hate_speech.telemetry import summarize
+# the device is the one the model is on
+from hate_speech.training import train_model, train_fn, val_fn
 
 """## GridSearch"""
 
@@ -415,7 +338,8 @@ batch_sizes = [32, 64]
 pos_weight = torch.tensor([1.5])
 dropout_rate = [0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8]
 
-results_df = pd.DataFrame(columns=["learning_rate", "pos_weight", "seed", "batch_size", "dropout_rate", "val_loss", "f1_score"])
+results_df = pd.DataFrame(columns=["learning_rate", "pos_weight", "seed", "batch_size", "dropout_rate", "val_loss", "f1_score",
+                                   "train_seconds", "eval_seconds", "examples_per_sec", "tokens_per_sec", "padding_ratio", "peak_rss_mb", "peak_device_mb"])
 
 # Loop over the hyperparameter grid
 for seed in seeds:
@@ -434,9 +358,9 @@ for seed in seeds:
       criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
       optimizer = torch.optim.Adam(model.parameters(), lr=lr)
 
-      _, losses, reports = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=num_epochs)
+      _, losses, reports, telemetry = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=num_epochs)
 
-      results_df = results_df.append({"learning_rate": lr, "pos_weight": pos_weight, "seed": seed, "batch_size": batch_size,"dropout_rate": dropout, "val_loss": losses[-1], "f1_score": reports[-1]["macro avg"]["f1-score"]}, ignore_index=True)
+      results_df = results_df.append({"learning_rate": lr, "pos_weight": pos_weight, "seed": seed, "batch_size": batch_size,"dropout_rate": dropout, "val_loss": losses[-1], "f1_score": reports[-1]["macro avg"]["f1-score"], **summarize(telemetry)}, ignore_index=True)
 
 # Get row with max f1_score
 max_f1_row = results_df.loc[results_df['f1_score'].idxmax()]
@@ -446,6 +370,12 @@ min_val_loss_row = results_df.loc[results_df['val_loss'].idxmin()]
 
 print(f"Model with the higher f1_score ({max_f1_row['f1_score']:.3f}): seed: {max_f1_row['seed']}, batch_size: {max_f1_row['batch_size']}, dropout rate: {max_f1_row['dropout_rate']:.3f} and loss: {max_f1_row['val_loss']:.3f}\nModel with the lowest loss ({min_val_loss_row['val_loss']:.3f}): seed: {min_val_loss_row['seed']}, batch_size: {min_val_loss_row['batch_size']}, dropout rate: {min_val_loss_row['dropout_rate']:.3f} and f1_score: {min_val_loss_row['f1_score']:.3f}")
 
+# Get the cheapest row to train within 0.01 of the best f1_score
+close_rows = results_df[results_df['f1_score'] >= max_f1_row['f1_score'] - 0.01]
+cheapest_row = close_rows.loc[close_rows['train_seconds'].idxmin()]
+
+print(f"Cheapest model within 0.01 f1_score ({cheapest_row['f1_score']:.3f}): batch_size: {cheapest_row['batch_size']}, dropout rate: {cheapest_row['dropout_rate']:.3f}, {cheapest_row['train_seconds']:.0f}s of training at {cheapest_row['examples_per_sec']:.1f} examples/s")
+
 results_df
 
 """## Train and Test with best hyperparameters"""
@@ -476,7 +406,7 @@ criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
 optimizer = torch.optim.Adam(best_model.parameters(), lr=lr)
 
 # Train the model and validate loss, F1 score, and precision
-train_loss, val_loss, report = train_model(best_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=2)
+train_loss, val_loss, report, telemetry = train_model(best_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=2)
 
 import matplotlib.pyplot as plt
 
@@ -491,12 +421,26 @@ plt.ylabel('Value')
 plt.legend()
 plt.show()
 
+# decision threshold with the best validation macro-F1, pos_weight moves it away from 0.5
+_, report_default, val_logits, val_labels = val_fn(val_dataloader, best_model, criterion, return_logits=True)
+threshold, sweep = best_threshold(val_logits, val_labels)
+
+print(f"Threshold {threshold:.3f}: macro-F1 {sweep['macro_f1'].max():.3f} (0.5: {report_default['macro avg']['f1-score']:.3f})")
+
 # to access drive
 from google.colab import drive
 drive.mount('/content/drive')
 
-# Save the fine-tuned model
+# Save the fine-tuned model and its decision threshold
+from hate_speech.inference import save_threshold
+
 torch.save(best_model.state_dict(), "/content/drive/MyDrive/Colab Notebooks/model_hs")
+save_threshold("/content/drive/MyDrive/Colab Notebooks/model_hs", threshold)
+
+# and as a model store: encoder, head, tokenizer and threshold, loadable offline without the pretrained base
+from hate_speech.model_store import save_store
+
+save_store(best_model, "/content/drive/MyDrive/Colab Notebooks/model_hs_store", BertTokenizer.from_pretrained("dbmdz/bert-base-italian-uncased"), threshold)
 
 """#### Evaluation over tweets and news"""
 
@@ -506,10 +450,11 @@ drive.mount('/content/drive')
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# Load model
-best_model_hs = Model(dropout)
-best_model_hs.load_state_dict(torch.load("/content/drive/MyDrive/Colab Notebooks/model_hs"))
-best_model_hs = best_model_hs.to(device)
+# Load model and decision threshold from the model store, the encoder is read straight from the fine-tuned weights
+from hate_speech.model_store import load_store
+
+best_model_hs, _ = load_store("/content/drive/MyDrive/Colab Notebooks/model_hs_store", device)
+threshold = best_model_hs.threshold
 
 set_reproducibility(seed)
 
@@ -521,12 +466,12 @@ test_news_dataloader = tokenization(X_test_news, y_test_news, batch_size=batch_s
 
 criterion = torch.nn.BCEWithLogitsLoss()
 
-loss_tweets, report_tweets = val_fn(test_dataloader, best_model_hs, criterion)
+loss_tweets, report_tweets = val_fn(test_dataloader, best_model_hs, criterion, threshold)
 
 print(f"\nTWEETS")
 print(f"\nLoss: {loss_tweets}")
 
-loss_news, report_news = val_fn(test_news_dataloader, best_model_hs, criterion)
+loss_news, report_news = val_fn(test_news_dataloader, best_model_hs, criterion, threshold)
 
 print(f"\nNEWS")
 print(f"\nLoss: {loss_news}")
@@ -537,61 +482,328 @@ pd.DataFrame(report_tweets).transpose()
 
 pd.DataFrame(report_news).transpose()
 
-"""# TASK B - Stereotype detection
+"""#### Dynamic int8 quantization"""
 
-## Preprocessing
-"""
+def quantization_report(fp32_model, int8_model, test_dataloaders, criterion):
+  rows = []
+  for name, model in [('fp32', fp32_model), ('int8', int8_model)]:
+    row = {'model': name, 'size_mb': model_size_mb(model)}
+    for split, data_loader in test_dataloaders.items():
+      _, report = val_fn(data_loader, model, criterion)
+      row[f'f1_{split}'] = report["macro avg"]["f1-score"]
+      row[f'ms_per_batch_{split}'] = measure_latency(model, data_loader)['ms_per_batch']
+    rows.append(row)
 
-from sklearn.model_selection import train_test_split
-from nltk.corpus import stopwords
-from nltk.stem import SnowballStemmer
-import nltk
-nltk.download('stopwords')
-import re
+  report_df = pd.DataFrame(rows).set_index('model')
+  report_df.loc['fp32/int8'] = report_df.loc['fp32'] / report_df.loc['int8']
+  return report_df
 
-def preprocessing(subset_len=None):
-  if subset_len:
-    subset_len = min(len(dev_df), subset_len)
-    # Randomly subset
-    temp_dev_df = dev_df.sample(n=subset_len)
-  else:
-    temp_dev_df = dev_df
+# quantized Linear kernels only run on CPU
+cpu = torch.device("cpu")
+best_model_hs = best_model_hs.to(cpu)
 
-  # Split dev_df into train and val
-  X_train, X_val, y_train, y_val = train_test_split(temp_dev_df['text'], temp_dev_df['stereotype'], test_size=0.2)
+best_model_hs_int8 = quantize_model(best_model_hs)
+torch.save(best_model_hs_int8.state_dict(), "/content/drive/MyDrive/Colab Notebooks/model_hs_int8")
 
-  X_test = test_df['text']
-  y_test = test_df['stereotype']
+# Load quantized model
+best_model_hs_int8 = load_quantized_model(Model(dropout), "/content/drive/MyDrive/Colab Notebooks/model_hs_int8")
 
-  X_test_news = test_df_news['text']
-  y_test_news = test_df_news['stereotype']
+quantization_report(best_model_hs, best_model_hs_int8, {'tweets': test_dataloader, 'news': test_news_dataloader}, criterion)
 
-  sw = stopwords.words('italian')
-  stemmer = SnowballStemmer("italian")
+"""#### Export to TorchScript and ONNX"""
 
-  def preprocess_tweet(tweet):
-    # convert to lowercase
-    tweet = tweet.lower()
-    # remove URLs
-    tweet = tweet.replace('url', '')
-    # remove mentions
-    tweet = re.sub(r'@\w+', '', tweet)
-    # remove non-alphanumeric characters
-    tweet = re.sub(r'[^\w\s]', ' ', tweet)
-    # remove duplicate whitespace and stopwords
-    tweet = ' '.join([word for word in tweet.split() if not word in sw])
+exported_paths = export_model(best_model_hs, test_dataloader, "/content/drive/MyDrive/Colab Notebooks/model_hs")
 
-    return tweet
+check_export_parity(best_model_hs, exported_paths, test_dataloader)
 
-  X_train = X_train.apply(preprocess_tweet)
+benchmark_export(best_model_hs, exported_paths, test_dataloader)
 
-  X_val = X_val.apply(preprocess_tweet)
+"""#### Attention-head and layer pruning"""
 
-  X_test = X_test.apply(preprocess_tweet)
+import copy
+from hate_speech.pruning import compute_head_importance, estimate_flops, load_pruned_model, prune_model, save_pruned_model, select_heads_to_prune
+
+def pruning_report(model, criterion, val_dataloader, test_dataloaders, head_fractions, num_layers_to_drop=0, train_dataloader=None, recover_epochs=0, lr=1e-5):
+  head_importance, layer_importance = compute_head_importance(val_dataloader, model, criterion)
+  seq_len = val_dataloader.dataset.tensors[0].shape[1]
+
+  rows, pruned_models = [], {}
+  for head_fraction in head_fractions:
+    heads_to_prune, layers_to_drop = select_heads_to_prune(head_importance, layer_importance, head_fraction, num_layers_to_drop if head_fraction > 0 else 0)
+    pruned_model = prune_model(copy.deepcopy(model), heads_to_prune, layers_to_drop).to(next(model.parameters()).device)
+
+    # optionally recover accuracy with a short fine-tuning
+    if train_dataloader is not None and recover_epochs > 0:
+      optimizer = torch.optim.Adam(pruned_model.parameters(), lr=lr)
+      train_model(pruned_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=recover_epochs)
+
+    row = {'head_fraction': head_fraction,
+           'heads': sum(layer.attention.self.num_attention_heads for layer in pruned_model.bert.encoder.layer),
+           'layers': len(pruned_model.bert.encoder.layer),
+           'gflops_per_example': estimate_flops(pruned_model, seq_len) / 1e9}
+    for split, data_loader in test_dataloaders.items():
+      _, report = val_fn(data_loader, pruned_model, criterion)
+      row[f'f1_{split}'] = report["macro avg"]["f1-score"]
+      row[f'ms_per_batch_{split}'] = measure_latency(pruned_model, data_loader)['ms_per_batch']
+    rows.append(row)
+    pruned_models[head_fraction] = pruned_model
+
+  return pd.DataFrame(rows).set_index('head_fraction'), pruned_models
+
+# pruned and unpruned models are timed on CPU
+cpu = torch.device("cpu")
+best_model_hs = best_model_hs.to(cpu)
+criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
+
+pruning_df, pruned_models = pruning_report(best_model_hs, criterion, val_dataloader, {'tweets': test_dataloader, 'news': test_news_dataloader},
+                                           head_fractions=[0, 0.2, 0.4, 0.6], num_layers_to_drop=2,
+                                           train_dataloader=train_dataloader, recover_epochs=1)
+
+pruning_df
+
+# Save the pruned model with 40% of the heads removed
+save_pruned_model(pruned_models[0.4], "/content/drive/MyDrive/Colab Notebooks/model_hs_pruned")
+
+# Load pruned model
+best_model_hs_pruned = load_pruned_model(Model(dropout), "/content/drive/MyDrive/Colab Notebooks/model_hs_pruned")
+
+"""#### Batch inference"""
+
+from hate_speech.inference import predict, get_preprocess_tweet
+from transformers import AutoTokenizer
+
+tokenizer = AutoTokenizer.from_pretrained("dbmdz/bert-base-italian-uncased")
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+best_model_hs = best_model_hs.to(device)
+
+# val_fn with dummy labels: preprocessing + padded tokenization + loss and report
+start = time.perf_counter()
+X_scoring = test_df['text'].apply(get_preprocess_tweet())
+val_fn(tokenization(X_scoring, [0] * len(X_scoring), batch_size, tokenizer), best_model_hs, criterion)
+val_fn_time = time.perf_counter() - start
+
+start = time.perf_counter()
+hs_prob = predict(test_df['text'], best_model_hs, batch_size=batch_size, tokenizer=tokenizer)
+predict_time = time.perf_counter() - start
+
+print(f"val_fn: {len(test_df) / val_fn_time:.1f} texts/s, predict: {len(test_df) / predict_time:.1f} texts/s")
+
+"""#### Profiling a training epoch"""
+
+from hate_speech.profiling import StageProfiler
+
+# one epoch of a fresh model with per-stage timings; steps 3-7 are traced to traces/epoch_1.json
+set_reproducibility(seed)
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+profiled_model = Model(dropout).to(device)
+criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
+optimizer = torch.optim.Adam(profiled_model.parameters(), lr=lr)
+
+profiler = StageProfiler(device, trace_dir="/content/traces", wait=1, warmup=1, active=5)
+train_model(profiled_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=1, profiler=profiler)
+
+pd.DataFrame(profiler.summaries[0]['stages']).transpose()
+
+"""#### Sliding-window inference on long news"""
+
+from hate_speech.inference import predict_long
+from sklearn.metrics import f1_score
+
+def long_document_report(model, texts, labels, threshold=None, aggregations=('max', 'mean', 'attention')):
+  # truncation at 256 tokens against overlapping 256-token windows, on texts already normalized by preprocessing()
+  # threshold: decision threshold of every mode, the model's own (model.threshold) by default
+  threshold = model.threshold if threshold is None else threshold
+  identity = lambda text: text
+  rows = []
+  for aggregation in ('truncation',) + tuple(aggregations):
+    start = time.perf_counter()
+    if aggregation == 'truncation':
+      probs = predict(texts, model, batch_size=batch_size, tokenizer=tokenizer, preprocess=identity)
+    else:
+      probs = predict_long(texts, model, batch_size=batch_size, tokenizer=tokenizer, preprocess=identity, aggregation=aggregation)
+    elapsed = time.perf_counter() - start
+    rows.append({'mode': aggregation, 'macro_f1': f1_score(labels, probs > threshold, average='macro'), 'texts_per_sec': len(texts) / elapsed})
+
+  return pd.DataFrame(rows).set_index('mode')
+
+num_tokens = np.array([len(ids) for ids in tokenizer(list(X_test_news))['input_ids']])
+print(f"{(num_tokens > 256).mean() * 100:.1f}% of the news articles are longer than 256 tokens")
+
+long_document_report(best_model_hs, list(X_test_news), list(y_test_news))
+
+"""#### Early-exit inference"""
+
+import math
+
+class EarlyExitModel(torch.nn.Module):
+  # a fine-tuned Model with a linear exit classifier on the [CLS] state of intermediate layers
+  def __init__(self, model, exit_layers=None):
+    super(EarlyExitModel, self).__init__()
+    self.model = model
+    num_layers = model.bert.config.num_hidden_layers
+    self.exit_layers = exit_layers or list(range(1, num_layers))
+    self.exits = torch.nn.ModuleList([torch.nn.Linear(model.bert.config.hidden_size, 1) for _ in self.exit_layers])
+
+  def forward(self, input_ids, attention_mask):
+    # training: logits of every exit followed by the final head, (num_exits + 1, batch, 1)
+    outputs = self.model.bert(input_ids=input_ids, attention_mask=attention_mask, output_hidden_states=True)
+    logits = [exit(self.model.dropout(outputs.hidden_states[layer][:, 0])) for layer, exit in zip(self.exit_layers, self.exits)]
+    logits.append(self.model.linear(self.model.dropout(outputs.pooler_output)))
+    return torch.stack(logits)
+
+  def run_layer(self, layer, hidden_states, attention_mask):
+    # additive mask as built inside BertModel: 0 for tokens, large negative for padding
+    extended_mask = (1.0 - attention_mask[:, None, None, :].to(hidden_states.dtype)) * torch.finfo(hidden_states.dtype).min
+    outputs = layer(hidden_states, attention_mask=extended_mask)
+    return outputs[0] if isinstance(outputs, tuple) else outputs
+
+  def predict(self, input_ids, attention_mask, threshold):
+    # runs the encoder layer by layer and drops from the batch every example whose exit
+    # probability is at least `threshold` away from the decision (max(p, 1 - p) >= threshold);
+    # compared as |logit| >= logit(threshold), since a float32 sigmoid rounds to 1.0 once
+    # |logit| > ~17, so threshold >= 1 never exits early
+    margin = math.log(threshold / (1 - threshold)) if threshold < 1 else math.inf
+    bert = self.model.bert
+    logits = torch.empty(len(input_ids), 1, device=input_ids.device)
+    exit_layer = torch.full((len(input_ids),), len(bert.encoder.layer), device=input_ids.device)
+    active = torch.arange(len(input_ids), device=input_ids.device)
+    exits = dict(zip(self.exit_layers, self.exits))
+
+    hidden_states = bert.embeddings(input_ids=input_ids)
+    for i, layer in enumerate(bert.encoder.layer):
+      hidden_states = self.run_layer(layer, hidden_states, attention_mask)
+
+      if i + 1 in exits:
+        exit_logits = exits[i + 1](hidden_states[:, 0])
+        done = exit_logits.squeeze(-1).abs() >= margin
+        logits[active[done]] = exit_logits[done]
+        exit_layer[active[done]] = i + 1
+        active, hidden_states, attention_mask = active[~done], hidden_states[~done], attention_mask[~done]
+        if len(active) == 0:
+          return logits, exit_layer
+
+    logits[active] = self.model.linear(bert.pooler(hidden_states))
+    return logits, exit_layer
+
+def train_exits(data_loader, model, criterion, optimizer, num_epochs, freeze_backbone=True):
+  # freeze_backbone: train only the exit classifiers on top of the fine-tuned model,
+  # otherwise fine-tune everything jointly on the sum of the losses of all exits
+  device = next(model.parameters()).device
+  for param in model.model.parameters():
+    param.requires_grad = not freeze_backbone
+
+  train_losses = []
+  for epoch in range(num_epochs):
+    print(f"Epoch {epoch+1}")
+    model.train()
+    train_loss = 0
+
+    for batch in tqdm(data_loader):
+      ids, mask, labels = batch
+      optimizer.zero_grad()
+
+      # Forward pass
+      outputs = model(ids.to(device), mask.to(device)).squeeze(-1)
+      loss = sum(criterion(exit_outputs.cpu(), labels.type_as(exit_outputs).cpu()) for exit_outputs in outputs)
+      train_loss += loss.item()
+
+      # Backward pass
+      loss.backward()
+      optimizer.step()
+
+    train_losses.append(train_loss / len(data_loader))
+
+  for param in model.model.parameters():
+    param.requires_grad = True
+
+  return train_losses
+
+def early_exit_report(model, test_dataloaders, thresholds):
+  # thresholds are exit confidences; every exit labels at the fine-tuned model's decision threshold
+  device = next(model.parameters()).device
+  decision_threshold = getattr(model.model, 'threshold', 0.5)
+  decision_logit = math.log(decision_threshold / (1 - decision_threshold))
+  model.eval()
+  rows = []
+  for threshold in thresholds:
+    row = {'threshold': threshold}
+    for split, data_loader in test_dataloaders.items():
+      metrics, layers = StreamingReport(labels=[0, 1]), []
+      start = time.perf_counter()
+      with torch.no_grad():
+        for batch in data_loader:
+          ids, mask, labels = batch
+          logits, exit_layer = model.predict(ids.to(device), mask.to(device), threshold)
+          metrics.update(logits > decision_logit, labels)
+          layers.append(exit_layer.cpu())
+      elapsed = time.perf_counter() - start
+
+      report = metrics.report()
+      row[f'f1_{split}'] = report["macro avg"]["f1-score"]
+      row[f'avg_layers_{split}'] = torch.cat(layers).float().mean().item()
+      row[f'examples_per_sec_{split}'] = len(data_loader.dataset) / elapsed
+    rows.append(row)
+
+  return pd.DataFrame(rows).set_index('threshold')
+
+cpu = torch.device("cpu")
+
+early_exit_model = EarlyExitModel(best_model_hs).to(cpu)
+criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
+optimizer = torch.optim.Adam(early_exit_model.exits.parameters(), lr=1e-3)
+
+train_exits(train_dataloader, early_exit_model, criterion, optimizer, num_epochs=2)
+
+torch.save(early_exit_model.state_dict(), "/content/drive/MyDrive/Colab Notebooks/model_hs_early_exit")
+
+# threshold 1.0 never exits early (an infinite logit margin) and matches the full model
+early_exit_report(early_exit_model, {'tweets': test_dataloader, 'news': test_news_dataloader}, thresholds=[1.0, 0.99, 0.95, 0.9, 0.8])
+
+"""#### Cascade with a sparse linear pre-filter"""
+
+from hate_speech.cascade import Cascade, choose_band, train_prefilter
+from sklearn.metrics import f1_score
+
+# pre-filter trained on the same preprocess_tweet output as the model
+prefilter = train_prefilter(X_train, y_train)
+
+# band chosen on the validation split against the predictions of the fine-tuned model
+# labels at the model's stored decision threshold, not 0.5
+bert_val_preds = predict(X_val, best_model_hs, batch_size=batch_size, tokenizer=tokenizer, preprocess=lambda text: text) > best_model_hs.threshold
+low, high = choose_band(prefilter.predict_proba(list(X_val))[:, 1], y_val, target_recall=0.8, bert_preds=bert_val_preds)
+print(f"Uncertainty band: [{low:.3f}, {high:.3f})")
+
+cascade = Cascade(prefilter, best_model_hs, low, high, tokenizer=tokenizer, batch_size=batch_size)
+
+rows = []
+for split, X, y in [('tweets', X_test, y_test), ('news', X_test_news, y_test_news)]:
+  start = time.perf_counter()
+  bert_probs = predict(X, best_model_hs, batch_size=batch_size, tokenizer=tokenizer, preprocess=lambda text: text)
+  bert_time = time.perf_counter() - start
+
+  start = time.perf_counter()
+  cascade_probs, sent_to_bert = cascade.predict(X)
+  cascade_time = time.perf_counter() - start
+
+  rows.append({'split': split, 'sent_to_bert': sent_to_bert.mean(),
+               'f1_bert': f1_score(y, bert_probs > best_model_hs.threshold, average='macro'), 'f1_cascade': f1_score(y, cascade_probs > cascade.threshold, average='macro'),
+               'posts_per_sec_bert': len(X) / bert_time, 'posts_per_sec_cascade': len(X) / cascade_time})
+
+pd.DataFrame(rows).set_index('split')
+
+"""# TASK B - Stereotype detection
+
+## Preprocessing
+"""
 
-  X_test_news = X_test_news.apply(preprocess_tweet)
+from hate_speech import training
+from hate_speech.inference import get_preprocess_tweet
 
-  return X_train, X_val, y_train, y_val, X_test, X_test_news, y_test, y_test_news,
+preprocess_tweet = get_preprocess_tweet('italian')
+
+def preprocessing(subset_len=None, near_duplicates=None):
+  # training.preprocessing on the corpora downloaded above
+  return training.preprocessing(dev_df, test_df, test_df_news, subset_len, near_duplicates, preprocess_tweet, label='stereotype')
 
 from sklearn.model_selection import train_test_split
 import pandas as pd
@@ -690,30 +902,7 @@ plt.show()
 
 """## Tokenization"""
 
-import torch
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
-from transformers import BertTokenizer
-
-def tokenization(X, y, batch_size, tokenizer=None):
-  if tokenizer is None:
-      tokenizer = BertTokenizer.from_pretrained("dbmdz/bert-base-italian-uncased")
-
-  max_length = 256
-
-  encoding = tokenizer.batch_encode_plus(list(X), max_length=max_length, padding=True, truncation=True)
-
-  input_ids = torch.tensor(encoding['input_ids'])
-  attention_mask = torch.tensor(encoding['attention_mask'])
-
-  inputs = torch.tensor(input_ids)
-  mask = torch.tensor(attention_mask)
-  labels = torch.tensor(list(y))
-
-  data = TensorDataset(inputs, mask, labels)
-  sampler = RandomSampler(data)
-  dataloader = DataLoader(data, sampler=sampler, batch_size=batch_size)
-
-  return dataloader
+from hate_speech.training import tokenization
 
 """## Model & functions"""
 
@@ -730,80 +919,13 @@ class Model(torch.nn.Module):
     self.linear = torch.nn.Linear(768, 1)
 
   def forward(self, input_ids, attention_mask):
-    outputs = self.bert(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device))
+    outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
     pooled_output = outputs.pooler_output
     pooled_output = self.dropout(pooled_output)
     logits = self.linear(pooled_output)
     return logits
 
-def train_fn(data_loader, model, criterion, optimizer):
-  # Train on training set
-  model.train()
-  train_loss = 0
-
-  for batch in tqdm(data_loader):
-    ids, mask, labels = batch
-    optimizer.zero_grad()
-
-    # Forward pass
-    outputs = model(ids.to(device), mask.to(device))
-    outputs = outputs.squeeze()
-    loss = criterion(outputs.cpu(), labels.type_as(outputs).cpu())
-    train_loss += loss.item()
-
-    # Backward pass
-    loss.backward()
-    optimizer.step()
-
-  return train_loss / len(data_loader)
-
-def train_fn(data_loader, model, criterion, optimizer):
-  # Train on training set
-  model.train()
-  train_loss = 0
-
-  for batch in tqdm(data_loader):
-    ids, mask, labels = batch
-    optimizer.zero_grad()
-
-    # Forward pass
-    outputs = model(ids.to(device), mask.to(device))
-    outputs = outputs.squeeze()
-    loss = criterion(outputs.cpu(), labels.type_as(outputs).cpu())
-    train_loss = loss.item()
-
-    # Backward pass
-    loss.backward()
-    optimizer.step()
-
-  return train_loss
-
-from sklearn.metrics import classification_report
-
-def val_fn(data_loader, model, criterion):
-  model.eval()
-  val_loss, predictions, true_labels = 0, [], []
-
-  with torch.no_grad():
-    for batch in tqdm(data_loader):
-      ids, mask, labels = batch
-      labels = labels.unsqueeze(1)
-
-      # Forward pass
-      outputs = model(ids.to(device), mask.to(device))
-      loss = criterion(outputs.cpu(), labels.float().cpu())
-      val_loss += loss.item()
-
-      preds = (torch.sigmoid(outputs) > 0.5).float()
-      predictions.append(preds)
-      true_labels.append(labels)
-
-  predictions = torch.cat(predictions, dim=0)
-  true_labels = torch.cat(true_labels, dim=0)
-  val_loss /= len(data_loader)
-  report = classification_report(true_labels.cpu(), predictions.cpu(), labels=[0, 1], zero_division=0, output_dict=True)
-
-  return val_loss, report
+from hate_speech.training import train_model, train_fn, val_fn
 
 """## GridSearch"""
 
@@ -817,7 +939,8 @@ batch_sizes = [32, 64]
 pos_weight = torch.tensor([1.25])
 dropout_rate = [0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8]
 
-results_df = pd.DataFrame(columns=["learning_rate", "pos_weight", "seed", "batch_size", "dropout_rate", "val_loss", "f1_score"])
+results_df = pd.DataFrame(columns=["learning_rate", "pos_weight", "seed", "batch_size", "dropout_rate", "val_loss", "f1_score",
+                                   "train_seconds", "eval_seconds", "examples_per_sec", "tokens_per_sec", "padding_ratio", "peak_rss_mb", "peak_device_mb"])
 
 # Loop over the hyperparameter grid
 for seed in seeds:
@@ -836,9 +959,9 @@ for seed in seeds:
       criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
       optimizer = torch.optim.Adam(model.parameters(), lr=lr)
 
-      _, losses, reports = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=num_epochs)
+      _, losses, reports, telemetry = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=num_epochs)
 
-      results_df = results_df.append({"learning_rate": lr, "pos_weight": pos_weight, "seed": seed, "batch_size": batch_size,"dropout_rate": dropout, "val_loss": losses[-1], "f1_score": reports[-1]["macro avg"]["f1-score"]}, ignore_index=True)
+      results_df = results_df.append({"learning_rate": lr, "pos_weight": pos_weight, "seed": seed, "batch_size": batch_size,"dropout_rate": dropout, "val_loss": losses[-1], "f1_score": reports[-1]["macro avg"]["f1-score"], **summarize(telemetry)}, ignore_index=True)
 
 # Get row with max f1_score
 max_f1_row = results_df.loc[results_df['f1_score'].idxmax()]
@@ -878,7 +1001,7 @@ criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
 optimizer = torch.optim.Adam(best_model.parameters(), lr=lr)
 
 # Train the model and validate loss, F1 score, and precision
-train_loss, val_loss, report = train_model(best_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=2)
+train_loss, val_loss, report, telemetry = train_model(best_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=2)
 
 import matplotlib.pyplot as plt
 
@@ -893,12 +1016,21 @@ plt.ylabel('Value')
 plt.legend()
 plt.show()
 
+# decision threshold with the best validation macro-F1, pos_weight moves it away from 0.5
+_, report_default, val_logits, val_labels = val_fn(val_dataloader, best_model, criterion, return_logits=True)
+threshold, sweep = best_threshold(val_logits, val_labels)
+
+print(f"Threshold {threshold:.3f}: macro-F1 {sweep['macro_f1'].max():.3f} (0.5: {report_default['macro avg']['f1-score']:.3f})")
+
 # to access drive
 from google.colab import drive
 drive.mount('/content/drive')
 
-# Save the fine-tuned model
+# Save the fine-tuned model and its decision threshold
+from hate_speech.inference import save_threshold
+
 torch.save(best_model.state_dict(), "/content/drive/MyDrive/Colab Notebooks/model_stereotype")
+save_threshold("/content/drive/MyDrive/Colab Notebooks/model_stereotype", threshold)
 
 """### Evaluation over tweets and news"""
 
@@ -908,10 +1040,13 @@ drive.mount('/content/drive')
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# Load model
+# Load model and decision threshold
+from hate_speech.inference import load_threshold
+
 best_model_stereotype = Model(dropout)
 best_model_stereotype.load_state_dict(torch.load("/content/drive/MyDrive/Colab Notebooks/model_stereotype"))
 best_model_stereotype = best_model_stereotype.to(device)
+threshold = load_threshold("/content/drive/MyDrive/Colab Notebooks/model_stereotype")
 
 set_reproducibility(seed)
 # preprocessing
@@ -920,12 +1055,12 @@ _, _, _, _, X_test, X_test_news, y_test, y_test_news = preprocessing()
 test_dataloader = tokenization(X_test, y_test, batch_size=batch_size)
 test_news_dataloader = tokenization(X_test_news, y_test_news, batch_size=batch_size)
 
-loss_tweets, report_tweets = val_fn(test_dataloader, best_model_stereotype, criterion)
+loss_tweets, report_tweets = val_fn(test_dataloader, best_model_stereotype, criterion, threshold)
 
 print(f"\nTWEETS")
 print(f"\nLoss: {loss_tweets}")
 
-loss_news, report_news = val_fn(test_news_dataloader, best_model_stereotype, criterion)
+loss_news, report_news = val_fn(test_news_dataloader, best_model_stereotype, criterion, threshold)
 
 print(f"\nNEWS")
 print(f"\nLoss: {loss_news}")
@@ -936,6 +1071,20 @@ pd.DataFrame(report_tweets).transpose()
 
 pd.DataFrame(report_news).transpose()
 
+"""### Dynamic int8 quantization"""
+
+# quantized Linear kernels only run on CPU
+cpu = torch.device("cpu")
+best_model_stereotype = best_model_stereotype.to(cpu)
+
+best_model_stereotype_int8 = quantize_model(best_model_stereotype)
+torch.save(best_model_stereotype_int8.state_dict(), "/content/drive/MyDrive/Colab Notebooks/model_stereotype_int8")
+
+# Load quantized model
+best_model_stereotype_int8 = load_quantized_model(Model(dropout), "/content/drive/MyDrive/Colab Notebooks/model_stereotype_int8")
+
+quantization_report(best_model_stereotype, best_model_stereotype_int8, {'tweets': test_dataloader, 'news': test_news_dataloader}, criterion)
+
 """# TASK C - Identification of Nominal Utterances
 
 ## Download
@@ -1100,38 +1249,71 @@ def tokenization(X, y, max_len, batch_size, tokenizer=None):
 """## Model & functions"""
 
 from transformers import AutoModel
+from hate_speech.crf import CRF, iob_constraints, pad_packed
 
 class Model(torch.nn.Module):
-  def __init__(self, dropout, num_labels):
+  def __init__(self, dropout, num_labels, crf=False):
     super(Model, self).__init__()
     self.bert = AutoModel.from_pretrained("dbmdz/bert-base-italian-uncased")
     for param in self.bert.parameters():
         param.requires_grad = True
     self.dropout = torch.nn.Dropout(dropout)
     self.classifier = torch.nn.Linear(self.bert.config.hidden_size, num_labels)
+    # optional CRF over the classifier logits, constrained to valid IOB sequences
+    self.crf = CRF(num_labels, *iob_constraints(label_map)) if crf else None
 
-  def forward(self, input_ids, attention_mask):
-    outputs = self.bert(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device))
+  def forward(self, input_ids, attention_mask, token_mask=None):
+    outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
     sequence_output = outputs.last_hidden_state
+    # token_mask: only these positions go through the classifier, packed as (num_tokens, num_labels)
+    if token_mask is not None:
+      sequence_output = sequence_output[token_mask]
     sequence_output = self.dropout(sequence_output)
     logits = self.classifier(sequence_output)
     return logits
 
 from tqdm import tqdm
-
-def train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs, num_labels=None):
+from hate_speech.profiling import NULL_PROFILER, format_summary
+from hate_speech.telemetry import Telemetry, format_record, summarize
+
+def trim_batch(ids, mask, labels):
+  # drop the trailing columns that are padding in every sequence of the batch
+  used = (mask.bool() | (labels != label_map['PAD'])).any(dim=0)
+  length = int(used.nonzero().max()) + 1
+  return ids[:, :length], mask[:, :length], labels[:, :length]
+
+def crf_inputs(logits, labels, token_mask):
+  # packed logits and labels of the real tokens -> left-aligned (batch, words, ...) sentences for the CRF
+  lengths = token_mask.sum(dim=1)
+  emissions, sentence_mask = pad_packed(logits, lengths)
+  tags, _ = pad_packed(labels, lengths, label_map['O'])
+  return emissions, tags, sentence_mask
+
+def train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs, num_labels=None, profiler=NULL_PROFILER, telemetry_path=None):
+  # profiler: a profiling.StageProfiler to time every stage of each epoch and trace a window of steps
+  # telemetry_path: JSONL file to append the per-epoch throughput and memory records to
   early_stopping = EarlyStopping(patience=int(num_epochs * 0.1))
+  telemetry = Telemetry(next(model.parameters()).device, telemetry_path)
   train_losses = []
   val_losses = []
   reports = []
   for epoch in range(num_epochs):
     print(f"Epoch {epoch+1}")
+    profiler.start_epoch(epoch + 1)
+    telemetry.start_epoch(epoch + 1)
 
-    # Train on training set
-    train_loss = train_fn(train_dataloader, model, criterion, num_labels, optimizer)
+    # Train on training set, batches are trimmed to their longest sequence (packed)
+    train_loss = train_fn(telemetry.count(train_dataloader, trim=True), model, criterion, num_labels, optimizer, profiler=profiler)
 
     # Evaluate on validation set
-    val_loss, report = val_fn(val_dataloader, model, criterion, num_labels)
+    with telemetry.evaluation():
+      val_loss, report = val_fn(val_dataloader, model, criterion, num_labels, profiler=profiler)
+
+    print(format_record(telemetry.end_epoch()))
+
+    summary = profiler.end_epoch()
+    if summary is not None:
+      print(format_summary(summary))
 
     train_losses.append(train_loss)
     val_losses.append(val_loss)
@@ -1141,52 +1323,92 @@ def train_model(model, criterion, optimizer, train_dataloader, val_dataloader, n
     if early_stopping.step(val_losses[-1]):
       break
 
-  return train_losses, val_losses, reports
+  return train_losses, val_losses, reports, telemetry.records
 
-def train_fn(data_loader, model, criterion, num_labels, optimizer):
+def train_fn(data_loader, model, criterion, num_labels, optimizer, packed=True, profiler=NULL_PROFILER):
+  # packed: the encoder sees the batch trimmed to its longest sequence, and only the real
+  # tokens (not PAD) reach the classifier and the loss; otherwise every position up to max_len
+  # with a CRF head the loss is the CRF negative log-likelihood instead of criterion
+  if model.crf is not None and not packed:
+    raise ValueError('the CRF head needs packed=True')
+  device = next(model.parameters()).device
   model.train()
   train_loss = 0
 
-  for batch in tqdm(data_loader):
+  for batch in profiler.iterate(tqdm(data_loader)):
     ids, mask, labels = batch
-    optimizer.zero_grad()
-
-    logits = model(ids.to(device), mask.to(device))
-
-    loss = criterion(logits.cpu().view(-1, num_labels), labels.cpu().view(-1))
-    loss.backward()
-    optimizer.step()
+    with profiler('zero_grad'):
+      optimizer.zero_grad()
+
+    with profiler('to_device'):
+      token_mask = None
+      if packed:
+        ids, mask, labels = trim_batch(ids, mask, labels)
+        token_mask = (labels != label_map['PAD']).to(device)
+      ids, mask, labels = ids.to(device), mask.to(device), labels.to(device)
+    with profiler('forward'):
+      logits = model(ids, mask, token_mask)
+    with profiler('loss'):
+      if not packed:
+        loss = criterion(logits.cpu().view(-1, num_labels), labels.cpu().view(-1))
+      elif model.crf is not None:
+        loss = model.crf.neg_log_likelihood(*crf_inputs(logits, labels[token_mask], token_mask))
+      else:
+        loss = criterion(logits, labels[token_mask])
+    with profiler('backward'):
+      loss.backward()
+    with profiler('optimizer'):
+      optimizer.step()
+    profiler.step()
 
     train_loss += loss.item()
 
   return train_loss/len(data_loader)
 
-from sklearn.metrics import classification_report
+from hate_speech.metrics import StreamingReport
 
-def val_fn(data_loader, model, criterion, num_labels):
+def val_fn(data_loader, model, criterion, num_labels, packed=True, profiler=NULL_PROFILER):
+  if model.crf is not None and not packed:
+    raise ValueError('the CRF head needs packed=True')
+  device = next(model.parameters()).device
   model.eval()
 
-  val_loss, predictions, true_labels = 0, [], []
+  # per-token counts of the B and I tags, PAD positions are not scored
+  val_loss, metrics = 0, StreamingReport(labels=[1, 2], num_classes=num_labels, ignore_index=label_map['PAD'])
 
   with torch.no_grad():
-    for batch in tqdm(data_loader):
+    for batch in profiler.iterate(tqdm(data_loader), 'val_data'):
       ids, mask, labels = batch
 
       # Forward pass
-      logits = model(ids.to(device), mask.to(device))
-
-      loss = criterion(logits.cpu().view(-1, num_labels), labels.cpu().view(-1))
-      val_loss += loss.item()
-      val_prediction = torch.argmax(logits.cpu(), axis=2).cpu().numpy()
-      actual = labels.cpu().numpy()
-
-      predictions.append(val_prediction)
-      true_labels.append(actual)
+      with profiler('val_to_device'):
+        token_mask = None
+        if packed:
+          ids, mask, labels = trim_batch(ids, mask, labels)
+          token_mask = (labels != label_map['PAD']).to(device)
+        ids, mask, labels = ids.to(device), mask.to(device), labels.to(device)
+      with profiler('val_forward'):
+        logits = model(ids, mask, token_mask)
+      with profiler('val_loss'):
+        if not packed:
+          loss = criterion(logits.cpu().view(-1, num_labels), labels.cpu().view(-1))
+          predictions = torch.argmax(logits, axis=-1)
+        elif model.crf is not None:
+          # Viterbi paths, packed back in the order of labels
+          labels = labels[token_mask]
+          emissions, tags, sentence_mask = crf_inputs(logits, labels, token_mask)
+          loss = model.crf.neg_log_likelihood(emissions, tags, sentence_mask)
+          predictions = model.crf.decode(emissions, sentence_mask)[sentence_mask]
+        else:
+          labels = labels[token_mask]
+          loss = criterion(logits, labels)
+          predictions = torch.argmax(logits, axis=-1)
+        val_loss += loss.item()
+      with profiler('val_metrics'):
+        metrics.update(predictions, labels)
 
-  predictions = np.concatenate(predictions, axis=0)
-  true_labels = np.concatenate(true_labels, axis=0)
   val_loss /= len(data_loader)
-  report = classification_report(true_labels.flatten(), predictions.flatten(), labels=[1, 2], zero_division=0, output_dict=True)
+  report = metrics.report()
 
   return val_loss, report
 
@@ -1203,7 +1425,8 @@ seeds = [42, 12321]
 batch_sizes = [32, 64]
 dropout_rate = [0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8]
 
-results_df = pd.DataFrame(columns=["learning_rate", "seed", "batch_size", "dropout_rate", "val_loss", "precision", "recall", "f1_score"])
+results_df = pd.DataFrame(columns=["learning_rate", "seed", "batch_size", "dropout_rate", "val_loss", "precision", "recall", "f1_score",
+                                   "train_seconds", "eval_seconds", "examples_per_sec", "tokens_per_sec", "padding_ratio", "peak_rss_mb", "peak_device_mb"])
 
 for seed in seeds:
   set_reproducibility(seed)
@@ -1222,9 +1445,9 @@ for seed in seeds:
       optimizer = torch.optim.Adam(model.parameters(), lr=lr)
 
       print(f"Running: seed: {seed}, batch_size: {batch_size}, dropout: {dropout}")
-      _, losses, reports = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs, num_labels)
+      _, losses, reports, telemetry = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs, num_labels)
 
-      results_df = results_df.append({"learning_rate": lr, "seed": seed, "batch_size": batch_size,"dropout_rate": dropout, "val_loss": losses[-1], "precision": reports[-1]["macro avg"]["precision"], "recall": reports[-1]["macro avg"]["recall"], "f1_score": reports[-1]["macro avg"]["f1-score"]}, ignore_index=True)
+      results_df = results_df.append({"learning_rate": lr, "seed": seed, "batch_size": batch_size,"dropout_rate": dropout, "val_loss": losses[-1], "precision": reports[-1]["macro avg"]["precision"], "recall": reports[-1]["macro avg"]["recall"], "f1_score": reports[-1]["macro avg"]["f1-score"], **summarize(telemetry)}, ignore_index=True)
 
 # Get row with max f1_score
 max_f1_row = results_df.loc[results_df['f1_score'].idxmax()]
@@ -1262,7 +1485,7 @@ best_model = Model(dropout, num_labels).to(device)
 criterion = torch.nn.CrossEntropyLoss()
 optimizer = torch.optim.Adam(best_model.parameters(), lr=lr)
 
-train_loss, val_loss, reports = train_model(best_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=40, num_labels=num_labels)
+train_loss, val_loss, reports, telemetry = train_model(best_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=40, num_labels=num_labels)
 
 import matplotlib.pyplot as plt
 
@@ -1311,6 +1534,131 @@ print(f"\nLoss: {loss}")
 
 pd.DataFrame(report).transpose()
 
+"""### Span-level evaluation"""
+
+from hate_speech.metrics import span_report
+
+def predict_tags(model, data_loader):
+  # gold and predicted tags of the real tokens of every sentence, back to back, and the number of tokens of each sentence
+  device = next(model.parameters()).device
+  model.eval()
+  true_tags, pred_tags, lengths = [], [], []
+  with torch.no_grad():
+    for batch in data_loader:
+      ids, mask, labels = trim_batch(*batch)
+      token_mask = (labels != label_map['PAD']).to(device)
+      logits = model(ids.to(device), mask.to(device), token_mask)
+      labels = labels.to(device)[token_mask]
+      if model.crf is not None:
+        emissions, _, sentence_mask = crf_inputs(logits, labels, token_mask)
+        predictions = model.crf.decode(emissions, sentence_mask)[sentence_mask]
+      else:
+        predictions = torch.argmax(logits, axis=-1)
+      true_tags.append(labels.cpu())
+      pred_tags.append(predictions.cpu())
+      lengths.append(token_mask.sum(dim=1).cpu())
+
+  return torch.cat(true_tags).numpy(), torch.cat(pred_tags).numpy(), torch.cat(lengths).numpy()
+
+true_tags, pred_tags, lengths = predict_tags(best_model_NU, test_dataloader)
+span_results, span_per_tweet = span_report(true_tags, pred_tags, lengths, label_map['B'], label_map['I'])
+
+pd.DataFrame(span_results).transpose()
+
+# tweets with the lowest exact-match F1
+span_per_tweet = pd.DataFrame(span_per_tweet)
+span_per_tweet.sort_values('exact_f1').head(20)
+
+"""### Padded vs packed token loss"""
+
+def token_loss_report(num_epochs=2):
+  # same seed, data and hyperparameters; padded: loss over all max_len positions, as before
+  rows = []
+  for packed in [False, True]:
+    set_reproducibility(seed)
+    model = Model(dropout, num_labels).to(device)
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+
+    start = time.perf_counter()
+    for epoch in range(num_epochs):
+      train_fn(train_dataloader, model, criterion, num_labels, optimizer, packed)
+    train_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, report = val_fn(val_dataloader, model, criterion, num_labels, packed)
+    val_time = time.perf_counter() - start
+
+    rows.append({'loss': 'packed' if packed else 'padded', 'train_sec_per_epoch': train_time / num_epochs,
+                 'val_sec': val_time, 'f1_B': report['1']['f1-score'], 'f1_I': report['2']['f1-score'],
+                 'macro_f1': report['macro avg']['f1-score']})
+
+  return pd.DataFrame(rows).set_index('loss')
+
+set_reproducibility(seed)
+X_train, y_train, X_val, y_val, _, _ = preprocessing(max_len)
+train_dataloader = tokenization(X_train, y_train, max_len, batch_size)
+val_dataloader = tokenization(X_val, y_val, max_len, batch_size)
+
+token_loss_report()
+
+"""### CRF head"""
+
+set_reproducibility(seed)
+
+# same data and hyperparameters as the model above, with a CRF over the classifier
+crf_model = Model(dropout, num_labels, crf=True).to(device)
+optimizer = torch.optim.Adam(crf_model.parameters(), lr=lr)
+
+train_loss, val_loss, reports, telemetry = train_model(crf_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=40, num_labels=num_labels)
+
+torch.save(crf_model.state_dict(), "/content/drive/MyDrive/Colab Notebooks/model_NU_crf")
+
+loss_crf, report_crf = val_fn(test_dataloader, crf_model, criterion, num_labels)
+
+print(f"\nLoss: {loss_crf}")
+pd.DataFrame(report_crf).transpose()
+
+def invalid_iob(tags, mask):
+  # sentences with an I that follows neither a B nor an I
+  previous = torch.cat([torch.full_like(tags[:, :1], label_map['O']), tags[:, :-1]], dim=1)
+  invalid = (tags == label_map['I']) & (previous != label_map['B']) & (previous != label_map['I']) & mask
+  return invalid.any(dim=1)
+
+def decode_report(model, data_loader, repeats=5):
+  # decoding only: the encoder runs once and its emissions are reused by both decoders
+  device = next(model.parameters()).device
+  model.eval()
+  batches = []
+  with torch.no_grad():
+    for batch in data_loader:
+      ids, mask, labels = trim_batch(*batch)
+      token_mask = (labels != label_map['PAD']).to(device)
+      logits = model(ids.to(device), mask.to(device), token_mask)
+      emissions, _, sentence_mask = crf_inputs(logits, labels.to(device)[token_mask], token_mask)
+      batches.append((emissions, sentence_mask))
+  num_sentences = sum(len(emissions) for emissions, _ in batches)
+
+  rows = []
+  for name, decode in [('argmax', lambda emissions, mask: emissions.argmax(dim=-1)), ('viterbi', model.crf.decode)]:
+    start = time.perf_counter()
+    for _ in range(repeats):
+      tags = [decode(emissions, mask) for emissions, mask in batches]
+    invalid = sum(int(invalid_iob(t, mask).sum()) for t, (_, mask) in zip(tags, batches))
+    elapsed = time.perf_counter() - start
+    rows.append({'decoder': name, 'sentences_per_sec': repeats * num_sentences / elapsed, 'invalid_iob_sentences': invalid / num_sentences})
+
+  return pd.DataFrame(rows).set_index('decoder')
+
+decode_report(crf_model, test_dataloader)
+
+"""### Export to TorchScript and ONNX"""
+
+exported_paths = export_model(best_model_NU, test_dataloader, "/content/drive/MyDrive/Colab Notebooks/model_NU", token_level=True)
+
+check_export_parity(best_model_NU, exported_paths, test_dataloader)
+
+benchmark_export(best_model_NU, exported_paths, test_dataloader)
+
 """# Project work
 
 ## Spanish
@@ -1497,6 +1845,7 @@ def tokenization(X, y, batch_size, tokenizer=None):
 
 from transformers import AutoModel
 import torch
+from hate_speech.inference import masked_mean
 
 class Model(torch.nn.Module):
     def __init__(self, dropout):
@@ -1508,86 +1857,17 @@ class Model(torch.nn.Module):
         self.linear = torch.nn.Linear(768, 1)
 
     def forward(self, input_ids, attention_mask):
-        outputs = self.bert(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device))
+        outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
         last_hidden_state = outputs.last_hidden_state
-        pooled_output = torch.mean(last_hidden_state, dim=1)
+        # padding positions are left out, as in inference.Model, so training and batched prediction agree
+        pooled_output = masked_mean(last_hidden_state, attention_mask)
         pooled_output = self.dropout(pooled_output)
         logits = self.linear(pooled_output)
         return logits
 
-from tqdm import tqdm
-
-def train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs):
-  early_stopping = EarlyStopping(patience=int(num_epochs * 0.1))
-  train_losses = []
-  val_losses = []
-  reports = []
-  for epoch in range(num_epochs):
-    print(f"Epoch {epoch+1}")
-
-    # Train on training set
-    train_loss = train_fn(train_dataloader, model, criterion, optimizer)
-
-    # Evaluate on validation set
-    val_loss, report = val_fn(val_dataloader, model, criterion)
-
-    train_losses.append(train_loss)
-    val_losses.append(val_loss)
-    reports.append(report)
-
-    # Check early stopping
-    if early_stopping.step(val_losses[-1]):
-      break
-
-  return train_losses, val_losses, reports
-
-def train_fn(data_loader, model, criterion, optimizer):
-  # Train on training set
-  model.train()
-  train_loss = 0
-
-  for batch in tqdm(data_loader):
-    ids, mask, labels = batch
-    optimizer.zero_grad()
-
-    # Forward pass
-    outputs = model(ids.to(device), mask.to(device))
-    outputs = outputs.squeeze()
-    loss = criterion(outputs.cpu(), labels.type_as(outputs).cpu())
-    train_loss += loss.item()
-
-    # Backward pass
-    loss.backward()
-    optimizer.step()
-
-  return train_loss / len(data_loader)
-
-from sklearn.metrics import classification_report
-
-def val_fn(data_loader, model, criterion):
-  model.eval()
-  val_loss, predictions, true_labels = 0, [], []
-
-  with torch.no_grad():
-    for batch in tqdm(data_loader):
-      ids, mask, labels = batch
-      labels = labels.unsqueeze(1)
-
-      # Forward pass
-      outputs = model(ids.to(device), mask.to(device))
-      loss = criterion(outputs.cpu(), labels.float().cpu())
-      val_loss += loss.item()
-
-      preds = (torch.sigmoid(outputs) > 0.5).float()
-      predictions.append(preds)
-      true_labels.append(labels)
-
-  predictions = torch.cat(predictions, dim=0)
-  true_labels = torch.cat(true_labels, dim=0)
-  val_loss /= len(data_loader)
-  report = classification_report(true_labels.cpu(), predictions.cpu(), labels=[0, 1], zero_division=0, output_dict=True)
-
-  return val_loss, report
+from hate_speech.metrics import best_threshold
+from hate_speech.telemetry import summarize
+from hate_speech.training import train_model, train_fn, val_fn
 
 """### GridSearch"""
 
@@ -1601,7 +1881,8 @@ batch_sizes = [32, 64]
 pos_weight = torch.tensor([1.4])
 dropout_rate = [0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8]
 
-results_df = pd.DataFrame(columns=["learning_rate", "pos_weight", "seed", "batch_size", "dropout_rate", "val_loss", "f1_score"])
+results_df = pd.DataFrame(columns=["learning_rate", "pos_weight", "seed", "batch_size", "dropout_rate", "val_loss", "f1_score",
+                                   "train_seconds", "eval_seconds", "examples_per_sec", "tokens_per_sec", "padding_ratio", "peak_rss_mb", "peak_device_mb"])
 
 # Loop over the hyperparameter grid
 for seed in seeds:
@@ -1618,9 +1899,9 @@ for seed in seeds:
       criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
       optimizer = torch.optim.Adam(model.parameters(), lr=lr)
 
-      _, losses, reports = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=num_epochs)
+      _, losses, reports, telemetry = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=num_epochs)
 
-      results_df = results_df.append({"learning_rate": lr, "pos_weight": pos_weight, "seed": seed, "batch_size": batch_size,"dropout_rate": dropout, "val_loss": losses[-1], "f1_score": reports[-1]["macro avg"]["f1-score"]}, ignore_index=True)
+      results_df = results_df.append({"learning_rate": lr, "pos_weight": pos_weight, "seed": seed, "batch_size": batch_size,"dropout_rate": dropout, "val_loss": losses[-1], "f1_score": reports[-1]["macro avg"]["f1-score"], **summarize(telemetry)}, ignore_index=True)
 
 # Get row with max f1_score
 max_f1_row = results_df.loc[results_df['f1_score'].idxmax()]
@@ -1659,7 +1940,7 @@ criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
 optimizer = torch.optim.Adam(best_model.parameters(), lr=lr)
 
 # Train the model and validate loss, F1 score, and precision
-train_loss, val_loss, report = train_model(best_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=10)
+train_loss, val_loss, report, telemetry = train_model(best_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=10)
 
 import matplotlib.pyplot as plt
 
@@ -1674,12 +1955,21 @@ plt.ylabel('Value')
 plt.legend()
 plt.show()
 
+# decision threshold with the best validation macro-F1, pos_weight moves it away from 0.5
+_, report_default, val_logits, val_labels = val_fn(val_dataloader, best_model, criterion, return_logits=True)
+threshold, sweep = best_threshold(val_logits, val_labels)
+
+print(f"Threshold {threshold:.3f}: macro-F1 {sweep['macro_f1'].max():.3f} (0.5: {report_default['macro avg']['f1-score']:.3f})")
+
 # to access drive
 from google.colab import drive
 drive.mount('/content/drive')
 
-# Save the fine-tuned model
+# Save the fine-tuned model and its decision threshold
+from hate_speech.inference import save_threshold
+
 torch.save(best_model.state_dict(), "/content/drive/MyDrive/Colab Notebooks/model_spanish_hs")
+save_threshold("/content/drive/MyDrive/Colab Notebooks/model_spanish_hs", threshold)
 
 """#### Evaluation"""
 
@@ -1689,10 +1979,13 @@ drive.mount('/content/drive')
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# Load model
+# Load model and decision threshold
+from hate_speech.inference import load_threshold
+
 best_model_hs = Model(dropout)
 best_model_hs.load_state_dict(torch.load("/content/drive/MyDrive/Colab Notebooks/model_spanish_hs"))
 best_model_hs = best_model_hs.to(device)
+threshold = load_threshold("/content/drive/MyDrive/Colab Notebooks/model_spanish_hs")
 
 set_reproducibility(seed)
 
@@ -1701,7 +1994,7 @@ test_dataloader = tokenization(X_test, y_test, batch_size=batch_size)
 
 criterion = torch.nn.BCEWithLogitsLoss()
 
-loss, report = val_fn(test_dataloader, best_model_hs, criterion)
+loss, report = val_fn(test_dataloader, best_model_hs, criterion, threshold)
 
 print(f"\nLoss: {loss}")
 
@@ -1888,85 +2181,15 @@ class Model(torch.nn.Module):
     self.linear = torch.nn.Linear(768, 1)
 
   def forward(self, input_ids, attention_mask):
-    outputs = self.bert(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device))
+    outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
     pooled_output = outputs.pooler_output
     pooled_output = self.dropout(pooled_output)
     logits = self.linear(pooled_output)
     return logits
 
-from tqdm import tqdm
-
-def train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs):
-  early_stopping = EarlyStopping(patience=int(num_epochs * 0.1))
-  train_losses = []
-  val_losses = []
-  reports = []
-  for epoch in range(num_epochs):
-    print(f"Epoch {epoch+1}")
-
-    # Train on training set
-    train_loss = train_fn(train_dataloader, model, criterion, optimizer)
-
-    # Evaluate on validation set
-    val_loss, report = val_fn(val_dataloader, model, criterion)
-
-    train_losses.append(train_loss)
-    val_losses.append(val_loss)
-    reports.append(report)
-
-    # Check early stopping
-    if early_stopping.step(val_losses[-1]):
-      break
-
-  return train_losses, val_losses, reports
-
-def train_fn(data_loader, model, criterion, optimizer):
-  # Train on training set
-  model.train()
-  train_loss = 0
-
-  for batch in tqdm(data_loader):
-    ids, mask, labels = batch
-    optimizer.zero_grad()
-
-    # Forward pass
-    outputs = model(ids.to(device), mask.to(device))
-    outputs = outputs.squeeze()
-    loss = criterion(outputs.cpu(), labels.type_as(outputs).cpu())
-    train_loss += loss.item()
-
-    # Backward pass
-    loss.backward()
-    optimizer.step()
-
-  return train_loss / len(data_loader)
-
-from sklearn.metrics import classification_report
-
-def val_fn(data_loader, model, criterion):
-  model.eval()
-  val_loss, predictions, true_labels = 0, [], []
-
-  with torch.no_grad():
-    for batch in tqdm(data_loader):
-      ids, mask, labels = batch
-      labels = labels.unsqueeze(1)
-
-      # Forward pass
-      outputs = model(ids.to(device), mask.to(device))
-      loss = criterion(outputs.cpu(), labels.float().cpu())
-      val_loss += loss.item()
-
-      preds = (torch.sigmoid(outputs) > 0.5).float()
-      predictions.append(preds)
-      true_labels.append(labels)
-
-  predictions = torch.cat(predictions, dim=0)
-  true_labels = torch.cat(true_labels, dim=0)
-  val_loss /= len(data_loader)
-  report = classification_report(true_labels.cpu(), predictions.cpu(), labels=[0, 1], zero_division=0, output_dict=True)
-
-  return val_loss, report
+from hate_speech.metrics import best_threshold
+from hate_speech.telemetry import summarize
+from hate_speech.training import train_model, train_fn, val_fn
 
 """### GridSearch"""
 
@@ -1980,7 +2203,8 @@ batch_sizes = [32, 64]
 pos_weight = torch.tensor([2.8])
 dropout_rate = [0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8]
 
-results_df = pd.DataFrame(columns=["learning_rate", "pos_weight", "seed", "batch_size", "dropout_rate", "val_loss", "f1_score"])
+results_df = pd.DataFrame(columns=["learning_rate", "pos_weight", "seed", "batch_size", "dropout_rate", "val_loss", "f1_score",
+                                   "train_seconds", "eval_seconds", "examples_per_sec", "tokens_per_sec", "padding_ratio", "peak_rss_mb", "peak_device_mb"])
 
 # Loop over the hyperparameter grid
 for seed in seeds:
@@ -1999,9 +2223,9 @@ for seed in seeds:
       criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
       optimizer = torch.optim.Adam(model.parameters(), lr=lr)
 
-      _, losses, reports = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=num_epochs)
+      _, losses, reports, telemetry = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=num_epochs)
 
-      results_df = results_df.append({"learning_rate": lr, "pos_weight": pos_weight, "seed": seed, "batch_size": batch_size,"dropout_rate": dropout, "val_loss": losses[-1], "f1_score": reports[-1]["macro avg"]["f1-score"]}, ignore_index=True)
+      results_df = results_df.append({"learning_rate": lr, "pos_weight": pos_weight, "seed": seed, "batch_size": batch_size,"dropout_rate": dropout, "val_loss": losses[-1], "f1_score": reports[-1]["macro avg"]["f1-score"], **summarize(telemetry)}, ignore_index=True)
 
 # Get row with max f1_score
 max_f1_row = results_df.loc[results_df['f1_score'].idxmax()]
@@ -2041,7 +2265,7 @@ criterion = torch.nn.BCEWithLogitsLoss(pos_weight=pos_weight)
 optimizer = torch.optim.Adam(best_model.parameters(), lr=lr)
 
 # Train the model and validate loss, F1 score, and precision
-train_loss, val_loss, report = train_model(best_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=20)
+train_loss, val_loss, report, telemetry = train_model(best_model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=20)
 
 import matplotlib.pyplot as plt
 
@@ -2056,12 +2280,21 @@ plt.ylabel('Value')
 plt.legend()
 plt.show()
 
+# decision threshold with the best validation macro-F1, pos_weight moves it away from 0.5
+_, report_default, val_logits, val_labels = val_fn(val_dataloader, best_model, criterion, return_logits=True)
+threshold, sweep = best_threshold(val_logits, val_labels)
+
+print(f"Threshold {threshold:.3f}: macro-F1 {sweep['macro_f1'].max():.3f} (0.5: {report_default['macro avg']['f1-score']:.3f})")
+
 # to access drive
 from google.colab import drive
 drive.mount('/content/drive')
 
-# Save the fine-tuned model
+# Save the fine-tuned model and its decision threshold
+from hate_speech.inference import save_threshold
+
 torch.save(best_model.state_dict(), "/content/drive/MyDrive/Colab Notebooks/model_german_hs")
+save_threshold("/content/drive/MyDrive/Colab Notebooks/model_german_hs", threshold)
 
 """#### Evaluation"""
 
@@ -2071,10 +2304,13 @@ drive.mount('/content/drive')
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-# Load model
+# Load model and decision threshold
+from hate_speech.inference import load_threshold
+
 best_model_hs = Model(dropout)
 best_model_hs.load_state_dict(torch.load("/content/drive/MyDrive/Colab Notebooks/model_german_hs"))
 best_model_hs = best_model_hs.to(device)
+threshold = load_threshold("/content/drive/MyDrive/Colab Notebooks/model_german_hs")
 
 set_reproducibility(seed)
 
@@ -2086,7 +2322,7 @@ test_dataloader = tokenization(X_test, y_test, batch_size=batch_size)
 
 criterion = torch.nn.BCEWithLogitsLoss()
 
-loss, report = val_fn(test_dataloader, best_model_hs, criterion)
+loss, report = val_fn(test_dataloader, best_model_hs, criterion, threshold)
 
 print(f"\nLoss: {loss}")
 
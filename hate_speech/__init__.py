@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+"""
+HaSpeeDe2 hate speech and stereotype classifiers: training, inference and serving
+
+    pip install -e .
+    hate-speech train --data-dir /content --output model_hs
+
+    from hate_speech.inference import load_model, predict
+
+The submodules are not imported here, so `import hate_speech` does not load torch or transformers.
+"""
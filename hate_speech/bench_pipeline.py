@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Offline micro-benchmarks of the pipeline hot paths, on a CPU-only box
+
+    python -m hate_speech.bench_pipeline --output bench.json
+    python -m hate_speech.bench_pipeline --baseline bench.json --tolerance 0.2     # exit code 1 on a regression
+
+No download is needed: the encoder is a tiny randomly initialized BERT written to a temporary
+directory, with a vocabulary built from the synthetic corpora of synthetic_data.py, and the
+stopwords are a fixed list. Each stage mirrors the corresponding notebook code (preprocess_tweet,
+tokenization, Model.forward, a train_fn step, val_fn, the Task C parser) or calls inference.py
+directly.
+Throughput is items/s at the median latency of the repeats.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import torch
+from .synthetic_data import VOCABULARY, taskab_frame, taskc_lines
+
+ITALIAN = VOCABULARY['italian']
+ITALIAN_STOPWORDS = ITALIAN['stopwords']
+WORDS = ITALIAN['neutral'] + ITALIAN['hateful'] + ITALIAN_STOPWORDS
+
+def parse_task_c(lines):
+  # the notebook's Task C parsing: rows of the file, id split, tag mapping, then one row of tokens and tags per tweet
+  row = []
+  for line in filter(None, (line.rstrip() for line in lines)):
+    if not line.startswith('#') and not line.startswith(' '):
+      row.append([word for word in line.strip().split('\t')])
+  df = pd.DataFrame(row, columns=['id', 'token', 'IOB'])
+  df[['id', 'numb']] = df.id.str.split('-', expand=True)
+  df.loc[df.IOB == 'B-NU-CGA', 'IOB'] = 'B'
+  df.loc[df.IOB == 'I-NU-CGA', 'IOB'] = 'I'
+
+  rows = []
+  for name, group in df.groupby('id'):
+    rows.append([name, group['token'].tolist(), group['IOB'].tolist()])
+  return pd.DataFrame(rows, columns=['id', 'sentences', 'IOB'])
+
+def build_tiny_model(directory, hidden_size=128, num_layers=2, seed=0):
+  # tokenizer vocabulary from the synthetic corpora, randomly initialized encoder; both saved in directory
+  from transformers import BertConfig, BertModel, BertTokenizer
+
+  characters = sorted(set(''.join(WORDS)) | set('abcdefghijklmnopqrstuvwxyz0123456789'))
+  vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + sorted(set(WORDS)) + characters + [f'##{c}' for c in characters]
+  with open(os.path.join(directory, 'vocab.txt'), 'w', encoding='utf-8') as f:
+    f.write('\n'.join(vocab))
+  BertTokenizer(os.path.join(directory, 'vocab.txt'), do_lower_case=True).save_pretrained(directory)
+
+  torch.manual_seed(seed)
+  config = BertConfig(vocab_size=len(vocab), hidden_size=hidden_size, num_hidden_layers=num_layers,
+                      num_attention_heads=max(hidden_size // 64, 1), intermediate_size=hidden_size * 4, max_position_embeddings=512)
+  BertModel(config).save_pretrained(directory)
+
+def measure(fn, num_items, repeats, warmup=1):
+  for _ in range(warmup):
+    fn()
+  latencies = []
+  for _ in range(repeats):
+    start = time.perf_counter()
+    fn()
+    latencies.append(time.perf_counter() - start)
+  latencies = np.array(latencies) * 1000
+  return {'items': num_items,
+          'throughput_per_sec': num_items / np.median(latencies) * 1000,
+          'p50_ms': float(np.percentile(latencies, 50)),
+          'p99_ms': float(np.percentile(latencies, 99))}
+
+def run(args, model_dir):
+  from torch.utils.data import DataLoader, SequentialSampler, TensorDataset
+  from transformers import AutoTokenizer
+  from .inference import Model, get_preprocess_tweet, predict_encoded
+  from .metrics import StreamingReport
+
+  tokenizer = AutoTokenizer.from_pretrained(model_dir)
+  preprocess = get_preprocess_tweet(stopword_list=ITALIAN_STOPWORDS)
+  corpus = taskab_frame(args.num_texts)
+  tweets = corpus['text'].tolist()
+  texts = [preprocess(tweet) for tweet in tweets]
+  labels = corpus['hs'].values
+  task_c_lines = taskc_lines(args.num_texts)
+
+  torch.manual_seed(0)
+  model = Model(0.1, model_dir)
+  criterion = torch.nn.BCEWithLogitsLoss()
+  optimizer = torch.optim.Adam(model.parameters(), lr=1e-5)
+
+  # one padded batch and a small validation set, as produced by the notebook's tokenization()
+  encoding = tokenizer(texts, max_length=256, padding=True, truncation=True, return_tensors='pt')
+  ids, mask = encoding['input_ids'][:args.batch_size], encoding['attention_mask'][:args.batch_size]
+  batch_labels = torch.tensor(labels[:args.batch_size])
+  val_size = args.batch_size * 8
+  val_loader = DataLoader(TensorDataset(encoding['input_ids'][:val_size], encoding['attention_mask'][:val_size], torch.tensor(labels[:val_size])),
+                          sampler=SequentialSampler(range(val_size)), batch_size=args.batch_size)
+
+  def forward():
+    model.eval()
+    with torch.no_grad():
+      model(ids, mask)
+
+  def train_step():
+    model.train()
+    optimizer.zero_grad()
+    outputs = model(ids, mask).squeeze()
+    loss = criterion(outputs, batch_labels.type_as(outputs))
+    loss.backward()
+    optimizer.step()
+
+  def val():
+    model.eval()
+    metrics = StreamingReport(labels=[0, 1])
+    with torch.no_grad():
+      for batch_ids, batch_mask, batch_labels_ in val_loader:
+        outputs = model(batch_ids, batch_mask)
+        criterion(outputs, batch_labels_.unsqueeze(1).float()).item()
+        metrics.update(torch.sigmoid(outputs) > 0.5, batch_labels_)
+    metrics.report()
+
+  input_ids = tokenizer(texts[:val_size], max_length=256, truncation=True)['input_ids']
+  stages = {
+    'preprocess_tweet': (lambda: [preprocess(tweet) for tweet in tweets], len(tweets)),
+    'tokenization': (lambda: tokenizer(texts, max_length=256, padding=True, truncation=True), len(texts)),
+    'forward': (forward, args.batch_size),
+    'train_step': (train_step, args.batch_size),
+    'val_fn': (val, val_size),
+    'predict': (lambda: predict_encoded(input_ids, model, tokenizer, args.batch_size), val_size),
+    'task_c_parse': (lambda: parse_task_c(task_c_lines), args.num_texts),
+  }
+
+  results = {}
+  for name in args.stages or list(stages):
+    fn, num_items = stages[name]
+    results[name] = measure(fn, num_items, args.repeats)
+    print(f"{name:>17}: {results[name]['throughput_per_sec']:12,.1f} items/s  p50 {results[name]['p50_ms']:9.2f} ms  p99 {results[name]['p99_ms']:9.2f} ms")
+  return results
+
+def compare(results, baseline, tolerance):
+  # stages whose throughput fell more than tolerance below the baseline
+  regressions = []
+  for name, result in results.items():
+    if name in baseline['stages']:
+      reference = baseline['stages'][name]['throughput_per_sec']
+      change = result['throughput_per_sec'] / reference - 1
+      print(f"{name:>17}: {change * 100:+.1f}% vs baseline")
+      if change < -tolerance:
+        regressions.append(name)
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description='Offline micro-benchmarks of the pipeline stages')
+  parser.add_argument('--output', help='write the results to this JSON file')
+  parser.add_argument('--baseline', help='JSON file of a previous run to compare against')
+  parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative throughput drop before failing')
+  parser.add_argument('--stages', nargs='+', help='subset of the stages to run')
+  parser.add_argument('--num-texts', type=int, default=2000, help='size of the synthetic corpora')
+  parser.add_argument('--batch-size', type=int, default=32)
+  parser.add_argument('--repeats', type=int, default=10)
+  parser.add_argument('--hidden-size', type=int, default=128)
+  parser.add_argument('--num-layers', type=int, default=2)
+  parser.add_argument('--threads', type=int, help='torch intra-op threads (default: torch default)')
+  args = parser.parse_args()
+
+  if args.threads:
+    torch.set_num_threads(args.threads)
+
+  with tempfile.TemporaryDirectory() as model_dir:
+    build_tiny_model(model_dir, args.hidden_size, args.num_layers)
+    results = run(args, model_dir)
+
+  report = {'environment': {'python': platform.python_version(), 'torch': torch.__version__, 'platform': platform.platform(),
+                            'threads': torch.get_num_threads()},
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+            'stages': results}
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+      print(f"Regression in {', '.join(regressions)} (more than {args.tolerance * 100:.0f}% slower than the baseline)")
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Load generator for server.py: p50/p99 latency and throughput at several concurrency levels
+
+    python -m hate_speech.server --model-hs model_hs &
+    python -m hate_speech.bench_server --port 8080 --concurrency 1 8 32 64 --data haspeede2_reference_taskAB-tweets.tsv
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+
+SAMPLE_TEXTS = [
+  "@user gli immigrati vanno rimandati tutti a casa loro URL",
+  "Oggi al mercato c'era un sacco di gente, bella giornata",
+  "Questi rom rubano e nessuno fa niente #vergogna",
+  "Il governo discute la nuova legge sull'accoglienza dei migranti",
+]
+
+async def client(host, port, texts, deadline, latencies):
+  reader, writer = await asyncio.open_connection(host, port)
+  i = 0
+  try:
+    while time.perf_counter() < deadline:
+      body = json.dumps({'text': texts[i % len(texts)]}).encode('utf-8')
+      i += 1
+
+      start = time.perf_counter()
+      writer.write(f"POST /predict HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                   f"Content-Length: {len(body)}\r\n\r\n".encode('latin-1') + body)
+      await writer.drain()
+
+      # status line and headers, then the body
+      content_length = 0
+      while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+          break
+        if line.lower().startswith(b'content-length:'):
+          content_length = int(line.split(b':', 1)[1])
+      await reader.readexactly(content_length)
+
+      latencies.append(time.perf_counter() - start)
+  finally:
+    writer.close()
+
+async def run_level(host, port, texts, concurrency, duration):
+  latencies = []
+  deadline = time.perf_counter() + duration
+  start = time.perf_counter()
+  await asyncio.gather(*[client(host, port, texts[i::concurrency] or texts, deadline, latencies) for i in range(concurrency)])
+  elapsed = time.perf_counter() - start
+
+  latencies = np.array(latencies) * 1000
+  return {'concurrency': concurrency,
+          'requests': len(latencies),
+          'throughput_rps': len(latencies) / elapsed,
+          'p50_ms': np.percentile(latencies, 50),
+          'p99_ms': np.percentile(latencies, 99)}
+
+def load_texts(path):
+  if path is None:
+    return SAMPLE_TEXTS
+  import pandas as pd
+  return pd.read_csv(path, sep='\t', names=['id', 'text'], usecols=[0, 1], header=0)['text'].tolist()
+
+def main():
+  parser = argparse.ArgumentParser(description='Load generator for the inference server')
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32, 64])
+  parser.add_argument('--duration', type=float, default=10, help='seconds per concurrency level')
+  parser.add_argument('--data', help='HaSpeeDe2 Task A/B tsv to draw texts from')
+  args = parser.parse_args()
+
+  texts = load_texts(args.data)
+  print(f"{'concurrency':>11} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+  for concurrency in args.concurrency:
+    r = asyncio.run(run_level(args.host, args.port, texts, concurrency, args.duration))
+    print(f"{r['concurrency']:>11} {r['requests']:>9} {r['throughput_rps']:>9.1f} {r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f}")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Prediction cache keyed by the normalized text and the model version
+
+Retweets and copy-pasted posts normalize to the same string under preprocess_tweet,
+so their predictions are looked up instead of recomputed. The memory tier is a bounded
+LRU; the optional disk tier is a sqlite file shared across runs.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+
+class PredictionCache(object):
+  def __init__(self, model_version, max_size=100000, path=None):
+    self.model_version = model_version
+    self.max_size = max_size
+    self.memory = OrderedDict()
+    self.lock = threading.Lock()
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+
+    self.db = None
+    if path is not None:
+      self.db = sqlite3.connect(path, check_same_thread=False)
+      self.db.execute('CREATE TABLE IF NOT EXISTS predictions (key TEXT PRIMARY KEY, value TEXT)')
+      self.db.commit()
+
+  def key(self, text):
+    return hashlib.sha1(f'{self.model_version}\0{text}'.encode('utf-8')).hexdigest()
+
+  def get_many(self, texts):
+    # one value per text, None for a miss
+    keys = [self.key(text) for text in texts]
+    values = [None] * len(keys)
+
+    with self.lock:
+      for i, key in enumerate(keys):
+        if key in self.memory:
+          self.memory.move_to_end(key)
+          values[i] = self.memory[key]
+
+      if self.db is not None:
+        missing = list({key for key, value in zip(keys, values) if value is None})
+        found = {}
+        for start in range(0, len(missing), 500):
+          chunk = missing[start:start + 500]
+          rows = self.db.execute(f"SELECT key, value FROM predictions WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+          found.update((key, json.loads(value)) for key, value in rows)
+
+        for i, key in enumerate(keys):
+          if values[i] is None and key in found:
+            values[i] = found[key]
+            self.disk_hits += 1
+        self._store(found.items())
+
+      num_misses = sum(value is None for value in values)
+      self.misses += num_misses
+      self.hits += len(values) - num_misses
+
+    return values
+
+  def put_many(self, texts, values):
+    items = [(self.key(text), value) for text, value in zip(texts, values)]
+    with self.lock:
+      self._store(items)
+      if self.db is not None:
+        self.db.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?)', [(key, json.dumps(value)) for key, value in items])
+        self.db.commit()
+
+  def _store(self, items):
+    for key, value in items:
+      self.memory[key] = value
+      self.memory.move_to_end(key)
+    while len(self.memory) > self.max_size:
+      self.memory.popitem(last=False)
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0, 'size': len(self.memory)}
+
+  def close(self):
+    if self.db is not None:
+      self.db.close()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Two-stage cascade for bulk scoring: a sparse linear pre-filter scores every post and only
+the posts whose pre-filter probability falls inside an uncertainty band go through BERT
+
+    prefilter = train_prefilter(X_train, y_train)         # preprocess_tweet output, as for Task A
+    low, high = choose_band(prefilter.predict_proba(X_val)[:, 1], y_val, target_recall=0.8,
+                            bert_preds=predict(X_val, model) > 0.5)
+    cascade = Cascade(prefilter, model, low, high)
+    probs, sent_to_bert = cascade.predict(texts)
+"""
+
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import make_pipeline, make_union
+
+def train_prefilter(texts, labels, C=4.0):
+  # word uni/bigrams and character n-grams hashed into a fixed space, no vocabulary to store
+  prefilter = make_pipeline(
+    make_union(HashingVectorizer(ngram_range=(1, 2), n_features=2 ** 20, alternate_sign=False),
+               HashingVectorizer(analyzer='char_wb', ngram_range=(2, 5), n_features=2 ** 20, alternate_sign=False)),
+    TfidfTransformer(sublinear_tf=True),
+    LogisticRegression(C=C, class_weight='balanced', max_iter=1000))
+  return prefilter.fit(list(texts), np.asarray(labels))
+
+def choose_band(prefilter_probs, labels, target_recall, target_precision=None, bert_preds=None, num_candidates=100):
+  # smallest band [low, high] (fewest posts sent to BERT) whose cascade reaches target_recall and
+  # target_precision (default: the precision of BERT alone): below low -> negative, above high ->
+  # positive, inside -> BERT (bert_preds on the same posts, or assumed correct when not given);
+  # when no band reaches the targets, the band covers every post, i.e. BERT alone
+  prefilter_probs, labels = np.asarray(prefilter_probs), np.asarray(labels).astype(bool)
+  bert_preds = labels if bert_preds is None else np.asarray(bert_preds).astype(bool).ravel()
+  if target_precision is None:
+    target_precision = (bert_preds & labels).sum() / max(bert_preds.sum(), 1)
+  candidates = np.unique(np.quantile(prefilter_probs, np.linspace(0, 1, num_candidates + 1)))
+  candidates[-1] = np.nextafter(candidates[-1], np.inf)
+
+  # with posts sorted by probability, every count for a band is a difference of prefix sums
+  order = np.argsort(prefilter_probs, kind='stable')
+  cut = np.searchsorted(prefilter_probs[order], candidates)
+  positives = np.concatenate([[0], np.cumsum(labels[order])])[cut]
+  bert_positives = np.concatenate([[0], np.cumsum(bert_preds[order])])[cut]
+  bert_true_positives = np.concatenate([[0], np.cumsum((bert_preds & labels)[order])])[cut]
+  n = len(prefilter_probs)
+
+  # (low, high) grids: below low -> negative, [low, high) -> BERT, from high up -> positive
+  true_positives = (labels.sum() - positives)[None, :] + (bert_true_positives[None, :] - bert_true_positives[:, None])
+  predicted = (n - cut)[None, :] + (bert_positives[None, :] - bert_positives[:, None])
+  recall = true_positives / max(labels.sum(), 1)
+  precision = true_positives / np.maximum(predicted, 1)
+  bert_fraction = (cut[None, :] - cut[:, None]) / n
+  valid = (cut[:, None] <= cut[None, :]) & (recall >= target_recall) & (precision >= target_precision)
+  if not valid.any():
+    return float(candidates[0]), float(candidates[-1])
+
+  cost = np.where(valid, bert_fraction, np.inf)
+  low, high = np.unravel_index(np.argmin(cost), cost.shape)
+  return float(candidates[low]), float(candidates[high])
+
+class Cascade(object):
+  def __init__(self, prefilter, model, low, high, tokenizer=None, batch_size=64, threshold=None):
+    # threshold: decision threshold of the model's probabilities, model.threshold by default
+    self.prefilter = prefilter
+    self.model = model
+    self.low = low
+    self.high = high
+    self.threshold = getattr(model, 'threshold', 0.5) if threshold is None else threshold
+    self.tokenizer = tokenizer
+    self.batch_size = batch_size
+
+  def predict(self, texts):
+    # texts must already be normalized with preprocess_tweet; posts outside the band get the hard
+    # decision of choose_band's rule (0 below low, 1 from high up), so `probs > self.threshold` is the cascade's label
+    from .inference import predict
+
+    texts = list(texts)
+    probs = self.prefilter.predict_proba(texts)[:, 1].astype(np.float32)
+    in_band = (probs >= self.low) & (probs < self.high)
+
+    band_texts = [text for text, b in zip(texts, in_band) if b]
+    if band_texts:
+      probs[in_band] = predict(band_texts, self.model, batch_size=self.batch_size, tokenizer=self.tokenizer, preprocess=lambda text: text)
+    probs[~in_band & (probs < self.low)] = 0
+    probs[~in_band & (probs >= self.high)] = 1
+    return probs, in_band
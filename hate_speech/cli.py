@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+Command line interface for training, evaluating and running the Task A classifier
+
+    hate-speech train --data-dir /content --output model_hs --epochs 2
+    hate-speech eval --data-dir /content --model model_hs
+    hate-speech predict --model model_hs < posts.txt           # probability and label per non-blank line
+    hate-speech grid --data-dir /content --dropouts 0.2 0.3 0.4 --output grid.csv
+
+Only argparse is imported at startup: torch, transformers, sklearn, nltk and the project
+modules are imported by the subcommand that needs them, so `--help` is instant. `predict`
+does not use sklearn itself, but transformers imports it when it is installed (about 1.5s of
+the 5-8s cold start, most of which is torch and transformers); pass --stopwords to skip
+nltk's list.
+"""
+
+import argparse
+import json
+import sys
+
+def read_stopwords(path):
+  if path is None:
+    return None
+  with open(path, encoding='utf-8') as f:
+    return [line.strip() for line in f if line.strip()]
+
+def read_texts(lines):
+  # one post per line, blank lines are skipped
+  texts = [line.rstrip('\n') for line in lines]
+  return [text for text in texts if text.strip()]
+
+def setup(args):
+  # torch and the device, after the CLI has been parsed
+  import torch
+
+  if args.threads:
+    torch.set_num_threads(args.threads)
+  return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+def prepare_data(args, seed):
+  from .inference import get_preprocess_tweet
+  from .training import load_corpora, preprocessing, set_reproducibility
+
+  set_reproducibility(seed)
+  dev_df, test_df, test_df_news = load_corpora(args.data_dir)
+  preprocess = get_preprocess_tweet(stopword_list=read_stopwords(args.stopwords))
+  X_train, X_val, y_train, y_val, _, _, _, _ = preprocessing(dev_df, test_df, test_df_news, args.subset, args.near_duplicates, preprocess)
+  return X_train, X_val, y_train, y_val
+
+def train(args):
+  device = setup(args)
+  import torch
+  from transformers import AutoTokenizer
+  from .inference import Model
+  from .metrics import best_threshold
+  from .model_store import save_store
+  from .training import tokenization, train_model, val_fn
+
+  tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+  X_train, X_val, y_train, y_val = prepare_data(args, args.seed)
+  train_dataloader = tokenization(X_train, y_train, args.batch_size, tokenizer)
+  val_dataloader = tokenization(X_val, y_val, args.batch_size, tokenizer, shuffle=False)
+
+  model = Model(args.dropout, args.model_name).to(device)
+  criterion = torch.nn.BCEWithLogitsLoss(pos_weight=torch.tensor([args.pos_weight]))
+  optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+  _, val_losses, reports, _ = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, args.epochs,
+                                          telemetry_path=args.telemetry, progress=not args.quiet)
+
+  # decision threshold with the best validation macro-F1
+  _, _, val_logits, val_labels = val_fn(val_dataloader, model, criterion, return_logits=True, progress=False)
+  threshold, sweep = best_threshold(val_logits, val_labels)
+  save_store(model, args.output, tokenizer, threshold)
+  print(f"val_loss {val_losses[-1]:.4f}, macro-F1 {reports[-1]['macro avg']['f1-score']:.3f} "
+        f"({sweep['macro_f1'].max():.3f} at threshold {threshold:.3f}), saved to {args.output}")
+
+def load(args, device):
+  # a model store directory is self-contained and loads offline; a state dict needs --model-name
+  from .model_store import is_store, load_store
+
+  if is_store(args.model):
+    return load_store(args.model, device)
+
+  from transformers import AutoTokenizer
+  from .inference import load_model
+
+  tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+  model = load_model(args.model, args.dropout, args.model_name, device)
+  return model, tokenizer
+
+def evaluate(args):
+  device = setup(args)
+  import torch
+  from .inference import get_preprocess_tweet
+  from .training import load_corpora, tokenization, val_fn
+
+  model, tokenizer = load(args, device)
+  preprocess = get_preprocess_tweet(stopword_list=read_stopwords(args.stopwords))
+  _, test_df, test_df_news = load_corpora(args.data_dir)
+
+  reports = {}
+  for name, df in [('tweets', test_df), ('news', test_df_news)]:
+    data_loader = tokenization(df['text'].apply(preprocess), df['hs'], args.batch_size, tokenizer, shuffle=False)
+    loss, reports[name] = val_fn(data_loader, model, torch.nn.BCEWithLogitsLoss(), model.threshold, progress=not args.quiet)
+    print(f"{name}: loss {loss:.4f}, macro-F1 {reports[name]['macro avg']['f1-score']:.3f} (threshold {model.threshold:.3f})")
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(reports, f, indent=2)
+
+def predict(args):
+  device = setup(args)
+  from .inference import get_preprocess_tweet, predict as predict_texts
+
+  model, tokenizer = load(args, device)
+  preprocess = get_preprocess_tweet(stopword_list=read_stopwords(args.stopwords))
+  if args.input:
+    with open(args.input, encoding='utf-8') as f:
+      texts = read_texts(f)
+  else:
+    texts = read_texts(sys.stdin)
+  probs = predict_texts(texts, model, args.batch_size, tokenizer, preprocess)
+  for prob in probs:
+    print(f"{prob:.4f}\t{int(prob > model.threshold)}")
+
+def grid(args):
+  device = setup(args)
+  import pandas as pd
+  import torch
+  from transformers import AutoTokenizer
+  from .inference import Model
+  from .telemetry import summarize
+  from .training import set_reproducibility, tokenization, train_model
+
+  tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+  rows = []
+  for seed in args.seeds:
+    X_train, X_val, y_train, y_val = prepare_data(args, seed)
+
+    for batch_size in args.batch_sizes:
+      train_dataloader = tokenization(X_train, y_train, batch_size, tokenizer)
+      val_dataloader = tokenization(X_val, y_val, batch_size, tokenizer, shuffle=False)
+
+      for dropout in args.dropouts:
+        set_reproducibility(seed)
+        model = Model(dropout, args.model_name).to(device)
+        criterion = torch.nn.BCEWithLogitsLoss(pos_weight=torch.tensor([args.pos_weight]))
+        optimizer = torch.optim.Adam(model.parameters(), lr=args.lr)
+        _, losses, reports, telemetry = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, args.epochs,
+                                                    telemetry_path=args.telemetry, progress=not args.quiet)
+        rows.append({'learning_rate': args.lr, 'pos_weight': args.pos_weight, 'seed': seed, 'batch_size': batch_size, 'dropout_rate': dropout,
+                     'val_loss': losses[-1], 'f1_score': reports[-1]['macro avg']['f1-score'], **summarize(telemetry)})
+
+  results_df = pd.DataFrame(rows)
+  best = results_df.loc[results_df['f1_score'].idxmax()]
+  print(results_df.to_string(index=False))
+  print(f"Best f1_score {best['f1_score']:.3f}: seed {best['seed']}, batch_size {best['batch_size']}, dropout rate {best['dropout_rate']}")
+  if args.output:
+    results_df.to_csv(args.output, index=False)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Train, evaluate and run the HaSpeeDe2 Task A hate speech classifier')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+
+  common = argparse.ArgumentParser(add_help=False)
+  common.add_argument('--model-name', default='dbmdz/bert-base-italian-uncased', help='pretrained encoder and tokenizer')
+  common.add_argument('--batch-size', type=int, default=32)
+  common.add_argument('--stopwords', help='file with one stopword per line, instead of nltk\'s Italian list')
+  common.add_argument('--threads', type=int, help='torch intra-op threads')
+  common.add_argument('--quiet', action='store_true', help='no progress bars')
+
+  data = argparse.ArgumentParser(add_help=False)
+  data.add_argument('--data-dir', default='/content', help='directory with haspeede2_dev/ and haspeede2_reference/')
+  data.add_argument('--subset', type=int, help='train on a random subset of this many dev posts')
+  data.add_argument('--near-duplicates', choices=['group', 'drop'], help='keep near-duplicate posts on one side of the split, or drop them')
+  data.add_argument('--lr', type=float, default=1e-5)
+  data.add_argument('--pos-weight', type=float, default=1.5)
+  data.add_argument('--telemetry', help='JSONL file for the per-epoch throughput and memory records')
+
+  model = argparse.ArgumentParser(add_help=False)
+  model.add_argument('--model', required=True, help='model store directory saved by train, or a state dict')
+  model.add_argument('--dropout', type=float, default=0.3)
+
+  command = subparsers.add_parser('train', parents=[common, data], help='fine-tune on the dev set and save the model and its threshold')
+  command.add_argument('--output', required=True, help='model store directory to save the model, tokenizer and threshold to')
+  command.add_argument('--epochs', type=int, default=2)
+  command.add_argument('--dropout', type=float, default=0.3)
+  command.add_argument('--seed', type=int, default=42)
+  command.set_defaults(run=train)
+
+  command = subparsers.add_parser('eval', parents=[common, model], help='classification report on the reference tweets and news')
+  command.add_argument('--data-dir', default='/content')
+  command.add_argument('--output', help='write both reports to this JSON file')
+  command.set_defaults(run=evaluate)
+
+  command = subparsers.add_parser('predict', parents=[common, model], help='positive class probability and label of every input line')
+  command.add_argument('--input', help='text file, one post per line, blank lines are skipped (default: stdin)')
+  command.set_defaults(run=predict)
+
+  command = subparsers.add_parser('grid', parents=[common, data], help='grid search over seeds, batch sizes and dropout rates')
+  command.add_argument('--seeds', type=int, nargs='+', default=[42, 12321])
+  command.add_argument('--batch-sizes', type=int, nargs='+', default=[32, 64])
+  command.add_argument('--dropouts', type=float, nargs='+', default=[0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8])
+  command.add_argument('--epochs', type=int, default=20)
+  command.add_argument('--output', help='write the results to this CSV file')
+  command.set_defaults(run=grid, subset=2500)
+
+  args = parser.parse_args(argv)
+  args.run(args)
+
+if __name__ == '__main__':
+  main()
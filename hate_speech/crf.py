@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Linear-chain CRF head for token classification (Task C nominal utterances)
+
+    crf = CRF(num_tags, *iob_constraints(label_map))
+    emissions, mask = pad_packed(packed_logits, lengths)         # (batch, time, tags), left-aligned
+    loss = crf.neg_log_likelihood(emissions, tags, mask)
+    best = crf.decode(emissions, mask)                            # (batch, time) Viterbi path
+
+The forward algorithm and Viterbi run over the whole batch at once: the only Python loop is
+over time steps, never over sentences. Transitions that the constraints forbid (e.g. O -> I)
+get a large negative score when decoding, so decoded sequences are always valid IOB; the
+likelihood leaves them free, since gold sequences truncated from the head can start with I.
+"""
+
+import torch
+
+FORBIDDEN = -1e4
+
+def iob_constraints(label_map):
+  # allowed[i, j]: tag j may follow tag i; allowed_start[j]: a sentence may start with tag j; PAD never appears
+  num_tags = len(label_map)
+  o, b, i = label_map['O'], label_map['B'], label_map['I']
+  allowed = torch.zeros(num_tags, num_tags, dtype=torch.bool)
+  allowed[[o, b, i], o] = True
+  allowed[[o, b, i], b] = True
+  allowed[[b, i], i] = True
+  allowed_start = torch.zeros(num_tags, dtype=torch.bool)
+  allowed_start[[o, b]] = True
+  return allowed, allowed_start
+
+def pad_packed(packed, lengths, padding_value=0):
+  # (num_tokens, ...) in row-major order of a (batch, time) token mask -> left-aligned (batch, max_length, ...) and its mask
+  lengths = torch.as_tensor(lengths, device=packed.device)
+  max_length = int(lengths.max()) if len(lengths) else 0
+  mask = torch.arange(max_length, device=packed.device)[None, :] < lengths[:, None]
+  padded = packed.new_full((len(lengths), max_length) + packed.shape[1:], padding_value)
+  padded[mask] = packed
+  return padded, mask
+
+class CRF(torch.nn.Module):
+  def __init__(self, num_tags, allowed=None, allowed_start=None):
+    super(CRF, self).__init__()
+    self.num_tags = num_tags
+    self.transitions = torch.nn.Parameter(torch.zeros(num_tags, num_tags))
+    self.start = torch.nn.Parameter(torch.zeros(num_tags))
+    self.end = torch.nn.Parameter(torch.zeros(num_tags))
+    self.register_buffer('allowed', torch.ones(num_tags, num_tags, dtype=torch.bool) if allowed is None else allowed)
+    self.register_buffer('allowed_start', torch.ones(num_tags, dtype=torch.bool) if allowed_start is None else allowed_start)
+
+  def _scores(self):
+    return self.transitions.masked_fill(~self.allowed, FORBIDDEN), self.start.masked_fill(~self.allowed_start, FORBIDDEN)
+
+  def neg_log_likelihood(self, emissions, tags, mask):
+    # mean over the sentences of -log p(tags | emissions); emissions (batch, time, tags), mask left-aligned
+    transitions, start = self.transitions, self.start
+    emissions = emissions.float()
+    mask = mask.bool()
+    batch = torch.arange(len(emissions), device=emissions.device)
+    lengths = mask.sum(dim=1)
+    last = (lengths - 1).clamp(min=0)
+
+    # score of the gold path
+    gold = start[tags[:, 0]] + emissions.gather(2, tags.unsqueeze(2)).squeeze(2).masked_fill(~mask, 0).sum(dim=1)
+    gold = gold + (transitions[tags[:, :-1], tags[:, 1:]] * mask[:, 1:]).sum(dim=1)
+    gold = gold + self.end[tags[batch, last]]
+
+    # forward algorithm: log-sum-exp over all paths, one step for the whole batch at a time
+    alpha = start + emissions[:, 0]
+    for t in range(1, emissions.shape[1]):
+      step = torch.logsumexp(alpha.unsqueeze(2) + transitions.unsqueeze(0), dim=1) + emissions[:, t]
+      alpha = torch.where(mask[:, t:t + 1], step, alpha)
+    log_partition = torch.logsumexp(alpha + self.end, dim=1)
+
+    has_tokens = lengths > 0
+    return ((log_partition - gold) * has_tokens).sum() / has_tokens.sum().clamp(min=1)
+
+  @torch.no_grad()
+  def decode(self, emissions, mask):
+    # Viterbi path of every sentence, (batch, time); positions outside the mask repeat the last tag
+    transitions, start = self._scores()
+    emissions = emissions.float()
+    mask = mask.bool()
+    batch_size, length, num_tags = emissions.shape
+    identity = torch.arange(num_tags, device=emissions.device).expand(batch_size, num_tags)
+
+    score = start + emissions[:, 0]
+    backpointers = []
+    for t in range(1, length):
+      best_score, best_previous = (score.unsqueeze(2) + transitions.unsqueeze(0)).max(dim=1)
+      step_mask = mask[:, t:t + 1]
+      score = torch.where(step_mask, best_score + emissions[:, t], score)
+      # padded steps point to themselves, so backtracking carries the last real tag through them
+      backpointers.append(torch.where(step_mask, best_previous, identity))
+
+    tags = torch.empty(batch_size, length, dtype=torch.long, device=emissions.device)
+    tags[:, -1] = (score + self.end).argmax(dim=1)
+    for t in range(length - 2, -1, -1):
+      tags[:, t] = backpointers[t].gather(1, tags[:, t + 1:t + 2]).squeeze(1)
+    return tags
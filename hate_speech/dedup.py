@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+MinHash/LSH near-duplicate detection over normalized posts
+
+    index = MinHashIndex()
+    groups = index.group(texts)          # group id per text, near-duplicates share it
+    keep = index.filter_new(texts)       # streaming: False for near-duplicates of a recent earlier text
+
+Shingles are word n-grams whose hashes come from prefix sums over the bytes of the whole
+batch, MinHash uses multiply-shift hashing, and the LSH bands turn candidate pairs into
+groups with scipy's connected components. No Python loop runs per word or shingle.
+filter_new remembers the band keys and signatures of the last max_seen texts it kept in a
+ring buffer, looked up with searchsorted over a sorted index, so its memory is bounded
+however long the stream is.
+
+    python -m hate_speech.dedup haspeede2_dev_taskAB.tsv
+"""
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+class MinHashIndex(object):
+  def __init__(self, num_perm=64, bands=16, threshold=0.7, shingle_size=2, seed=42, chunk_size=20000, max_seen=100000):
+    # max_seen: filter_new compares against the last max_seen kept texts (about 640 bytes each)
+    if num_perm % bands != 0:
+      raise ValueError('num_perm must be a multiple of bands')
+    rng = np.random.default_rng(seed)
+    self.num_perm = num_perm
+    self.bands = bands
+    self.threshold = threshold
+    self.shingle_size = shingle_size
+    self.chunk_size = chunk_size
+    # odd multipliers for multiply-shift hashing, for combining words into shingles and rows into band keys
+    self.a = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    self.b = rng.integers(0, 2 ** 63, num_perm, dtype=np.uint64)
+    self.word_mult = rng.integers(0, 2 ** 63, shingle_size, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    self.band_mult = rng.integers(0, 2 ** 63, num_perm // bands, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    # xor-ed into the band keys so that the keys of all bands can share one index
+    self.band_salt = rng.integers(0, 2 ** 63, bands, dtype=np.uint64)
+    self.max_seen = max_seen
+    self.reset()
+
+  def reset(self):
+    # streaming state for filter_new: ring buffers of the band keys and signatures of the last
+    # max_seen kept texts (the k-th kept text is in slot k % max_seen), a sorted index from
+    # band key to slot, and the unsorted entries added since the index was last rebuilt
+    self.seen_keys = np.zeros((self.max_seen, self.bands), dtype=np.uint64)
+    self.seen_signatures = np.zeros((self.max_seen, self.num_perm), dtype=np.uint64)
+    self.num_seen = 0
+    self.index = (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+    self.pending = (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+
+  def _word_hashes(self, texts):
+    # polynomial hash of every whitespace-separated word, computed from prefix sums over the
+    # whole batch; P is odd, so it is invertible modulo 2^64 and the hash does not depend on position
+    buffer = np.frombuffer(' '.join(texts).encode('utf-8'), dtype=np.uint8)
+    lengths = np.array([len(text.encode('utf-8')) + 1 for text in texts], dtype=np.int64)
+    text_starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+    is_space = buffer <= 32
+    is_word = ~is_space
+    word_starts = np.nonzero(is_word & np.concatenate([[True], is_space[:-1]]))[0]
+    word_ends = np.nonzero(is_word & np.concatenate([is_space[1:], [True]]))[0] + 1
+
+    p = np.uint64(0x100000001b3)
+    p_inv = np.uint64(pow(int(p), -1, 2 ** 64))
+    one, zero = np.ones(1, dtype=np.uint64), np.zeros(1, dtype=np.uint64)
+    powers = np.concatenate([one, np.cumprod(np.full(len(buffer), p, dtype=np.uint64))])
+    inverse_powers = np.concatenate([one, np.cumprod(np.full(len(buffer), p_inv, dtype=np.uint64))])
+    prefix = np.concatenate([zero, np.cumsum(buffer.astype(np.uint64) * inverse_powers[:-1])])
+
+    hashes = (prefix[word_ends] - prefix[word_starts]) * powers[word_starts]
+    text_ids = np.searchsorted(text_starts, word_starts, side='right') - 1
+    return hashes, text_ids
+
+  def _shingle_hashes(self, texts):
+    # hashes of consecutive word n-grams, with the offset of each text's first shingle;
+    # a text with fewer than n words gets one shingle of all its words (or of nothing)
+    n = self.shingle_size
+    word_hashes, text_ids = self._word_hashes(texts)
+    num_words = np.bincount(text_ids, minlength=len(texts))
+    first_word = np.concatenate([[0], np.cumsum(num_words)[:-1]])
+
+    num_shingles = max(len(word_hashes) - n + 1, 0)
+    shingles = np.zeros(num_shingles, dtype=np.uint64)
+    for j in range(n):
+      shingles += word_hashes[j:j + num_shingles] * self.word_mult[j]
+    valid = text_ids[:num_shingles] == text_ids[n - 1:n - 1 + num_shingles]
+
+    short = np.nonzero(num_words < n)[0]
+    short_shingles = np.zeros(len(short), dtype=np.uint64)
+    for j in range(n - 1):
+      has_word = num_words[short] > j
+      short_shingles[has_word] += word_hashes[first_word[short][has_word] + j] * self.word_mult[j]
+
+    owners = np.concatenate([text_ids[:num_shingles][valid], short])
+    hashes = np.concatenate([shingles[valid], short_shingles])
+    order = np.argsort(owners, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(owners, minlength=len(texts)))[:-1]])
+
+    # mix the bits before the multiply-shift permutations
+    hashes = hashes[order]
+    hashes ^= hashes >> np.uint64(31)
+    return hashes * np.uint64(0x9e3779b97f4a7c15), offsets
+
+  def signatures(self, texts):
+    texts = list(texts)
+    signatures = np.empty((len(texts), self.num_perm), dtype=np.uint64)
+
+    # bound the (shingles x num_perm) matrix by processing a chunk of texts at a time
+    for start in range(0, len(texts), self.chunk_size):
+      hashes, offsets = self._shingle_hashes(texts[start:start + self.chunk_size])
+      values = (hashes[:, None] * self.a[None, :] + self.b[None, :]) >> np.uint64(32)
+      signatures[start:start + len(offsets)] = np.minimum.reduceat(values, offsets, axis=0)
+
+    return signatures
+
+  def band_keys(self, signatures):
+    rows = self.num_perm // self.bands
+    return (signatures.reshape(len(signatures), self.bands, rows) * self.band_mult).sum(axis=2)
+
+  def group(self, texts):
+    signatures = self.signatures(texts)
+    keys = self.band_keys(signatures)
+    n = len(signatures)
+
+    # link every text to the first text sharing one of its band keys
+    sources, targets = [], []
+    for band in range(self.bands):
+      _, first, inverse = np.unique(keys[:, band], return_index=True, return_inverse=True)
+      linked = first[inverse.ravel()]
+      candidates = np.nonzero(linked != np.arange(n))[0]
+      sources.append(linked[candidates])
+      targets.append(candidates)
+    sources, targets = np.concatenate(sources), np.concatenate(targets)
+
+    # keep only candidate pairs whose estimated Jaccard similarity passes the threshold
+    similarity = (signatures[sources] == signatures[targets]).mean(axis=1)
+    sources, targets = sources[similarity >= self.threshold], targets[similarity >= self.threshold]
+
+    graph = coo_matrix((np.ones(len(sources), dtype=np.int8), (sources, targets)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    return labels
+
+  def _salted(self, keys):
+    # band keys flattened text by text, made distinct across bands
+    return (keys ^ self.band_salt).ravel()
+
+  def _rebuild_index(self):
+    # the index of the slots in the ring, dropping the entries of overwritten slots;
+    # newest slot first, so that np.unique keeps the most recent text for a shared key
+    filled = min(self.num_seen, self.max_seen)
+    slots = (self.num_seen - 1 - np.arange(filled)) % self.max_seen
+    keys, first = np.unique(self._salted(self.seen_keys[slots]), return_index=True)
+    self.index = (keys, np.repeat(slots, self.bands)[first])
+    self.pending = (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+
+  @staticmethod
+  def _merge(index, keys, slots):
+    # inserts newer entries into a sorted index, in front of the older entries with the same key
+    order = np.argsort(keys[::-1], kind='stable')
+    keys, slots = keys[::-1][order], slots[::-1][order]
+    position = np.searchsorted(index[0], keys)
+    return np.insert(index[0], position, keys), np.insert(index[1], position, slots)
+
+  @staticmethod
+  def _lookup(index, queries):
+    # slot of the newest entry for every query, -1 where it is missing
+    keys, slots = index
+    if len(keys) == 0:
+      return np.full(len(queries), -1, dtype=np.int64)
+    position = np.minimum(np.searchsorted(keys, queries), len(keys) - 1)
+    return np.where(keys[position] == queries, slots[position], -1)
+
+  def filter_new(self, texts):
+    # True for texts that are not near-duplicates of an earlier text of this call or of the
+    # last max_seen texts kept by previous calls
+    signatures = self.signatures(texts)
+    keys = self.band_keys(signatures)
+    n = len(signatures)
+    duplicate = np.zeros(n, dtype=bool)
+    if n == 0:
+      return ~duplicate
+
+    # candidates among the kept texts: the slot of each band key in the index and in the
+    # pending entries, valid while the slot still holds that key
+    queries = self._salted(keys)
+    text_ids = np.repeat(np.arange(n), self.bands)
+    bands = np.tile(np.arange(self.bands), n)
+    for slots in (self._lookup(self.index, queries), self._lookup(self.pending, queries)):
+      found = np.nonzero(slots >= 0)[0]
+      found = found[self.seen_keys[slots[found], bands[found]] == queries[found] ^ self.band_salt[bands[found]]]
+      similarity = (self.seen_signatures[slots[found]] == signatures[text_ids[found]]).mean(axis=1)
+      duplicate[text_ids[found[similarity >= self.threshold]]] = True
+
+    # candidates within the call: the first text sharing a band key
+    _, first, inverse = np.unique(queries, return_index=True, return_inverse=True)
+    linked = first[inverse.ravel()] // self.bands
+    found = np.nonzero(linked != text_ids)[0]
+    similarity = (signatures[linked[found]] == signatures[text_ids[found]]).mean(axis=1)
+    duplicate[text_ids[found[similarity >= self.threshold]]] = True
+
+    # remember the kept texts, overwriting the oldest slots once the ring is full
+    kept = np.nonzero(~duplicate)[0]
+    stored = kept[-self.max_seen:]
+    slots = (self.num_seen + len(kept) - len(stored) + np.arange(len(stored))) % self.max_seen
+    self.seen_keys[slots] = keys[stored]
+    self.seen_signatures[slots] = signatures[stored]
+    self.num_seen += len(kept)
+
+    # new entries go to the small pending index, which is merged into the main one once it
+    # is an eighth of its size; the main one is rebuilt when stale entries have doubled it
+    self.pending = self._merge(self.pending, self._salted(keys[stored]), np.repeat(slots, self.bands))
+    if len(self.pending[0]) > max(len(self.index[0]) // 8, 256 * self.bands):
+      self.index = self._merge(self.index, *self.pending)
+      self.pending = (np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64))
+      if len(self.index[0]) > 2 * self.max_seen * self.bands:
+        self._rebuild_index()
+
+    return ~duplicate
+
+def main():
+  import argparse
+  import time
+  import pandas as pd
+  from .inference import get_preprocess_tweet
+
+  parser = argparse.ArgumentParser(description='Group near-duplicate posts of a HaSpeeDe2-style TSV')
+  parser.add_argument('path')
+  parser.add_argument('--threshold', type=float, default=0.7)
+  parser.add_argument('--language', default='italian', help='stopword list used by the normalization')
+  args = parser.parse_args()
+
+  texts = pd.read_csv(args.path, sep='\t', names=['id', 'text'], usecols=[0, 1], header=0)['text'].astype(str)
+  texts = texts.apply(get_preprocess_tweet(args.language)).tolist()
+
+  start = time.perf_counter()
+  labels = MinHashIndex(threshold=args.threshold).group(texts)
+  elapsed = time.perf_counter() - start
+
+  sizes = np.bincount(labels)
+  print(f"{len(texts)} posts, {len(sizes)} groups, {int((sizes > 1).sum())} groups with near-duplicates covering {int(sizes[sizes > 1].sum())} posts")
+  print(f"{60 * len(texts) / elapsed:,.0f} posts/minute")
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+CPU data-parallel training over local processes (torch.distributed, gloo backend), experimental
+
+    from hate_speech.distributed import launch
+
+    def fit(train_dataloader, val_dataloader, dropout, lr, num_epochs):
+      # runs in every process with the same arguments; DDP copies rank 0's initial weights to the others
+      model = Model(dropout)
+      optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+      return train_model_distributed(model, torch.nn.BCEWithLogitsLoss(), optimizer, train_dataloader, val_dataloader, num_epochs)
+
+    train_losses, val_losses, reports, telemetry = launch(fit, 4, (train_dataloader, val_dataloader, 0.3, 1e-5, 20))
+
+Every rank trains on its own shard of each epoch (DistributedSampler, global batch size
+unchanged) and DistributedDataParallel averages the gradients with an all-reduce after
+backward. Validation is sharded too; the loss and the confusion counts are summed over the
+ranks before the report is built, so every rank gets the same val_loss and report, and
+therefore takes the same EarlyStopping decision. The torch threads of the machine are split
+between the ranks. fn must be importable (defined in a module, not in the notebook).
+
+Experimental, and not exposed by the hate-speech CLI: the speed-up has only been measured on
+a single-core machine, where extra processes can only add overhead (76, 61, 39 and 21
+examples/s with 1, 2, 4 and 8 processes). Whether it scales with more cores is untested;
+compare the examples/s of the telemetry records against a single-process train_model run
+before relying on it. tests/test_distributed.py checks that two ranks end with the same
+weights and report as each other and as single-process training.
+"""
+
+import os
+import pickle
+import sys
+import tempfile
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader, DistributedSampler, RandomSampler, Subset
+
+def is_distributed():
+  return dist.is_available() and dist.is_initialized()
+
+def rank():
+  return dist.get_rank() if is_distributed() else 0
+
+def all_reduce_sum(*values):
+  # sums of the given numbers over all ranks, as floats
+  tensor = torch.tensor(values, dtype=torch.float64)
+  dist.all_reduce(tensor)
+  return tensor.tolist()
+
+def shard(data_loader, train=True, seed=0):
+  # this rank's part of data_loader: a DistributedSampler with batch_size / world_size for training, so
+  # every rank has the same number of batches; a strided, unpadded slice of the examples for validation
+  world_size = dist.get_world_size()
+  if train:
+    sampler = DistributedSampler(data_loader.dataset, world_size, rank(), shuffle=isinstance(data_loader.sampler, RandomSampler), seed=seed)
+    return DataLoader(data_loader.dataset, sampler=sampler, batch_size=max(data_loader.batch_size // world_size, 1))
+  dataset = Subset(data_loader.dataset, range(rank(), len(data_loader.dataset), world_size))
+  return DataLoader(dataset, batch_size=data_loader.batch_size)
+
+def train_model_distributed(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs, seed=0, **kwargs):
+  # training.train_model on this rank's shards, with the model wrapped in DistributedDataParallel;
+  # kwargs go to train_model (profiler, telemetry_path, progress)
+  from torch.nn.parallel import DistributedDataParallel
+  from .training import train_model
+
+  # buffers (position ids) are constants, and broadcasting them would make every forward a
+  # collective, which validation shards of different lengths cannot take part in
+  ddp_model = DistributedDataParallel(model, broadcast_buffers=False)
+  return train_model(ddp_model, criterion, optimizer, shard(train_dataloader, True, seed), shard(val_dataloader, False),
+                     num_epochs, distributed=True, **kwargs)
+
+def _worker(rank, world_size, port, threads, fn, args, result_path):
+  os.environ['MASTER_ADDR'] = '127.0.0.1'
+  os.environ['MASTER_PORT'] = str(port)
+  torch.set_num_threads(threads)
+  dist.init_process_group('gloo', rank=rank, world_size=world_size)
+  if rank != 0:
+    # only rank 0 prints epochs, telemetry and progress bars
+    sys.stdout = open(os.devnull, 'w')
+    sys.stderr = open(os.devnull, 'w')
+  try:
+    result = fn(*args)
+    if rank == 0:
+      with open(result_path, 'wb') as f:
+        pickle.dump(result, f)
+  finally:
+    dist.destroy_process_group()
+
+def launch(fn, world_size, args=(), port=29500, threads=None):
+  # runs fn(*args) in world_size local processes and returns the result of rank 0;
+  # threads: torch threads per process (default: this process's threads split evenly)
+  if threads is None:
+    threads = max(torch.get_num_threads() // world_size, 1)
+  with tempfile.TemporaryDirectory() as directory:
+    result_path = os.path.join(directory, 'result.pkl')
+    mp.start_processes(_worker, (world_size, port, threads, fn, args, result_path), nprocs=world_size, join=True, start_method='spawn')
+    with open(result_path, 'rb') as f:
+      return pickle.load(f)
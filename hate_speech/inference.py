@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Batch inference for the HaSpeeDe2 Task A/B classifiers (hate speech and stereotype)
+
+    from hate_speech.inference import load_model, predict
+
+    model_hs = load_model("model_hs", dropout=0.3)       # a state dict, or a model_store directory
+    hs_prob = predict(texts, model_hs, batch_size=64)
+    news_prob = predict_long(articles, model_hs, aggregation='max')   # overlapping windows instead of truncation
+"""
+
+import json
+import os
+import re
+import numpy as np
+import torch
+
+MODEL_NAME = "dbmdz/bert-base-italian-uncased"
+MAX_LENGTH = 256
+
+def get_preprocess_tweet(language='italian', stopword_list=None):
+  # stopword_list: use these stopwords instead of nltk's list for language (no download)
+  if stopword_list is not None:
+    sw = set(stopword_list)
+  else:
+    # nltk is only imported when its stopwords are needed, it is slow to import
+    import nltk
+    from nltk.corpus import stopwords
+    try:
+      sw = set(stopwords.words(language))
+    except LookupError:
+      nltk.download('stopwords')
+      sw = set(stopwords.words(language))
+
+  def preprocess_tweet(tweet):
+    # convert to lowercase
+    tweet = tweet.lower()
+    # remove URLs
+    tweet = tweet.replace('url', '')
+    # remove mentions
+    tweet = re.sub(r'@\w+', '', tweet)
+    # remove non-alphanumeric characters
+    tweet = re.sub(r'[^\w\s]', ' ', tweet)
+    # remove duplicate whitespace and stopwords
+    tweet = ' '.join([word for word in tweet.split() if not word in sw])
+
+    return tweet
+
+  return preprocess_tweet
+
+def masked_mean(hidden_states, attention_mask):
+  # mean over the real tokens only, so a text's pooled vector does not depend on how far its batch is padded
+  mask = attention_mask.unsqueeze(-1).type_as(hidden_states)
+  return (hidden_states * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+
+class Model(torch.nn.Module):
+  # pooling: 'pooler' as the Italian and German models, 'mean' of the last hidden state (real tokens only) as the Spanish DistilBERT
+  def __init__(self, dropout, model_name=MODEL_NAME, pooling='pooler'):
+    # transformers is imported where it is used, importing this module stays cheap
+    from transformers import AutoModel
+
+    super(Model, self).__init__()
+    self.pooling = pooling
+    self.bert = AutoModel.from_pretrained(model_name)
+    for param in self.bert.parameters():
+        param.requires_grad = True
+    self.dropout = torch.nn.Dropout(dropout)
+    self.linear = torch.nn.Linear(self.bert.config.hidden_size, 1)
+
+  def forward(self, input_ids, attention_mask):
+    outputs = self.bert(input_ids=input_ids, attention_mask=attention_mask)
+    if self.pooling == 'mean':
+      pooled_output = masked_mean(outputs.last_hidden_state, attention_mask)
+    else:
+      pooled_output = outputs.pooler_output
+    pooled_output = self.dropout(pooled_output)
+    logits = self.linear(pooled_output)
+    return logits
+
+def save_threshold(path, threshold):
+  # decision threshold on the positive class probability, next to the state dict saved at path
+  with open(f'{path}.threshold.json', 'w') as f:
+    json.dump({'threshold': threshold}, f)
+
+def load_threshold(path, default=0.5):
+  if not os.path.exists(f'{path}.threshold.json'):
+    return default
+  with open(f'{path}.threshold.json') as f:
+    return json.load(f)['threshold']
+
+def load_model(path, dropout, model_name=MODEL_NAME, device='cpu', pooling='pooler'):
+  # path: a state dict saved with torch.save, or a model_store directory (dropout, model_name and pooling are then read from it)
+  if os.path.isdir(path):
+    from .model_store import load_store
+    return load_store(path, device, tokenizer=False)[0]
+
+  model = Model(dropout, model_name, pooling)
+  model.load_state_dict(torch.load(path, map_location='cpu'))
+  model.threshold = load_threshold(path)
+  return model.to(device).eval()
+
+def encode(texts, tokenizer, preprocess, max_length=MAX_LENGTH):
+  # normalized and tokenized, but not padded: padding happens per batch in predict_encoded
+  texts = [preprocess(text) for text in texts]
+  return tokenizer(texts, max_length=max_length, truncation=True)['input_ids']
+
+def predict_encoded(input_ids, model, tokenizer, batch_size=64, logits=False):
+  # logits: return the raw logits instead of the probabilities
+  models = model if isinstance(model, dict) else {None: model}
+
+  # sort by length so that each batch is padded only to its own longest text
+  order = np.argsort([len(ids) for ids in input_ids], kind='stable')
+  probs = {name: np.empty(len(input_ids), dtype=np.float32) for name in models}
+
+  for m in models.values():
+    m.eval()
+
+  with torch.inference_mode():
+    for start in range(0, len(order), batch_size):
+      idx = order[start:start + batch_size]
+      batch = tokenizer.pad({'input_ids': [input_ids[i] for i in idx]}, return_tensors='pt')
+
+      for name, m in models.items():
+        device = next(m.parameters()).device
+        outputs = m(batch['input_ids'].to(device), batch['attention_mask'].to(device)).float()
+        probs[name][idx] = (outputs if logits else torch.sigmoid(outputs)).squeeze(-1).cpu().numpy()
+
+  return probs if isinstance(model, dict) else probs[None]
+
+def predict(texts, model, batch_size=64, tokenizer=None, preprocess=None, max_length=MAX_LENGTH, cache=None):
+  # model: a single Model, or a dict of Models sharing the tokenizer (e.g. {'hs': ..., 'stereotype': ...})
+  # cache: optional PredictionCache, only texts that miss it go through the encoder
+  # returns the positive class probability of every text, in input order
+  if tokenizer is None:
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+  if preprocess is None:
+    preprocess = get_preprocess_tweet()
+
+  if cache is None:
+    input_ids = encode(texts, tokenizer, preprocess, max_length)
+    return predict_encoded(input_ids, model, tokenizer, batch_size)
+
+  models = model if isinstance(model, dict) else {'prob': model}
+  texts = [preprocess(text) for text in texts]
+  values = cache.get_many(texts)
+
+  # identical normalized texts in the same call are computed once
+  misses = list(dict.fromkeys(text for text, value in zip(texts, values) if value is None))
+  if misses:
+    input_ids = tokenizer(misses, max_length=max_length, truncation=True)['input_ids']
+    probs = predict_encoded(input_ids, models, tokenizer, batch_size)
+    computed = [{name: float(probs[name][i]) for name in models} for i in range(len(misses))]
+    cache.put_many(misses, computed)
+
+    computed = dict(zip(misses, computed))
+    values = [computed[text] if value is None else value for text, value in zip(texts, values)]
+
+  probs = {name: np.array([value[name] for value in values], dtype=np.float32) for name in models}
+  return probs if isinstance(model, dict) else probs['prob']
+
+def split_windows(input_ids, tokenizer, window=MAX_LENGTH, stride=MAX_LENGTH // 2):
+  # overlapping windows of at most `window` tokens (special tokens included) over ids tokenized
+  # without special tokens; the last window of a text always ends at its last token
+  size = window - 2
+  windows, owners = [], []
+  for i, ids in enumerate(input_ids):
+    starts = list(range(0, max(len(ids) - size, 0) + 1, stride))
+    if starts[-1] + size < len(ids):
+      starts.append(len(ids) - size)
+    windows.extend([tokenizer.cls_token_id] + ids[start:start + size] + [tokenizer.sep_token_id] for start in starts)
+    owners.extend([i] * len(starts))
+  return windows, np.array(owners, dtype=np.int64)
+
+def aggregate_windows(logits, owners, num_texts, aggregation='max'):
+  # one logit per text from the logits of its windows; owners is sorted and every text has a window
+  # 'attention' weights each window by the softmax of its own logit, between mean and max
+  offsets = np.concatenate([[0], np.cumsum(np.bincount(owners, minlength=num_texts))[:-1]])
+  if aggregation == 'max':
+    return np.maximum.reduceat(logits, offsets)
+  if aggregation == 'mean':
+    return np.add.reduceat(logits, offsets) / np.bincount(owners, minlength=num_texts)
+  if aggregation == 'attention':
+    weights = np.exp(logits - np.maximum.reduceat(logits, offsets)[owners])
+    return np.add.reduceat(weights * logits, offsets) / np.add.reduceat(weights, offsets)
+  raise ValueError(f'unknown aggregation {aggregation}')
+
+def predict_long(texts, model, batch_size=64, tokenizer=None, preprocess=None, window=MAX_LENGTH, stride=MAX_LENGTH // 2, aggregation='max'):
+  # positive class probability of texts of any length: the windows of all texts are sorted by
+  # length and batched together, then the window logits of each text are aggregated
+  if tokenizer is None:
+    from transformers import AutoTokenizer
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+  if preprocess is None:
+    preprocess = get_preprocess_tweet()
+
+  texts = [preprocess(text) for text in texts]
+  input_ids = tokenizer(texts, add_special_tokens=False)['input_ids']
+  windows, owners = split_windows(input_ids, tokenizer, window, stride)
+  logits = predict_encoded(windows, model, tokenizer, batch_size, logits=True)
+  return 1 / (1 + np.exp(-aggregate_windows(logits, owners, len(texts), aggregation)))
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Character n-gram language identification in front of the per-language models
+
+    python -m hate_speech.langid train --output langid.npz      # from the corpora downloaded by the notebook
+    lid = LanguageIdentifier.load('langid.npz')
+    languages = lid.predict(texts)                   # 'it', 'es', 'de' or 'unknown'
+    probs = route(texts, lid, router)                # router: a router.ModelRouter
+
+A multinomial Naive Bayes over hashed byte 1-3 grams. All the n-grams of a batch are hashed
+at once with rolling NumPy hashes, and each order is scored as one sparse (texts x buckets)
+by (buckets x languages) product, so no Python code runs per n-gram. Posts whose two best
+languages are too close, or that have no letters, go to 'unknown'.
+"""
+
+import argparse
+import numpy as np
+from scipy.sparse import csr_matrix
+
+UNKNOWN = 'unknown'
+
+# the training texts of each language, as downloaded and read by the notebook
+CORPORA = {
+  'it': ('/content/haspeede2_dev/haspeede2_dev_taskAB.tsv', '\t', 1),
+  'es': ('/content/haspeede_spanish/hateval2019_es_train.csv', ',', 1),
+  'de': ('/content/IWG_hatespeech_public/german hatespeech refugees.csv', ',', 0),
+}
+
+class LanguageIdentifier(object):
+  def __init__(self, languages=('it', 'es', 'de'), num_buckets=2 ** 16, max_n=3, min_margin=0.05, log_probs=None):
+    self.languages = list(languages)
+    self.num_buckets = num_buckets
+    self.max_n = max_n
+    # num_buckets must be a power of two; min_margin is the minimum difference, per n-gram, between the log-likelihoods of the two best languages
+    self.min_margin = min_margin
+    self.log_probs = log_probs
+
+  def _ngram_buckets(self, texts):
+    # bucket of every byte n-gram (1 <= n <= max_n) of the space-padded lowercase texts; the buffer
+    # is padded so that each order has one n-gram per byte, starting at the same offsets, and the
+    # weights are 0 for the last n - 1 n-grams of every text, which run into the next one
+    data = [f' {text.lower()} '.encode('utf-8') for text in texts]
+    lengths = np.array([len(d) for d in data], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+    buffer = np.frombuffer(b''.join(data) + b' ' * (self.max_n - 1), dtype=np.uint8).astype(np.uint32)
+    size = len(buffer) - self.max_n + 1
+    ends = offsets + lengths
+
+    buckets, weights, hashes = [], [], np.zeros(len(buffer), dtype=np.uint32)
+    order_weights = np.ones(size, dtype=np.float32)
+    shift = np.uint32(32 - int(np.log2(self.num_buckets)))
+    for n in range(1, self.max_n + 1):
+      # rolling polynomial hash of the n-gram starting at every byte, then multiplicative hashing into buckets
+      hashes = hashes[:len(buffer) - n + 1] * np.uint32(257) + buffer[n - 1:]
+      buckets.append(((hashes[:size] + np.uint32(n)) * np.uint32(0x9e3779b1)) >> shift)
+      if n > 1:
+        # the n-gram starting n - 1 bytes before the end is the first one to run out of its text
+        order_weights = order_weights.copy()
+        order_weights[np.maximum(ends - n + 1, offsets)] = 0
+      weights.append(order_weights)
+
+    num_ngrams = sum(np.maximum(lengths - n + 1, 0) for n in range(1, self.max_n + 1))
+    letters = (buffer[:size] >= 97) & (buffer[:size] <= 122) | (buffer[:size] >= 128)
+    return buckets, weights, offsets, num_ngrams, np.add.reduceat(letters, offsets) > 0
+
+  def fit(self, texts_by_language):
+    counts = np.ones((len(self.languages), self.num_buckets))
+    for i, language in enumerate(self.languages):
+      buckets, weights, _, _, _ = self._ngram_buckets(list(texts_by_language[language]))
+      for order_buckets, order_weights in zip(buckets, weights):
+        counts[i] += np.bincount(order_buckets, order_weights, minlength=self.num_buckets)
+    self.log_probs = np.log(counts / counts.sum(axis=1, keepdims=True)).T.astype(np.float32)
+    return self
+
+  def _scores(self, texts):
+    buckets, weights, offsets, num_ngrams, has_letters = self._ngram_buckets(texts)
+    # the n-grams of text i are the rows offsets[i]:offsets[i + 1] of each order, i.e. row i of a
+    # CSR matrix of n-gram counts; summing them through a sparse product avoids gathering a
+    # (n-grams x languages) array of log-probabilities first
+    indptr = np.append(offsets, len(buckets[0]))
+    totals = sum(csr_matrix((order_weights, order_buckets, indptr), shape=(len(texts), self.num_buckets)) @ self.log_probs
+                 for order_buckets, order_weights in zip(buckets, weights))
+    return totals / num_ngrams[:, None], has_letters
+
+  def scores(self, texts):
+    # average log-likelihood per n-gram of every language, (texts, languages)
+    return self._scores(list(texts))[0]
+
+  def predict(self, texts):
+    texts = list(texts)
+    if not texts:
+      return np.array([], dtype=object)
+    scores, has_letters = self._scores(texts)
+    top2 = np.sort(scores, axis=1)[:, -2:]
+    languages = np.array(self.languages, dtype=object)[scores.argmax(axis=1)]
+    languages[(top2[:, 1] - top2[:, 0] < self.min_margin) | ~has_letters] = UNKNOWN
+    return languages
+
+  def save(self, path):
+    np.savez_compressed(path, languages=np.array(self.languages), num_buckets=self.num_buckets, max_n=self.max_n,
+                        min_margin=self.min_margin, log_probs=self.log_probs)
+
+  @classmethod
+  def load(cls, path):
+    data = np.load(path)
+    return cls([str(l) for l in data['languages']], int(data['num_buckets']), int(data['max_n']),
+               float(data['min_margin']), data['log_probs'])
+
+def route(texts, identifier, router):
+  # per-language probabilities from the matching Model/tokenizer pair, NaN for 'unknown'
+  texts = list(texts)
+  return router.predict(texts, identifier.predict(texts))
+
+def read_corpus(path, sep, column):
+  import pandas as pd
+  return pd.read_csv(path, sep=sep, usecols=[column], header=0).iloc[:, 0].astype(str).tolist()
+
+def main():
+  import time
+
+  parser = argparse.ArgumentParser(description='Train or run the character n-gram language identifier')
+  subparsers = parser.add_subparsers(dest='command', required=True)
+  train_parser = subparsers.add_parser('train', help='train on the Italian, Spanish and German corpora')
+  train_parser.add_argument('--output', default='langid.npz')
+  for language, (path, _, _) in CORPORA.items():
+    train_parser.add_argument(f'--{language}', default=path, help=f'{language} corpus')
+  predict_parser = subparsers.add_parser('predict', help='print the language of every line of stdin')
+  predict_parser.add_argument('--model', default='langid.npz')
+  args = parser.parse_args()
+
+  if args.command == 'train':
+    texts = {language: read_corpus(getattr(args, language), sep, column) for language, (_, sep, column) in CORPORA.items()}
+    identifier = LanguageIdentifier(list(texts)).fit(texts)
+    identifier.save(args.output)
+
+    # throughput on the training texts themselves
+    all_texts = [text for language_texts in texts.values() for text in language_texts]
+    start = time.perf_counter()
+    languages = identifier.predict(all_texts)
+    elapsed = time.perf_counter() - start
+    expected = np.concatenate([[language] * len(language_texts) for language, language_texts in texts.items()])
+    print(f"training accuracy {(languages == expected).mean():.3f}, unknown {(languages == UNKNOWN).mean():.3f}, {len(all_texts) / elapsed:,.0f} posts/s")
+  else:
+    import sys
+    identifier = LanguageIdentifier.load(args.model)
+    lines = [line.rstrip('\n') for line in sys.stdin]
+    for language in identifier.predict(lines):
+      print(language)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming classification metrics accumulated on the model's device
+
+    report = StreamingReport(labels=[0, 1])
+    for batch in data_loader:
+      report.update(preds, labels)                          # any shape, any device
+    report.report()                                         # same dict as classification_report(..., output_dict=True)
+
+    StreamingReport(labels=[1, 2], num_classes=4, ignore_index=label_map['PAD'])   # Task C tokens
+
+Only a (num_classes x num_classes) confusion matrix is kept, updated with one bincount per
+batch and moved to the CPU once at the end, so evaluation memory does not grow with the
+number of examples or their length and no batch forces a device synchronization.
+
+    threshold, sweep = best_threshold(val_logits, val_labels)   # macro-F1 of every distinct threshold in one pass
+    report, per_sentence = span_report(true_tags, pred_tags, lengths)   # Task C spans, exact and partial match
+"""
+
+import numpy as np
+import torch
+
+class StreamingReport(object):
+  def __init__(self, labels, num_classes=None, ignore_index=None):
+    # labels: the classes reported, as in classification_report; targets equal to ignore_index are skipped
+    self.labels = list(labels)
+    self.num_classes = num_classes or max(self.labels) + 1
+    self.ignore_index = ignore_index
+    self.confusion = None
+
+  def reset(self):
+    self.confusion = None
+
+  def update(self, predictions, targets):
+    predictions = predictions.reshape(-1).long()
+    targets = targets.reshape(-1).long().to(predictions.device)
+    n = self.num_classes
+    if self.confusion is None:
+      self.confusion = torch.zeros(n * n, dtype=torch.long, device=predictions.device)
+
+    # cell (target, prediction) of every element; ignored elements go to an extra bin that is dropped
+    cells = targets * n + predictions
+    if self.ignore_index is not None:
+      cells = torch.where(targets == self.ignore_index, torch.full_like(cells, n * n), cells)
+    self.confusion += torch.bincount(cells, minlength=n * n + 1)[:n * n]
+
+  def all_reduce(self):
+    # sum the counts of all torch.distributed ranks, e.g. after each one evaluated its own shard
+    if self.confusion is None:
+      self.confusion = torch.zeros(self.num_classes ** 2, dtype=torch.long)
+    torch.distributed.all_reduce(self.confusion)
+
+  def confusion_matrix(self):
+    n = self.num_classes
+    if self.confusion is None:
+      return np.zeros((n, n), dtype=np.int64)
+    return self.confusion.view(n, n).cpu().numpy()
+
+  def report(self):
+    confusion = self.confusion_matrix()
+    labels = np.array(self.labels)
+    true_positives = np.diag(confusion)[labels].astype(np.float64)
+    predicted = confusion[:, labels].sum(axis=0).astype(np.float64)
+    support = confusion[labels, :].sum(axis=1)
+
+    # zero_division=0, as in the notebook's classification_report calls
+    divide = lambda a, b: np.divide(a, b, out=np.zeros_like(a, dtype=np.float64), where=b > 0)
+    precision = divide(true_positives, predicted)
+    recall = divide(true_positives, support.astype(np.float64))
+    f1 = divide(2 * true_positives, predicted + support)
+
+    report = {}
+    for i, label in enumerate(self.labels):
+      report[str(label)] = {'precision': float(precision[i]), 'recall': float(recall[i]), 'f1-score': float(f1[i]), 'support': float(support[i])}
+
+    # accuracy when the reported labels cover every class seen, micro average otherwise
+    seen = np.nonzero(confusion.sum(axis=0) + confusion.sum(axis=1))[0]
+    if set(seen) <= set(self.labels):
+      report['accuracy'] = float(true_positives.sum() / max(confusion.sum(), 1))
+    else:
+      tp, p, s = true_positives.sum(), predicted.sum(), float(support.sum())
+      report['micro avg'] = {'precision': float(tp / p) if p else 0.0, 'recall': float(tp / s) if s else 0.0,
+                             'f1-score': float(2 * tp / (p + s)) if p + s else 0.0, 'support': s}
+
+    total = float(support.sum())
+    report['macro avg'] = {'precision': float(precision.mean()), 'recall': float(recall.mean()), 'f1-score': float(f1.mean()), 'support': total}
+    weights = support / total if total else np.zeros(len(support))
+    report['weighted avg'] = {'precision': float(precision @ weights), 'recall': float(recall @ weights), 'f1-score': float(f1 @ weights), 'support': total}
+    return report
+
+def threshold_sweep(logits, labels):
+  # precision, recall and F1 of both classes and their macro average for every distinct
+  # decision threshold on sigmoid(logits), from one sort and cumulative sums over the examples
+  logits = np.asarray(torch.as_tensor(logits).float().reshape(-1).cpu(), dtype=np.float64)
+  labels = np.asarray(torch.as_tensor(labels).reshape(-1).cpu()).astype(bool)
+  order = np.argsort(-logits, kind='stable')
+  logits, labels = logits[order], labels[order]
+  n, positives = len(labels), int(labels.sum())
+
+  # cut k predicts the k highest logits positive; only cuts between distinct values are reachable
+  distinct = np.nonzero(np.diff(logits) < 0)[0] + 1
+  cuts = np.concatenate([[0], distinct, [n]])
+  bounds = np.concatenate([[np.inf], logits, [-np.inf]])
+  thresholds = 1 / (1 + np.exp(-(bounds[cuts] + bounds[cuts + 1]) / 2))
+
+  true_positives = np.concatenate([[0], np.cumsum(labels)])[cuts].astype(np.float64)
+  true_negatives = (n - positives) - (cuts - true_positives)
+  divide = lambda a, b: np.divide(a, b, out=np.zeros_like(a), where=b > 0)
+
+  sweep = {'threshold': thresholds}
+  for name, tp, predicted, support in [('1', true_positives, cuts.astype(np.float64), positives),
+                                       ('0', true_negatives, (n - cuts).astype(np.float64), n - positives)]:
+    sweep[f'precision_{name}'] = divide(tp, predicted)
+    sweep[f'recall_{name}'] = divide(tp, np.full_like(tp, support))
+    sweep[f'f1_{name}'] = divide(2 * tp, predicted + support)
+  sweep['macro_f1'] = (sweep['f1_0'] + sweep['f1_1']) / 2
+  return sweep
+
+def best_threshold(logits, labels):
+  # the threshold on the positive class probability with the highest macro-F1, and the whole sweep
+  sweep = threshold_sweep(logits, labels)
+  return float(sweep['threshold'][np.argmax(sweep['macro_f1'])]), sweep
+
+def iob_spans(tags, lengths, begin=1, inside=2):
+  # [start, end) of every span in the concatenated tags of all sentences; a span starts at B,
+  # or at an I that does not continue a span, and goes on over the following I tags
+  tags, lengths = np.asarray(tags), np.asarray(lengths)
+  sentence_start = np.zeros(len(tags), dtype=bool)
+  sentence_start[np.cumsum(lengths)[:-1][lengths[1:] > 0]] = True
+  if len(tags):
+    sentence_start[0] = True
+
+  in_span = (tags == begin) | (tags == inside)
+  continues = (tags == inside) & np.concatenate([[False], in_span[:-1]]) & ~sentence_start
+  starts = np.nonzero(in_span & ~continues)[0]
+  ends = np.nonzero(in_span & ~np.concatenate([continues[1:], [False]]))[0] + 1
+  return starts, ends
+
+def span_report(true_tags, pred_tags, lengths, begin=1, inside=2):
+  # exact and partial (at least one shared token) span precision/recall/F1, overall and per sentence;
+  # true_tags and pred_tags hold the real tokens of all sentences back to back, lengths their number
+  true_tags, pred_tags, lengths = np.asarray(true_tags), np.asarray(pred_tags), np.asarray(lengths)
+  sentence = np.repeat(np.arange(len(lengths)), lengths)
+  true_starts, true_ends = iob_spans(true_tags, lengths, begin, inside)
+  pred_starts, pred_ends = iob_spans(pred_tags, lengths, begin, inside)
+
+  # exact: a true span starts where the predicted one does and ends with it; positions are
+  # global, so the sentence matches too
+  size = len(true_tags) + 1
+  true_end_at = np.full(size, -1)
+  true_end_at[true_starts] = true_ends
+  exact = true_end_at[pred_starts] == pred_ends
+
+  # partial: the span covers at least one token of a span of the other side
+  def overlaps(starts, ends, other_starts, other_ends):
+    depth = np.cumsum(np.bincount(other_starts, minlength=size) - np.bincount(other_ends, minlength=size))
+    covered = np.concatenate([[0], np.cumsum(depth[:-1] > 0)])
+    return covered[ends] - covered[starts] > 0
+  partial_pred = overlaps(pred_starts, pred_ends, true_starts, true_ends)
+  partial_true = overlaps(true_starts, true_ends, pred_starts, pred_ends)
+
+  count = lambda starts, weights=None: np.bincount(sentence[starts], weights=weights, minlength=len(lengths))
+  num_true, num_pred = count(true_starts), count(pred_starts)
+  matches = {'exact': (count(pred_starts, exact), count(pred_starts, exact)),
+             'partial': (count(pred_starts, partial_pred), count(true_starts, partial_true))}
+
+  report, per_sentence = {}, {'true_spans': num_true, 'pred_spans': num_pred}
+  for name, (pred_matched, true_matched) in matches.items():
+    precision = pred_matched.sum() / num_pred.sum() if num_pred.sum() else 0.0
+    recall = true_matched.sum() / num_true.sum() if num_true.sum() else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    report[name] = {'precision': float(precision), 'recall': float(recall), 'f1-score': float(f1), 'support': float(num_true.sum())}
+
+    # per sentence, NaN where there is nothing to divide by
+    with np.errstate(divide='ignore', invalid='ignore'):
+      precision = pred_matched / num_pred
+      recall = true_matched / num_true
+      f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+    per_sentence[f'{name}_precision'] = precision
+    per_sentence[f'{name}_recall'] = recall
+    per_sentence[f'{name}_f1'] = np.where(np.isnan(precision) | np.isnan(recall), np.nan, f1)
+
+  return report, per_sentence
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Self-contained model directories for the Task A/B classifiers, loaded offline from safetensors
+
+    from hate_speech.model_store import save_store, load_store
+
+    save_store(best_model, "model_hs", tokenizer, threshold=threshold)
+    model, tokenizer = load_store("model_hs")        # no download, no pretrained base
+    load_model("model_hs", dropout=0.3)               # inference.load_model accepts a store directory too
+
+A store holds the fine-tuned encoder as a transformers checkpoint (config.json and
+model.safetensors), the classification head in head.safetensors, the tokenizer files and
+store.json (dropout, pooling, decision threshold). Loading builds the encoder straight from
+the memory-mapped fine-tuned weights, instead of loading the pretrained base and then
+overwriting it with a torch.load'ed state dict, and never touches the network.
+"""
+
+import json
+import os
+import torch
+from safetensors.torch import load_file, save_file
+
+HEAD_FILE = 'head.safetensors'
+STORE_FILE = 'store.json'
+
+def is_store(path):
+  return os.path.isfile(os.path.join(path, STORE_FILE))
+
+def save_store(model, directory, tokenizer=None, threshold=None):
+  # model: an inference.Model or the notebook's Model (bert encoder + linear head)
+  os.makedirs(directory, exist_ok=True)
+  model.bert.save_pretrained(directory, safe_serialization=True)
+  head = {name: tensor.detach().cpu().contiguous() for name, tensor in model.state_dict().items() if not name.startswith('bert.')}
+  save_file(head, os.path.join(directory, HEAD_FILE))
+  if tokenizer is not None:
+    tokenizer.save_pretrained(directory)
+
+  if threshold is None:
+    threshold = getattr(model, 'threshold', 0.5)
+  with open(os.path.join(directory, STORE_FILE), 'w') as f:
+    json.dump({'dropout': model.dropout.p, 'pooling': getattr(model, 'pooling', 'pooler'), 'threshold': threshold}, f, indent=2)
+
+def load_store(directory, device='cpu', tokenizer=True):
+  # the model in eval mode with its threshold, and the stored tokenizer (None if tokenizer=False)
+  from transformers import AutoTokenizer
+  from .inference import Model
+
+  if not is_store(directory):
+    raise ValueError(f'{directory} is not a model store (no {STORE_FILE})')
+  with open(os.path.join(directory, STORE_FILE)) as f:
+    spec = json.load(f)
+
+  model = Model(spec['dropout'], directory, spec['pooling'])
+  missing, unexpected = model.load_state_dict(load_file(os.path.join(directory, HEAD_FILE)), strict=False)
+  missing = [name for name in missing if not name.startswith('bert.')]
+  if missing or unexpected:
+    raise ValueError(f'head of {directory} does not match the model: missing {missing}, unexpected {unexpected}')
+  model.threshold = spec['threshold']
+  model = model.to(device).eval()
+
+  if not tokenizer:
+    return model, None
+  return model, AutoTokenizer.from_pretrained(directory, local_files_only=True)
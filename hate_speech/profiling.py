@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in per-stage timings and PyTorch profiler traces for the training loops
+
+    profiler = StageProfiler(device, trace_dir='traces', active=5)
+    train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs, profiler=profiler)
+    profiler.summaries[0]        # per-stage timings of the first epoch
+    # traces/epoch_1.json: Chrome trace (chrome://tracing or https://ui.perfetto.dev) of a window of steps
+
+Inside train_fn/val_fn every stage runs under `with profiler('forward'):` and batches come
+from `profiler.iterate(data_loader)`, so data loading, host-to-device copy, forward, loss,
+backward and optimizer step are timed separately and appear as named ranges in the trace.
+On CUDA each stage synchronizes the device so that its time is not charged to the next one,
+which is why profiling is opt-in: NULL_PROFILER, the default, does nothing.
+"""
+
+import contextlib
+import os
+import time
+from collections import defaultdict
+import torch
+
+class NullProfiler(object):
+  def __call__(self, stage):
+    return contextlib.nullcontext()
+
+  def iterate(self, iterable, stage='data'):
+    return iterable
+
+  def step(self):
+    pass
+
+  def start_epoch(self, epoch):
+    pass
+
+  def end_epoch(self):
+    return None
+
+NULL_PROFILER = NullProfiler()
+
+class StageProfiler(object):
+  def __init__(self, device=None, trace_dir=None, wait=1, warmup=1, active=5, top_operators=10):
+    # trace_dir: when set, every epoch wraps steps wait+warmup .. wait+warmup+active in the PyTorch
+    # profiler, exports them as trace_dir/epoch_N.json and summarizes the top operators
+    self.synchronize = device is not None and torch.device(device).type == 'cuda'
+    self.trace_dir = trace_dir
+    self.schedule = torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1)
+    self.top_operators = top_operators
+    self.times = defaultdict(float)
+    self.calls = defaultdict(int)
+    self.profiler = None
+    self.epoch = 0
+    self.summaries = []
+    if trace_dir:
+      os.makedirs(trace_dir, exist_ok=True)
+
+  @contextlib.contextmanager
+  def __call__(self, stage):
+    if self.synchronize:
+      torch.cuda.synchronize()
+    start = time.perf_counter()
+    with torch.profiler.record_function(stage):
+      yield
+      if self.synchronize:
+        torch.cuda.synchronize()
+    self.times[stage] += time.perf_counter() - start
+    self.calls[stage] += 1
+
+  def iterate(self, iterable, stage='data'):
+    # times fetching every batch, e.g. DataLoader collation and worker waits
+    iterator = iter(iterable)
+    while True:
+      with self(stage):
+        try:
+          batch = next(iterator)
+        except StopIteration:
+          return
+      yield batch
+
+  def step(self):
+    # end of a training step, advances the profiler schedule
+    if self.profiler is not None:
+      self.profiler.step()
+
+  def start_epoch(self, epoch):
+    self.epoch = epoch
+    self.times.clear()
+    self.calls.clear()
+    self.start = time.perf_counter()
+    if self.trace_dir:
+      path = os.path.join(self.trace_dir, f'epoch_{epoch}.json')
+      self.profiler = torch.profiler.profile(
+        activities=[torch.profiler.ProfilerActivity.CPU] + ([torch.profiler.ProfilerActivity.CUDA] if self.synchronize else []),
+        schedule=self.schedule, on_trace_ready=lambda profiler: profiler.export_chrome_trace(path), record_shapes=True)
+      self.profiler.start()
+
+  def end_epoch(self):
+    elapsed = time.perf_counter() - self.start
+    summary = {'epoch': self.epoch, 'seconds': elapsed, 'stages': {}}
+    for stage, seconds in sorted(self.times.items(), key=lambda item: -item[1]):
+      summary['stages'][stage] = {'seconds': seconds, 'calls': self.calls[stage],
+                                  'mean_ms': 1000 * seconds / self.calls[stage], 'share': seconds / elapsed}
+
+    if self.profiler is not None:
+      self.profiler.stop()
+      sort_by = 'self_cuda_time_total' if self.synchronize else 'self_cpu_time_total'
+      summary['top_operators'] = self.profiler.key_averages().table(sort_by=sort_by, row_limit=self.top_operators)
+      self.profiler = None
+
+    self.summaries.append(summary)
+    return summary
+
+def format_summary(summary):
+  lines = [f"Epoch {summary['epoch']}: {summary['seconds']:.1f}s"]
+  for stage, timing in summary['stages'].items():
+    lines.append(f"  {stage:>16}: {timing['seconds']:8.2f}s {timing['share'] * 100:5.1f}%  {timing['mean_ms']:8.2f} ms x {timing['calls']}")
+  if 'top_operators' in summary:
+    lines.append(summary['top_operators'])
+  return '\n'.join(lines)
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Attention-head and layer pruning of the BERT Task A/B classifiers
+
+    from hate_speech.pruning import compute_head_importance, select_heads_to_prune, prune_model
+
+    head_importance, layer_importance = compute_head_importance(val_dataloader, model, criterion)
+    heads_to_prune, layers_to_drop = select_heads_to_prune(head_importance, layer_importance, 0.4, num_layers_to_drop=2)
+    model = prune_model(model, heads_to_prune, layers_to_drop)
+    save_pruned_model(model, "model_hs_pruned")
+    model = load_pruned_model(Model(dropout), "model_hs_pruned")
+
+Nothing here relies on the head_mask argument or on PreTrainedModel.prune_heads, which
+transformers 5 removed: a head's importance is the gradient of the loss w.r.t. a gate that
+multiplies its context vectors (the same gradient head_mask gave, since the context is linear
+in the attention probabilities), and a head is pruned by slicing its rows out of the
+query/key/value projections and its columns out of the attention output projection.
+Pruned layers have different numbers of heads, so a pruned model is saved with its pruning
+spec and rebuilt from a fresh Model, not with save_pretrained.
+"""
+
+import torch
+
+def head_gates(model, gates):
+  # forward hooks multiplying the context vectors of head h of layer i by gates[i, h]
+  def hook(gate):
+    def scale(module, inputs, outputs):
+      context = outputs[0]
+      heads = context.view(*context.shape[:-1], len(gate), -1) * gate[:, None]
+      return (heads.view(context.shape),) + tuple(outputs[1:])
+    return scale
+  return [layer.attention.self.register_forward_hook(hook(gate)) for layer, gate in zip(model.bert.encoder.layer, gates)]
+
+def compute_head_importance(data_loader, model, criterion, progress=True):
+  # accumulated |gradient of the loss| w.r.t. a (num_layers, num_heads) gate on every attention head
+  device = next(model.parameters()).device
+  model.eval()
+  config = model.bert.config
+  gates = torch.ones(config.num_hidden_layers, config.num_attention_heads, device=device, requires_grad=True)
+  head_importance = torch.zeros(config.num_hidden_layers, config.num_attention_heads, device=device)
+
+  if progress:
+    from tqdm import tqdm
+    data_loader = tqdm(data_loader)
+
+  hooks = head_gates(model, gates)
+  try:
+    for batch in data_loader:
+      ids, mask, labels = batch
+      outputs = model(ids.to(device), mask.to(device))
+      loss = criterion(outputs.cpu(), labels.unsqueeze(1).float().cpu())
+      loss.backward()
+
+      head_importance += gates.grad.abs().detach()
+      gates.grad = None
+      model.zero_grad()
+  finally:
+    for handle in hooks:
+      handle.remove()
+
+  # layers are ranked on raw scores, heads after normalizing within each layer
+  layer_importance = head_importance.sum(dim=-1)
+  head_importance /= head_importance.norm(dim=-1, keepdim=True) + 1e-20
+
+  return head_importance.cpu(), layer_importance.cpu()
+
+def select_heads_to_prune(head_importance, layer_importance, head_fraction, num_layers_to_drop=0):
+  layers_to_drop = sorted(layer_importance.argsort()[:num_layers_to_drop].tolist())
+
+  # rank the remaining heads globally and keep at least one head per layer
+  scores = head_importance.clone()
+  scores[layers_to_drop] = float('inf')
+  scores[torch.arange(len(scores)), scores.argmax(dim=-1)] = float('inf')
+  num_heads_to_prune = int(head_fraction * (scores.numel() - len(layers_to_drop) * scores.shape[1]))
+  num_heads_to_prune = min(num_heads_to_prune, int(torch.isfinite(scores).sum()))
+
+  heads_to_prune = {}
+  for idx in scores.flatten().argsort()[:num_heads_to_prune].tolist():
+    layer, head = divmod(idx, scores.shape[1])
+    heads_to_prune.setdefault(layer, []).append(head)
+
+  return heads_to_prune, layers_to_drop
+
+def slice_linear(linear, index, dim):
+  # a copy of linear keeping the output (dim=0) or input (dim=1) features in index
+  weight = linear.weight.index_select(dim, index).detach().clone()
+  bias = linear.bias if dim == 1 or linear.bias is None else linear.bias[index]
+  sliced = torch.nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None).to(weight.device, weight.dtype)
+  with torch.no_grad():
+    sliced.weight.copy_(weight)
+    if bias is not None:
+      sliced.bias.copy_(bias.detach())
+  return sliced
+
+def prune_heads(attention, heads):
+  # removes heads (indices of the layer's current heads) from a BertAttention module
+  self_attention = attention.self
+  head_size = self_attention.attention_head_size
+  keep = [h for h in range(self_attention.num_attention_heads) if h not in set(heads)]
+  index = torch.arange(self_attention.all_head_size, device=self_attention.query.weight.device).view(-1, head_size)[keep].flatten()
+
+  self_attention.query = slice_linear(self_attention.query, index, 0)
+  self_attention.key = slice_linear(self_attention.key, index, 0)
+  self_attention.value = slice_linear(self_attention.value, index, 0)
+  attention.output.dense = slice_linear(attention.output.dense, index, 1)
+  self_attention.num_attention_heads = len(keep)
+  self_attention.all_head_size = len(keep) * head_size
+
+def prune_model(model, heads_to_prune, layers_to_drop):
+  # indices refer to the original, unpruned encoder
+  for layer, heads in heads_to_prune.items():
+    if heads:
+      prune_heads(model.bert.encoder.layer[int(layer)].attention, heads)
+  model.bert.encoder.layer = torch.nn.ModuleList([layer for i, layer in enumerate(model.bert.encoder.layer) if i not in layers_to_drop])
+  model.bert.config.num_hidden_layers = len(model.bert.encoder.layer)
+  model.pruning = {'heads_to_prune': heads_to_prune, 'layers_to_drop': layers_to_drop}
+  return model
+
+def save_pruned_model(model, path):
+  torch.save({'pruning': model.pruning, 'state_dict': model.state_dict()}, path)
+
+def load_pruned_model(model, path):
+  # model must be a freshly built Model with the same architecture used for the saved one
+  checkpoint = torch.load(path, map_location='cpu')
+  model = prune_model(model, **checkpoint['pruning'])
+  model.load_state_dict(checkpoint['state_dict'])
+  return model
+
+def estimate_flops(model, seq_len):
+  # multiply-adds x2 of the encoder for one sequence of seq_len tokens
+  config = model.bert.config
+  hidden, intermediate = config.hidden_size, config.intermediate_size
+  flops = 0
+  for layer in model.bert.encoder.layer:
+    attention_size = layer.attention.self.all_head_size
+    flops += 2 * seq_len * (3 * hidden * attention_size + attention_size * hidden + 2 * hidden * intermediate)
+    flops += 2 * 2 * seq_len * seq_len * attention_size
+  return flops
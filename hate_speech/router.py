@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-language model router: Italian, Spanish and German classifier+tokenizer pairs in one process
+
+    router = ModelRouter({'it': 'model_hs', 'es': 'model_spanish_hs', 'de': 'model_german_hs'}, memory_limit_mb=1500)
+    probs = router.predict(texts, languages)     # languages[i] in {'it', 'es', 'de'}, NaN for anything else
+
+A language is loaded on its first request, so startup does not pay for languages that get no
+traffic, and the least recently used languages are evicted when the loaded models exceed the
+memory limit. Each call batches the texts of every language separately.
+"""
+
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# base model, pooling of the classification head, stopword list and dropout used when training
+LANGUAGES = {
+  'it': {'model_name': "dbmdz/bert-base-italian-uncased", 'pooling': 'pooler', 'stopwords': 'italian', 'dropout': 0.3},
+  'es': {'model_name': "dccuchile/distilbert-base-spanish-uncased", 'pooling': 'mean', 'stopwords': 'spanish', 'dropout': 0.5},
+  'de': {'model_name': "dbmdz/bert-base-german-uncased", 'pooling': 'pooler', 'stopwords': 'german', 'dropout': 0.2},
+}
+
+def model_size_mb(model):
+  return sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers())) / 1e6
+
+class ModelRouter(object):
+  def __init__(self, paths, memory_limit_mb=None, languages=LANGUAGES, batch_size=64, device='cpu'):
+    # paths: language -> fine-tuned state dict
+    self.paths = paths
+    self.memory_limit_mb = memory_limit_mb
+    self.languages = languages
+    self.batch_size = batch_size
+    self.device = device
+    self.loaded = OrderedDict()
+    self.lock = threading.Lock()
+    self.loads = 0
+    self.evictions = 0
+
+  def get(self, language):
+    with self.lock:
+      if language in self.loaded:
+        self.loaded.move_to_end(language)
+        return self.loaded[language]
+
+      entry = self._load(language)
+      self.loaded[language] = entry
+      self.loads += 1
+
+      # evict least recently used languages, never the one just loaded
+      while self.memory_limit_mb and len(self.loaded) > 1 and self.memory_mb() > self.memory_limit_mb:
+        self.loaded.popitem(last=False)
+        self.evictions += 1
+      return entry
+
+  def _load(self, language):
+    from transformers import AutoTokenizer
+    from .inference import get_preprocess_tweet, load_model
+
+    spec = self.languages[language]
+    return {'model': load_model(self.paths[language], spec['dropout'], spec['model_name'], self.device, spec['pooling']),
+            'tokenizer': AutoTokenizer.from_pretrained(spec['model_name']),
+            'preprocess': get_preprocess_tweet(spec['stopwords'])}
+
+  def memory_mb(self):
+    return sum(model_size_mb(entry['model']) for entry in self.loaded.values())
+
+  def predict(self, texts, languages):
+    from .inference import predict
+
+    texts, languages = list(texts), np.asarray(languages)
+    probs = np.full(len(texts), np.nan, dtype=np.float32)
+
+    for language in map(str, np.unique(languages)):
+      if language not in self.paths:
+        continue
+      idx = np.nonzero(languages == language)[0]
+      entry = self.get(language)
+      probs[idx] = predict([texts[i] for i in idx], entry['model'], batch_size=self.batch_size,
+                           tokenizer=entry['tokenizer'], preprocess=entry['preprocess'])
+    return probs
+
+  def stats(self):
+    return {'loaded': list(self.loaded), 'memory_mb': self.memory_mb(), 'loads': self.loads, 'evictions': self.evictions}
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP inference server for the Task A/B classifiers with dynamic micro-batching
+
+    python -m hate_speech.server --model-hs model_hs --model-stereotype model_stereotype --port 8080
+
+    POST /predict  {"text": "..."}  ->  {"hs": 0.91, "stereotype": 0.12}
+    GET  /health                    ->  {"status": "ok"}
+
+Requests are queued and grouped into one batched forward through Model as soon as
+max_batch_size texts are waiting or the oldest one has waited max_latency_ms.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+class MicroBatcher(object):
+  def __init__(self, predict_fn, max_batch_size=32, max_latency_ms=10):
+    # predict_fn: list of texts -> list of results, run in a worker thread
+    self.predict_fn = predict_fn
+    self.max_batch_size = max_batch_size
+    self.max_latency = max_latency_ms / 1000
+    self.queue = asyncio.Queue()
+    self.executor = ThreadPoolExecutor(max_workers=1)
+    self.num_batches = 0
+    self.num_texts = 0
+
+  async def submit(self, text):
+    future = asyncio.get_running_loop().create_future()
+    await self.queue.put((text, future))
+    return await future
+
+  async def run(self):
+    loop = asyncio.get_running_loop()
+    while True:
+      batch = [await self.queue.get()]
+      deadline = loop.time() + self.max_latency
+
+      # wait for more texts until the batch is full or the latency budget is spent
+      while len(batch) < self.max_batch_size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+          break
+        try:
+          batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+        except asyncio.TimeoutError:
+          break
+
+      texts = [text for text, _ in batch]
+      try:
+        results = await loop.run_in_executor(self.executor, self.predict_fn, texts)
+      except Exception as e:
+        for _, future in batch:
+          if not future.done():
+            future.set_exception(e)
+        continue
+
+      self.num_batches += 1
+      self.num_texts += len(texts)
+      for (_, future), result in zip(batch, results):
+        if not future.done():
+          future.set_result(result)
+
+async def read_request(reader):
+  request_line = await reader.readline()
+  if not request_line:
+    return None
+  method, path, _ = request_line.decode('latin-1').split(' ', 2)
+
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if line in (b'\r\n', b'\n', b''):
+      break
+    name, value = line.decode('latin-1').split(':', 1)
+    headers[name.strip().lower()] = value.strip()
+
+  body = await reader.readexactly(int(headers.get('content-length', 0)))
+  return method, path, headers, body
+
+def write_response(writer, status, payload, keep_alive):
+  body = json.dumps(payload).encode('utf-8')
+  reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+  writer.write(f"HTTP/1.1 {status} {reason}\r\n"
+               f"Content-Type: application/json\r\n"
+               f"Content-Length: {len(body)}\r\n"
+               f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1') + body)
+
+def make_handler(batcher, cache=None):
+  async def handle(reader, writer):
+    try:
+      while True:
+        try:
+          request = await read_request(reader)
+        except ValueError:
+          # malformed request line, header or Content-Length: the stream cannot be resynchronized
+          write_response(writer, 400, {'error': 'malformed HTTP request'}, keep_alive=False)
+          await writer.drain()
+          break
+        if request is None:
+          break
+        method, path, headers, body = request
+        keep_alive = headers.get('connection', '').lower() != 'close'
+
+        if method == 'GET' and path == '/health':
+          status, payload = 200, {'status': 'ok', 'batches': batcher.num_batches, 'texts': batcher.num_texts}
+          if cache is not None:
+            payload['cache'] = cache.stats()
+        elif method == 'POST' and path == '/predict':
+          # validated before queueing: an error inside predict_fn fails every request of the micro-batch
+          try:
+            text = json.loads(body)['text']
+          except (ValueError, KeyError, TypeError):
+            text = None
+          if not isinstance(text, str):
+            status, payload = 400, {'error': 'expected a JSON body {"text": "..."}'}
+          else:
+            try:
+              status, payload = 200, await batcher.submit(text)
+            except Exception as e:
+              status, payload = 500, {'error': str(e)}
+        else:
+          status, payload = 404, {'error': 'not found'}
+
+        write_response(writer, status, payload, keep_alive)
+        await writer.drain()
+        if not keep_alive:
+          break
+    except (ConnectionError, asyncio.IncompleteReadError):
+      pass
+    finally:
+      writer.close()
+
+  return handle
+
+def make_predict_fn(args):
+  import torch
+  from transformers import AutoTokenizer
+  from .cache import PredictionCache
+  from .inference import MODEL_NAME, load_model, predict
+
+  if args.num_threads:
+    torch.set_num_threads(args.num_threads)
+  tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+  models = {'hs': load_model(args.model_hs, args.dropout_hs)}
+  if args.model_stereotype:
+    models['stereotype'] = load_model(args.model_stereotype, args.dropout_stereotype)
+
+  cache = None
+  if args.cache_size:
+    # a new or retrained state dict file changes the version and invalidates the disk tier
+    paths = [path for path in (args.model_hs, args.model_stereotype) if path]
+    model_version = args.model_version or ','.join(f'{os.path.abspath(path)}:{os.path.getmtime(path)}' for path in paths)
+    cache = PredictionCache(model_version, max_size=args.cache_size, path=args.cache_path)
+
+  def predict_fn(texts):
+    probs = predict(texts, models, batch_size=len(texts), tokenizer=tokenizer, cache=cache)
+    return [{name: float(probs[name][i]) for name in models} for i in range(len(texts))]
+
+  return predict_fn, cache
+
+async def serve(predict_fn, host, port, max_batch_size, max_latency_ms, cache=None):
+  batcher = MicroBatcher(predict_fn, max_batch_size, max_latency_ms)
+  batch_task = asyncio.create_task(batcher.run())
+  server = await asyncio.start_server(make_handler(batcher, cache), host, port)
+  print(f"Serving on http://{host}:{port} (max_batch_size={max_batch_size}, max_latency_ms={max_latency_ms})")
+
+  try:
+    async with server:
+      await server.serve_forever()
+  finally:
+    batch_task.cancel()
+
+def main():
+  parser = argparse.ArgumentParser(description='HTTP server for the hate speech and stereotype classifiers')
+  parser.add_argument('--model-hs', required=True, help='state dict of the Task A model')
+  parser.add_argument('--dropout-hs', type=float, default=0.3)
+  parser.add_argument('--model-stereotype', help='state dict of the Task B model')
+  parser.add_argument('--dropout-stereotype', type=float, default=0.8)
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--max-batch-size', type=int, default=32)
+  parser.add_argument('--max-latency-ms', type=float, default=10)
+  parser.add_argument('--num-threads', type=int, default=None, help='torch intra-op threads')
+  parser.add_argument('--cache-size', type=int, default=0, help='in-memory LRU prediction cache entries (0 disables the cache)')
+  parser.add_argument('--cache-path', help='sqlite file for the on-disk cache tier')
+  parser.add_argument('--model-version', help='cache namespace (default: model paths and modification times)')
+  args = parser.parse_args()
+
+  predict_fn, cache = make_predict_fn(args)
+  asyncio.run(serve(predict_fn, args.host, args.port, args.max_batch_size, args.max_latency_ms, cache))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded-memory streaming classification of posts read from stdin or a file
+
+    cat posts.tsv | python -m hate_speech.stream_classify --model-hs model_hs --model-stereotype model_stereotype > scores.tsv
+    python -m hate_speech.stream_classify --input posts.jsonl --format jsonl --model-hs model_hs
+
+Input is TSV in the HaSpeeDe2 `id\ttext` layout (extra columns and a header row are ignored)
+or JSONL with `id` and `text` fields. A producer thread reads, normalizes and tokenizes
+fixed-size chunks while the main thread classifies the previous ones, and the output
+`id, hs_prob, stereotype_prob` is written and flushed chunk by chunk. At most
+`prefetch` chunks are held in memory, whatever the size of the input.
+With --skip-duplicates, near-duplicates of earlier posts (MinHash, see dedup.py) are not scored;
+posts are compared with the last --dedup-window unique posts only, which bounds the memory.
+"""
+
+import argparse
+import json
+import sys
+import threading
+from queue import Queue
+
+def read_posts(lines, fmt):
+  for i, line in enumerate(lines):
+    line = line.rstrip('\r\n')
+    if not line:
+      continue
+    if fmt == 'jsonl':
+      post = json.loads(line)
+      yield str(post['id']), post['text']
+    else:
+      fields = line.split('\t')
+      if i == 0 and fields[0] == 'id':
+        continue
+      yield fields[0], fields[1] if len(fields) > 1 else ''
+
+def read_chunks(posts, chunk_size):
+  chunk = []
+  for post in posts:
+    chunk.append(post)
+    if len(chunk) == chunk_size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+def producer(chunks, queue, preprocess, encode_fn, dedup_index=None):
+  try:
+    for chunk in chunks:
+      ids = [post_id for post_id, _ in chunk]
+      texts = [preprocess(text) for _, text in chunk]
+      if dedup_index is not None:
+        keep = dedup_index.filter_new(texts)
+        ids = [post_id for post_id, k in zip(ids, keep) if k]
+        texts = [text for text, k in zip(texts, keep) if k]
+      queue.put((ids, encode_fn(texts)))
+  except Exception as e:
+    queue.put(e)
+  finally:
+    queue.put(None)
+
+def classify_stream(lines, out, preprocess, encode_fn, predict_fn, names, fmt='tsv', output_format='tsv', chunk_size=256, prefetch=4, dedup_index=None):
+  # encode_fn: normalized texts -> input ids, predict_fn: input ids -> {name: probabilities}
+  # dedup_index: optional MinHashIndex, near-duplicates of earlier posts are skipped
+  queue = Queue(maxsize=prefetch)
+  chunks = read_chunks(read_posts(lines, fmt), chunk_size)
+  thread = threading.Thread(target=producer, args=(chunks, queue, preprocess, encode_fn, dedup_index), daemon=True)
+  thread.start()
+
+  if output_format == 'tsv':
+    out.write('\t'.join(['id'] + [f'{name}_prob' for name in names]) + '\n')
+
+  num_posts = 0
+  while True:
+    item = queue.get()
+    if item is None:
+      break
+    if isinstance(item, Exception):
+      raise item
+
+    ids, input_ids = item
+    if not ids:
+      continue
+    probs = predict_fn(input_ids)
+    for i, post_id in enumerate(ids):
+      if output_format == 'jsonl':
+        out.write(json.dumps({'id': post_id, **{f'{name}_prob': round(float(probs[name][i]), 6) for name in names}}) + '\n')
+      else:
+        out.write('\t'.join([post_id] + [f'{probs[name][i]:.6f}' for name in names]) + '\n')
+    out.flush()
+    num_posts += len(ids)
+
+  thread.join()
+  return num_posts
+
+def main():
+  parser = argparse.ArgumentParser(description='Stream posts through the hate speech and stereotype classifiers')
+  parser.add_argument('--input', help='input file (default: stdin)')
+  parser.add_argument('--output', help='output file (default: stdout)')
+  parser.add_argument('--format', choices=['tsv', 'jsonl'], default='tsv', help='input format')
+  parser.add_argument('--output-format', choices=['tsv', 'jsonl'], default='tsv')
+  parser.add_argument('--model-hs', required=True, help='state dict of the Task A model')
+  parser.add_argument('--dropout-hs', type=float, default=0.3)
+  parser.add_argument('--model-stereotype', help='state dict of the Task B model')
+  parser.add_argument('--dropout-stereotype', type=float, default=0.8)
+  parser.add_argument('--chunk-size', type=int, default=256, help='posts tokenized and classified together')
+  parser.add_argument('--batch-size', type=int, default=64, help='posts per forward pass')
+  parser.add_argument('--prefetch', type=int, default=4, help='tokenized chunks buffered ahead of the model')
+  parser.add_argument('--skip-duplicates', action='store_true', help='do not score near-duplicates of earlier posts')
+  parser.add_argument('--dedup-window', type=int, default=100000, help='unique posts remembered by --skip-duplicates (about 640 bytes each)')
+  args = parser.parse_args()
+
+  from transformers import AutoTokenizer
+  from .inference import MODEL_NAME, MAX_LENGTH, get_preprocess_tweet, load_model, predict_encoded
+
+  tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+  preprocess = get_preprocess_tweet()
+  models = {'hs': load_model(args.model_hs, args.dropout_hs)}
+  if args.model_stereotype:
+    models['stereotype'] = load_model(args.model_stereotype, args.dropout_stereotype)
+
+  encode_fn = lambda texts: tokenizer(texts, max_length=MAX_LENGTH, truncation=True)['input_ids']
+  predict_fn = lambda input_ids: predict_encoded(input_ids, models, tokenizer, args.batch_size)
+
+  lines = open(args.input, encoding='utf-8') if args.input else sys.stdin
+  out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+  try:
+    dedup_index = None
+    if args.skip_duplicates:
+      from .dedup import MinHashIndex
+      dedup_index = MinHashIndex(max_seen=args.dedup_window)
+    num_posts = classify_stream(lines, out, preprocess, encode_fn, predict_fn, list(models), args.format, args.output_format, args.chunk_size, args.prefetch, dedup_index)
+  finally:
+    if args.input:
+      lines.close()
+    if args.output:
+      out.close()
+
+  print(f"Classified {num_posts} posts", file=sys.stderr)
+
+if __name__ == '__main__':
+  main()
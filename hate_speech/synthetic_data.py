@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic HaSpeeDe2-shaped corpora for offline load testing
+
+    python -m hate_speech.synthetic_data --output-dir /tmp/content --scale 10
+    # then point the notebook at /tmp/content instead of /content (or symlink it)
+
+Writes every file the notebook reads, with the same relative paths and schemas:
+Task A/B TSVs (id, text, hs, stereotype), Task C token files (TweetID-TokenNumber, token,
+IOB) and the Spanish hateval CSVs (id, text, hs, tr, ag). Sizes are the real ones times
+--scale. Texts are drawn from small Italian/Spanish vocabularies with lognormal lengths,
+anonymized mentions (@user), URL placeholders, hashtags and punctuation, and positive posts
+use more words of a hateful lexicon, so label ratios and a learnable signal are preserved.
+Generation is vectorized over the words of a whole chunk of posts.
+"""
+
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+VOCABULARY = {
+  'italian': {
+    'neutral': ['governo', 'legge', 'casa', 'oggi', 'mercato', 'gente', 'giornata', 'lavoro', 'città', 'sindaco',
+                'quartiere', 'polizia', 'notizia', 'bella', 'grande', 'nuova', 'discute', 'arrivano', 'aiutare',
+                'porti', 'sicurezza', 'paese', 'europa', 'accoglienza', 'sbarchi', 'confini', 'migranti', 'italiani',
+                'stranieri', 'comune', 'scuola', 'famiglie', 'centro', 'progetto', 'integrazione', 'diritti'],
+    'hateful': ['immigrati', 'rom', 'clandestini', 'vergogna', 'rubano', 'rimandati', 'invasione', 'delinquenti',
+                'parassiti', 'cacciare', 'schifo', 'chiudere', 'nessuno', 'niente', 'tutti', 'loro'],
+    'stopwords': ['a', 'al', 'alla', 'che', 'con', 'da', 'dei', 'del', 'della', 'di', 'e', 'gli', 'ha', 'i', 'il', 'in',
+                  'la', 'le', 'lo', 'ma', 'non', 'per', 'più', 'se', 'si', 'sono', 'su', 'tra', 'un', 'una'],
+  },
+  'spanish': {
+    'neutral': ['gobierno', 'ley', 'casa', 'hoy', 'mercado', 'gente', 'día', 'trabajo', 'ciudad', 'alcalde', 'barrio',
+                'policía', 'noticia', 'bonito', 'grande', 'nueva', 'llegan', 'ayudar', 'frontera', 'seguridad', 'país',
+                'europa', 'acogida', 'migrantes', 'españoles', 'escuela', 'familias', 'derechos', 'mujeres', 'calle'],
+    'hateful': ['inmigrantes', 'ilegales', 'vergüenza', 'roban', 'fuera', 'invasión', 'delincuentes', 'parásitos',
+                'echar', 'asco', 'zorra', 'puta', 'callate', 'todos', 'nadie', 'nada'],
+    'stopwords': ['a', 'al', 'con', 'de', 'del', 'el', 'en', 'es', 'la', 'las', 'lo', 'los', 'no', 'para', 'por', 'que',
+                  'se', 'su', 'un', 'una', 'y', 'ya'],
+  },
+}
+
+PUNCTUATION = np.array(['.', ',', '!', '?', '...', ':'])
+
+# (posts, mean words, sigma of log words) of the real files; label ratios of HaSpeeDe2 dev and hateval es train
+SIZES = {'dev': 6839, 'tweets': 1263, 'news': 500, 'es_train': 4500, 'es_dev': 500, 'es_test': 1600}
+LENGTHS = {'tweet': (20, 0.5, 2, 70), 'news': (12, 0.35, 3, 40)}
+
+def post_lengths(rng, n, kind='tweet'):
+  mean, sigma, low, high = LENGTHS[kind]
+  return np.clip(np.round(rng.lognormal(np.log(mean), sigma, n)), low, high).astype(np.int64)
+
+def post_words(rng, lengths, positive, language='italian', hateful_rate=0.25, news=False):
+  # flat array of the words of all posts; positive posts draw hateful_rate of their words from the hateful lexicon
+  vocabulary = VOCABULARY[language]
+  neutral = np.array(vocabulary['neutral'] + vocabulary['stopwords'])
+  hateful = np.array(vocabulary['hateful'])
+  owner = np.repeat(np.arange(len(lengths)), lengths)
+  first = np.repeat(np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+
+  rate = np.where(positive[owner], hateful_rate, 0.03)
+  words = np.where(rng.random(len(owner)) < rate, rng.choice(hateful, len(owner)), rng.choice(neutral, len(owner))).astype(object)
+  if not news:
+    # a mention at the start of some tweets, hashtags, URL placeholders and punctuation anywhere
+    draw = rng.random(len(owner))
+    at_start = np.arange(len(owner)) == first
+    words[at_start & (draw < 0.35)] = '@user'
+    words[~at_start & (draw < 0.03)] = '@user'
+    words[(draw >= 0.03) & (draw < 0.06)] = 'URL'
+    hashtags = (draw >= 0.06) & (draw < 0.09)
+    words[hashtags] = '#' + rng.choice(neutral[:len(vocabulary['neutral'])], int(hashtags.sum())).astype(object)
+    punctuation = (draw >= 0.09) & (draw < 0.17)
+    words[punctuation] = rng.choice(PUNCTUATION, int(punctuation.sum()))
+  return words, owner
+
+def join_posts(words, lengths):
+  offsets = np.cumsum(lengths)[:-1]
+  return [' '.join(post) for post in np.split(words, offsets)]
+
+def taskab_frame(n, seed=0, hs_ratio=0.42, stereotype_given_hs=0.7, stereotype_given_not_hs=0.25, news=False, first_id=1):
+  # id, text, hs, stereotype as in haspeede2_*_taskAB*.tsv
+  rng = np.random.default_rng(seed)
+  hs = rng.random(n) < hs_ratio
+  stereotype = rng.random(n) < np.where(hs, stereotype_given_hs, stereotype_given_not_hs)
+  lengths = post_lengths(rng, n, 'news' if news else 'tweet')
+  words, _ = post_words(rng, lengths, hs, 'italian', news=news)
+  texts = join_posts(words, lengths)
+  if news:
+    texts = [text.capitalize() for text in texts]
+  return pd.DataFrame({'id': np.arange(first_id, first_id + n), 'text': texts, 'hs': hs.astype(int), 'stereotype': stereotype.astype(int)})
+
+def hateval_frame(n, seed=0, hs_ratio=0.41, tr_given_hs=0.5, ag_given_hs=0.6, first_id=20001):
+  # id, text, HS, TR, AG as in hateval2019_es_*.csv; TR and AG are only set for hateful posts
+  rng = np.random.default_rng(seed)
+  hs = rng.random(n) < hs_ratio
+  lengths = post_lengths(rng, n)
+  words, _ = post_words(rng, lengths, hs, 'spanish')
+  return pd.DataFrame({'id': np.arange(first_id, first_id + n), 'text': join_posts(words, lengths), 'HS': hs.astype(int),
+                       'TR': (hs & (rng.random(n) < tr_given_hs)).astype(int), 'AG': (hs & (rng.random(n) < ag_given_hs)).astype(int)})
+
+def taskc_lines(n, seed=0, span_ratio=0.6, news=False, first_id=1):
+  # lines of a haspeede2_*_taskC*.txt file: a comment line per post, then TweetID-TokenNumber, token
+  # and IOB tag per token, and a blank line; at most two nominal utterance spans per post
+  rng = np.random.default_rng(seed)
+  lengths = post_lengths(rng, n, 'news' if news else 'tweet')
+  words, owner = post_words(rng, lengths, rng.random(n) < 0.4, 'italian', news=news)
+  position = np.arange(len(owner)) - np.repeat(np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+
+  tags = np.full(len(owner), 'O', dtype=object)
+  end = np.zeros(n, dtype=np.int64)
+  for ratio in (span_ratio, span_ratio / 3):
+    has_span = (rng.random(n) < ratio) & (end < lengths)
+    start = end + (rng.random(n) * (lengths - end)).astype(np.int64)
+    end = np.where(has_span, np.minimum(start + rng.geometric(0.25, n), lengths), end)
+    inside = has_span[owner] & (position >= start[owner]) & (position < end[owner])
+    tags[inside & (position == start[owner])] = 'B-NU-CGA'
+    tags[inside & (position > start[owner])] = 'I-NU-CGA'
+    end = np.where(has_span, end + 1, end)
+
+  ids = np.arange(first_id, first_id + n)
+  rows = [f'{i}-{p + 1}\t{w}\t{t}' for i, p, w, t in zip(ids[owner], position, words, tags)]
+  lines = []
+  for post_id, post_rows in zip(ids, np.split(np.array(rows, dtype=object), np.cumsum(lengths)[:-1])):
+    lines.append(f'# tweet_id = {post_id}')
+    lines.extend(post_rows)
+    lines.append('')
+  return lines
+
+def write_corpora(output_dir, scale=1.0, seed=0, chunk_size=50000):
+  # the notebook's /content layout; large files are written chunk by chunk
+  paths = {'dev': 'haspeede2_dev/haspeede2_dev_taskAB.tsv',
+           'tweets': 'haspeede2_reference/haspeede2_reference/haspeede2_reference_taskAB-tweets.tsv',
+           'news': 'haspeede2_reference/haspeede2_reference/haspeede2_reference_taskAB-news.tsv',
+           'dev_c': 'haspeede2_dev/haspeede2_dev_taskC.txt',
+           'tweets_c': 'haspeede2_reference/haspeede2_reference/haspeede2_reference_taskC-tweets.txt',
+           'news_c': 'haspeede2_reference/haspeede2_reference/haspeede2_reference_taskC-news.txt',
+           'es_train': 'haspeede_spanish/hateval2019_es_train.csv',
+           'es_dev': 'haspeede_spanish/hateval2019_es_dev.csv',
+           'es_test': 'haspeede_spanish/hateval2019_es_test.csv'}
+  for path in paths.values():
+    os.makedirs(os.path.join(output_dir, os.path.dirname(path)), exist_ok=True)
+
+  written = {}
+  for i, (name, path) in enumerate(paths.items()):
+    split = name[:-2] if name.endswith('_c') else name
+    total = max(int(round(SIZES[split] * scale)), 1)
+    with open(os.path.join(output_dir, path), 'w', encoding='utf-8', newline='') as f:
+      for start in range(0, total, chunk_size):
+        n = min(chunk_size, total - start)
+        chunk_seed = (seed, i, start)
+        if name.endswith('_c'):
+          f.write('\n'.join(taskc_lines(n, chunk_seed, news=split == 'news', first_id=start + 1)) + '\n')
+        elif name.startswith('es_'):
+          hateval_frame(n, chunk_seed, first_id=20001 + start).to_csv(f, index=False, header=start == 0)
+        else:
+          taskab_frame(n, chunk_seed, news=split == 'news', first_id=start + 1).to_csv(f, sep='\t', index=False, header=start == 0)
+    written[path] = total
+  return written
+
+def main():
+  import time
+
+  parser = argparse.ArgumentParser(description='Write synthetic HaSpeeDe2-shaped corpora with the layout of /content')
+  parser.add_argument('--output-dir', required=True)
+  parser.add_argument('--scale', type=float, default=1.0, help='size relative to the real corpora, e.g. 10 or 100')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  start = time.perf_counter()
+  written = write_corpora(args.output_dir, args.scale, args.seed)
+  for path, n in written.items():
+    print(f"{n:>10,} posts  {os.path.join(args.output_dir, path)}")
+  print(f"{time.perf_counter() - start:.1f}s")
+
+if __name__ == '__main__':
+  main()
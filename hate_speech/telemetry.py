@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Per-epoch training throughput and resource telemetry
+
+    train_losses, val_losses, reports, telemetry = train_model(..., telemetry_path='runs/telemetry.jsonl')
+    telemetry[-1]['tokens_per_sec']       # one record per epoch, also appended to the JSONL file
+    summarize(telemetry)                  # whole-run rates for a row of the grid results
+
+Examples and real (attention mask) tokens are counted while train_fn iterates the data
+loader, so throughput is measured on the batches the model actually saw; padding_ratio is
+the share of encoder positions that are padding (with trim=True, as for the packed Task C
+batches, a batch is only as long as its longest sequence). Peak RSS is the process peak so
+far, peak device memory is reset at the start of every epoch.
+"""
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+import torch
+
+class CountingLoader(object):
+  # iterates the data loader unchanged, counting examples, real tokens and encoder positions
+  def __init__(self, data_loader, trim=False):
+    self.data_loader = data_loader
+    self.trim = trim
+    self.examples = self.tokens = self.positions = 0
+
+  def __len__(self):
+    return len(self.data_loader)
+
+  def __iter__(self):
+    for batch in self.data_loader:
+      lengths = batch[1].sum(dim=1)
+      self.examples += len(lengths)
+      self.tokens += int(lengths.sum())
+      self.positions += len(lengths) * (int(lengths.max()) if self.trim else batch[1].shape[1])
+      yield batch
+
+def peak_rss_mb():
+  # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+class Telemetry(object):
+  def __init__(self, device=None, path=None, distributed=False):
+    # path: when set, every epoch record is appended to this JSONL file
+    # distributed: counts are summed over the torch.distributed ranks and only rank 0 writes
+    self.cuda = device is not None and torch.device(device).type == 'cuda'
+    self.distributed = distributed
+    self.path = path if not distributed or torch.distributed.get_rank() == 0 else None
+    self.records = []
+    if path and os.path.dirname(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+
+  def start_epoch(self, epoch):
+    self.epoch = epoch
+    self.eval_seconds = 0.0
+    self.loader = None
+    if self.cuda:
+      torch.cuda.reset_peak_memory_stats()
+    self.start = time.perf_counter()
+
+  def count(self, data_loader, trim=False):
+    self.loader = CountingLoader(data_loader, trim)
+    return self.loader
+
+  @contextlib.contextmanager
+  def evaluation(self):
+    start = time.perf_counter()
+    yield
+    self.eval_seconds += time.perf_counter() - start
+
+  def end_epoch(self):
+    if self.cuda:
+      torch.cuda.synchronize()
+    seconds = time.perf_counter() - self.start
+    train_seconds = seconds - self.eval_seconds
+    loader = self.loader or CountingLoader([])
+    examples, tokens, positions = loader.examples, loader.tokens, loader.positions
+    if self.distributed:
+      counts = torch.tensor([examples, tokens, positions], dtype=torch.float64)
+      torch.distributed.all_reduce(counts)
+      examples, tokens, positions = (int(count) for count in counts.tolist())
+    record = dict(epoch=self.epoch, seconds=seconds, train_seconds=train_seconds, eval_seconds=self.eval_seconds,
+                  examples=examples, tokens=tokens, positions=positions,
+                  examples_per_sec=examples / train_seconds if train_seconds else 0.0,
+                  tokens_per_sec=tokens / train_seconds if train_seconds else 0.0,
+                  padding_ratio=1 - tokens / positions if positions else 0.0,
+                  peak_rss_mb=peak_rss_mb(),
+                  peak_device_mb=torch.cuda.max_memory_allocated() / 2 ** 20 if self.cuda else None)
+    self.records.append(record)
+    if self.path:
+      with open(self.path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+    return record
+
+def format_record(record):
+  device = f", device {record['peak_device_mb']:.0f} MB" if record['peak_device_mb'] is not None else ''
+  return (f"{record['examples_per_sec']:.1f} examples/s, {record['tokens_per_sec']:.0f} tokens/s, "
+          f"{record['padding_ratio'] * 100:.1f}% padding, eval {record['eval_seconds']:.1f}s, RSS {record['peak_rss_mb']:.0f} MB{device}")
+
+def summarize(records):
+  # whole-run cost of the records of one train_model call
+  train_seconds = sum(record['train_seconds'] for record in records)
+  examples = sum(record['examples'] for record in records)
+  tokens = sum(record['tokens'] for record in records)
+  positions = sum(record['positions'] for record in records)
+  device = [record['peak_device_mb'] for record in records if record['peak_device_mb'] is not None]
+  return {'train_seconds': train_seconds,
+          'eval_seconds': sum(record['eval_seconds'] for record in records),
+          'examples_per_sec': examples / train_seconds if train_seconds else 0.0,
+          'tokens_per_sec': tokens / train_seconds if train_seconds else 0.0,
+          'padding_ratio': 1 - tokens / positions if positions else 0.0,
+          'peak_rss_mb': max((record['peak_rss_mb'] for record in records), default=0.0),
+          'peak_device_mb': max(device) if device else None}
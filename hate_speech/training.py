@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Task A training and evaluation outside the notebook
+
+    from hate_speech.training import load_corpora, preprocessing, tokenization, train_model, val_fn
+    from hate_speech.inference import Model
+
+    dev_df, test_df, test_df_news = load_corpora('/content')
+    X_train, X_val, y_train, y_val, X_test, X_test_news, y_test, y_test_news = preprocessing(dev_df, test_df, test_df_news)
+    train_losses, val_losses, reports, telemetry = train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs=2)
+
+EarlyStopping, preprocessing, tokenization, train_model, train_fn and val_fn for the binary
+classifiers, shared by the hate-speech CLI and the notebook (Tasks A and B, Spanish and German models):
+the datasets are passed in instead of read from globals and the device is taken from the model.
+Nothing is downloaded, mounted or plotted on import; sklearn is only imported by preprocessing.
+"""
+
+import os
+import random
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from .metrics import StreamingReport
+from .profiling import NULL_PROFILER, format_summary
+from .telemetry import Telemetry, format_record
+
+def set_reproducibility(seed):
+  random.seed(seed)
+  np.random.seed(seed)
+  torch.manual_seed(seed)
+  os.environ['TF_DETERMINISTIC_OPS'] = '1'
+
+class EarlyStopping(object):
+  def __init__(self, mode='min', min_delta=0, patience=2, percentage=False):
+    self.mode = mode
+    self.min_delta = min_delta
+    self.patience = patience
+    self.best = None
+    self.num_bad_epochs = 0
+    self.is_better = None
+    self._init_is_better(mode, min_delta, percentage)
+
+    if patience == 0:
+      self.is_better = lambda a, b: True
+      self.step = lambda a: False
+
+  def step(self, metrics):
+    if self.best is None:
+      self.best = metrics
+      return False
+
+    if np.isnan(metrics):
+      return True
+
+    if self.is_better(metrics, self.best):
+      self.num_bad_epochs = 0
+      self.best = metrics
+    else:
+      self.num_bad_epochs += 1
+
+    if self.num_bad_epochs >= self.patience:
+      print('terminating because of early stopping!')
+      return True
+    return False
+
+  def _init_is_better(self, mode, min_delta, percentage):
+    if mode not in {'min', 'max'}:
+      raise ValueError('mode ' + mode + ' is unknown!')
+    if not percentage:
+      if mode == 'min':
+        self.is_better = lambda a, best: a < best - min_delta
+      if mode == 'max':
+        self.is_better = lambda a, best: a > best + min_delta
+    else:
+      if mode == 'min':
+        self.is_better = lambda a, best: a < best - (best * min_delta / 100)
+      if mode == 'max':
+        self.is_better = lambda a, best: a > best + (best * min_delta / 100)
+
+def load_corpora(data_dir='/content'):
+  # dev, reference tweets and reference news of Task A/B, in the layout the notebook extracts to
+  # (and synthetic_data.write_corpora writes)
+  read = lambda path: pd.read_csv(os.path.join(data_dir, path), sep='\t', names=['id', 'text', 'hs', 'stereotype'], usecols=[0, 1, 2, 3], header=0)
+  dev_df = read('haspeede2_dev/haspeede2_dev_taskAB.tsv')
+  test_df = read('haspeede2_reference/haspeede2_reference/haspeede2_reference_taskAB-tweets.tsv')
+  test_df_news = read('haspeede2_reference/haspeede2_reference/haspeede2_reference_taskAB-news.tsv')
+  return dev_df, test_df, test_df_news
+
+def preprocessing(dev_df, test_df, test_df_news, subset_len=None, near_duplicates=None, preprocess=None, label='hs'):
+  # near_duplicates: None splits dev_df as is, 'group' keeps every group of near-duplicate
+  # posts on one side of the split, 'drop' keeps a single post per group
+  # preprocess: text normalization, inference.get_preprocess_tweet() by default
+  from sklearn.model_selection import train_test_split, GroupShuffleSplit
+
+  if preprocess is None:
+    from .inference import get_preprocess_tweet
+    preprocess = get_preprocess_tweet()
+
+  if subset_len:
+    subset_len = min(len(dev_df), subset_len)
+    # Randomly subset
+    dev_df = dev_df.sample(n=subset_len)
+
+  if near_duplicates:
+    from .dedup import MinHashIndex
+
+    groups = MinHashIndex().group(dev_df['text'].apply(preprocess).tolist())
+    if near_duplicates == 'drop':
+      keep = ~pd.Series(groups).duplicated().values
+      dev_df, groups = dev_df[keep], groups[keep]
+
+    # Split dev_df into train and val without separating near-duplicates
+    train_idx, val_idx = next(GroupShuffleSplit(n_splits=1, test_size=0.2).split(dev_df, groups=groups))
+    X_train, X_val = dev_df['text'].iloc[train_idx], dev_df['text'].iloc[val_idx]
+    y_train, y_val = dev_df[label].iloc[train_idx], dev_df[label].iloc[val_idx]
+  else:
+    # Split dev_df into train and val
+    X_train, X_val, y_train, y_val = train_test_split(dev_df['text'], dev_df[label], test_size=0.2)
+
+  X_test, y_test = test_df['text'].apply(preprocess), test_df[label]
+  X_test_news, y_test_news = test_df_news['text'].apply(preprocess), test_df_news[label]
+
+  return X_train.apply(preprocess), X_val.apply(preprocess), y_train, y_val, X_test, X_test_news, y_test, y_test_news
+
+def tokenization(X, y, batch_size, tokenizer=None, max_length=256, shuffle=True):
+  if tokenizer is None:
+    from transformers import AutoTokenizer
+    from .inference import MODEL_NAME
+    tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+
+  encoding = tokenizer(list(X), max_length=max_length, padding=True, truncation=True)
+
+  inputs = torch.tensor(encoding['input_ids'])
+  mask = torch.tensor(encoding['attention_mask'])
+  labels = torch.tensor(list(y))
+
+  data = TensorDataset(inputs, mask, labels)
+  sampler = RandomSampler(data) if shuffle else SequentialSampler(data)
+  return DataLoader(data, sampler=sampler, batch_size=batch_size)
+
+def train_model(model, criterion, optimizer, train_dataloader, val_dataloader, num_epochs, profiler=NULL_PROFILER, telemetry_path=None, progress=True, distributed=False):
+  # profiler: a profiling.StageProfiler to time every stage of each epoch and trace a window of steps
+  # telemetry_path: JSONL file to append the per-epoch throughput and memory records to
+  # distributed: this process is one rank of distributed.train_model_distributed, losses, reports
+  # and telemetry are those of all ranks together
+  early_stopping = EarlyStopping(patience=int(num_epochs * 0.1))
+  telemetry = Telemetry(next(model.parameters()).device, telemetry_path, distributed)
+  train_losses = []
+  val_losses = []
+  reports = []
+  for epoch in range(num_epochs):
+    print(f"Epoch {epoch+1}")
+    profiler.start_epoch(epoch + 1)
+    telemetry.start_epoch(epoch + 1)
+    if hasattr(train_dataloader.sampler, 'set_epoch'):
+      # a different shuffle of the DistributedSampler every epoch
+      train_dataloader.sampler.set_epoch(epoch)
+
+    # Train on training set
+    train_loss = train_fn(telemetry.count(train_dataloader), model, criterion, optimizer, profiler, progress)
+    if distributed:
+      from .distributed import all_reduce_sum
+      train_loss = all_reduce_sum(train_loss)[0] / torch.distributed.get_world_size()
+
+    # Evaluate on validation set
+    with telemetry.evaluation():
+      val_loss, report = val_fn(val_dataloader, model, criterion, profiler=profiler, progress=progress, distributed=distributed)
+
+    print(format_record(telemetry.end_epoch()))
+    summary = profiler.end_epoch()
+    if summary is not None:
+      print(format_summary(summary))
+
+    train_losses.append(train_loss)
+    val_losses.append(val_loss)
+    reports.append(report)
+
+    # Check early stopping
+    if early_stopping.step(val_losses[-1]):
+      break
+
+  return train_losses, val_losses, reports, telemetry.records
+
+def _progress(data_loader, progress):
+  if not progress:
+    return data_loader
+  from tqdm import tqdm
+  return tqdm(data_loader)
+
+def train_fn(data_loader, model, criterion, optimizer, profiler=NULL_PROFILER, progress=True):
+  device = next(model.parameters()).device
+  model.train()
+  train_loss = 0
+
+  for batch in profiler.iterate(_progress(data_loader, progress)):
+    ids, mask, labels = batch
+    with profiler('zero_grad'):
+      optimizer.zero_grad()
+
+    # Forward pass
+    with profiler('to_device'):
+      ids, mask = ids.to(device), mask.to(device)
+    with profiler('forward'):
+      outputs = model(ids, mask)
+      outputs = outputs.squeeze(-1)
+    with profiler('loss'):
+      loss = criterion(outputs.cpu(), labels.type_as(outputs).cpu())
+      train_loss += loss.item()
+
+    # Backward pass
+    with profiler('backward'):
+      loss.backward()
+    with profiler('optimizer'):
+      optimizer.step()
+    profiler.step()
+
+  return train_loss / len(data_loader)
+
+def val_fn(data_loader, model, criterion, threshold=0.5, return_logits=False, profiler=NULL_PROFILER, progress=True, distributed=False):
+  # threshold: on the positive class probability; return_logits: also return the logits and labels, e.g. for best_threshold
+  # distributed: data_loader is this rank's shard, loss and report are summed over all ranks (logits stay local)
+  device = next(model.parameters()).device
+  model.eval()
+  val_loss, metrics = 0, StreamingReport(labels=[0, 1])
+  all_logits, all_labels = [], []
+
+  with torch.no_grad():
+    for batch in profiler.iterate(_progress(data_loader, progress), 'val_data'):
+      ids, mask, labels = batch
+      labels = labels.unsqueeze(1)
+
+      # Forward pass
+      with profiler('val_to_device'):
+        ids, mask = ids.to(device), mask.to(device)
+      with profiler('val_forward'):
+        outputs = model(ids, mask)
+      with profiler('val_loss'):
+        loss = criterion(outputs.cpu(), labels.float().cpu())
+        val_loss += loss.item()
+
+      # confusion counts stay on the device, no per-batch predictions are kept
+      with profiler('val_metrics'):
+        metrics.update(torch.sigmoid(outputs) > threshold, labels)
+      if return_logits:
+        all_logits.append(outputs)
+        all_labels.append(labels)
+
+  num_batches = len(data_loader)
+  if distributed:
+    from .distributed import all_reduce_sum
+    val_loss, num_batches = all_reduce_sum(val_loss, num_batches)
+    metrics.all_reduce()
+  val_loss /= max(num_batches, 1)
+  report = metrics.report()
+
+  if return_logits:
+    return val_loss, report, torch.cat(all_logits).cpu(), torch.cat(all_labels)
+  return val_loss, report
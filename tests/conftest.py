@@ -0,0 +1,30 @@
+import pytest
+
+WORDS = 'ciao mondo gli immigrati vanno rimandati tutti casa loro oggi mercato gente bella giornata vergogna governo'.split()
+
+@pytest.fixture(scope='session')
+def tiny_bert(tmp_path_factory):
+  # a randomly initialized 2-layer BERT with a word-level vocabulary, saved like a pretrained checkpoint
+  import torch
+  from transformers import BertConfig, BertModel, BertTokenizer
+
+  directory = tmp_path_factory.mktemp('tiny_bert')
+  letters = 'abcdefghijklmnopqrstuvwxyz'
+  vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + WORDS + list(letters) + ['##' + c for c in letters]
+  (directory / 'vocab.txt').write_text('\n'.join(vocab))
+  BertTokenizer(str(directory / 'vocab.txt')).save_pretrained(directory)
+
+  torch.manual_seed(0)
+  config = BertConfig(vocab_size=len(vocab), hidden_size=768, num_hidden_layers=2, num_attention_heads=12, intermediate_size=64)
+  BertModel(config).save_pretrained(directory)
+  return str(directory)
+
+@pytest.fixture
+def tiny_model(tiny_bert):
+  # inference.Model over the tiny encoder, in eval mode, and its tokenizer
+  import torch
+  from transformers import AutoTokenizer
+  from hate_speech.inference import Model
+
+  torch.manual_seed(0)
+  return Model(0.3, tiny_bert).eval(), AutoTokenizer.from_pretrained(tiny_bert)
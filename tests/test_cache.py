@@ -0,0 +1,40 @@
+from hate_speech.cache import PredictionCache
+
+def test_hits_and_misses():
+  cache = PredictionCache('v1')
+  assert cache.get_many(['a', 'b']) == [None, None]
+  cache.put_many(['a'], [{'prob': 0.9}])
+  assert cache.get_many(['a', 'b', 'a']) == [{'prob': 0.9}, None, {'prob': 0.9}]
+  stats = cache.stats()
+  assert (stats['hits'], stats['misses'], stats['size']) == (2, 3, 1)
+  assert stats['hit_rate'] == 2 / 5
+
+def test_model_version_is_part_of_the_key():
+  cache = PredictionCache('v1')
+  cache.put_many(['a'], [0.9])
+  cache.model_version = 'v2'
+  assert cache.get_many(['a']) == [None]
+
+def test_lru_eviction():
+  cache = PredictionCache('v1', max_size=2)
+  cache.put_many(['a', 'b'], [1, 2])
+  cache.get_many(['a'])
+  # 'b' is now the least recently used
+  cache.put_many(['c'], [3])
+  assert cache.get_many(['a', 'b', 'c']) == [1, None, 3]
+  assert cache.stats()['size'] == 2
+
+def test_sqlite_round_trip(tmp_path):
+  path = str(tmp_path / 'cache.sqlite')
+  cache = PredictionCache('v1', max_size=1, path=path)
+  cache.put_many(['a', 'b'], [{'hs': 0.25}, {'hs': 0.75}])
+  # 'a' was evicted from memory but is still on disk
+  assert cache.get_many(['a']) == [{'hs': 0.25}]
+  assert cache.stats()['disk_hits'] == 1
+  cache.close()
+
+  reopened = PredictionCache('v1', path=path)
+  assert reopened.get_many(['b', 'a', 'c']) == [{'hs': 0.75}, {'hs': 0.25}, None]
+  assert reopened.stats()['disk_hits'] == 2
+  assert PredictionCache('v2', path=path).get_many(['a']) == [None]
+  reopened.close()
@@ -0,0 +1,71 @@
+import itertools
+import numpy as np
+from hate_speech.cascade import Cascade, choose_band
+
+def brute_force_band(probs, labels, target_recall, target_precision, bert_preds, candidates):
+  # every (low, high) pair simulated post by post: fraction sent to BERT of the cheapest valid band
+  best = None
+  for low, high in itertools.product(candidates, candidates):
+    if low > high:
+      continue
+    in_band = (probs >= low) & (probs < high)
+    preds = np.where(in_band, bert_preds, probs >= high)
+    true_positives = (preds & labels).sum()
+    recall = true_positives / max(labels.sum(), 1)
+    precision = true_positives / max(preds.sum(), 1)
+    if recall >= target_recall and precision >= target_precision:
+      fraction = in_band.mean()
+      best = fraction if best is None else min(best, fraction)
+  return best
+
+def test_choose_band_matches_brute_force():
+  rng = np.random.default_rng(0)
+  for _ in range(20):
+    n = 60
+    labels = rng.random(n) < 0.4
+    probs = np.clip(labels * 0.3 + rng.random(n) * 0.7, 0, 1)
+    bert_preds = np.where(rng.random(n) < 0.85, labels, ~labels)
+    target_precision = (bert_preds & labels).sum() / max(bert_preds.sum(), 1)
+    low, high = choose_band(probs, labels, 0.8, bert_preds=bert_preds, num_candidates=20)
+
+    candidates = np.unique(np.quantile(probs, np.linspace(0, 1, 21)))
+    candidates[-1] = np.nextafter(candidates[-1], np.inf)
+    expected = brute_force_band(probs, labels, 0.8, target_precision, bert_preds, candidates)
+    in_band = (probs >= low) & (probs < high)
+    if expected is None:
+      assert in_band.all()
+    else:
+      assert in_band.mean() == expected
+
+def test_choose_band_separable_prefilter_needs_no_bert():
+  probs = np.array([0.1, 0.2, 0.3, 0.7, 0.8, 0.9])
+  labels = np.array([0, 0, 0, 1, 1, 1])
+  low, high = choose_band(probs, labels, target_recall=1.0)
+  assert not ((probs >= low) & (probs < high)).any()
+
+def test_choose_band_unreachable_target_sends_everything_to_bert():
+  probs = np.array([0.1, 0.5, 0.9])
+  labels = np.array([1, 0, 1])
+  low, high = choose_band(probs, labels, target_recall=1.0, target_precision=1.0, bert_preds=np.zeros(3, dtype=bool))
+  assert ((probs >= low) & (probs < high)).all()
+
+class FixedPrefilter(object):
+  def __init__(self, probs):
+    self.probs = np.asarray(probs)
+
+  def predict_proba(self, texts):
+    return np.stack([1 - self.probs, self.probs], axis=1)
+
+def test_cascade_outside_band_is_hard_decision():
+  cascade = Cascade(FixedPrefilter([0.1, 0.35, 0.45, 0.9]), model=None, low=0.3, high=0.3)
+  probs, in_band = cascade.predict(['a', 'b', 'c', 'd'])
+  assert not in_band.any()
+  assert probs.tolist() == [0, 1, 1, 1]
+
+class ThresholdModel(object):
+  threshold = 0.3
+
+def test_cascade_threshold_defaults_to_the_model_threshold():
+  assert Cascade(FixedPrefilter([0.5]), model=ThresholdModel(), low=0.2, high=0.8).threshold == 0.3
+  assert Cascade(FixedPrefilter([0.5]), model=ThresholdModel(), low=0.2, high=0.8, threshold=0.6).threshold == 0.6
+  assert Cascade(FixedPrefilter([0.5]), model=None, low=0.2, high=0.8).threshold == 0.5
@@ -0,0 +1,5 @@
+import io
+from hate_speech.cli import read_texts
+
+def test_read_texts_skips_blank_lines():
+  assert read_texts(io.StringIO('ciao\n\n   \nmondo\n\t\nultima')) == ['ciao', 'mondo', 'ultima']
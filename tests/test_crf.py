@@ -0,0 +1,52 @@
+import itertools
+import torch
+from hate_speech.crf import CRF, iob_constraints, pad_packed
+
+LABEL_MAP = {'O': 0, 'B': 1, 'I': 2, 'PAD': 3}
+
+def path_score(crf, emissions, tags):
+  transitions, start = crf._scores()
+  score = start[tags[0]] + crf.end[tags[-1]] + sum(emissions[t, tag] for t, tag in enumerate(tags))
+  return score + sum(transitions[a, b] for a, b in zip(tags[:-1], tags[1:]))
+
+def test_pad_packed():
+  packed = torch.tensor([1, 2, 3, 4, 5, 6])
+  padded, mask = pad_packed(packed, [2, 0, 3, 1], padding_value=-1)
+  assert padded.tolist() == [[1, 2, -1], [-1, -1, -1], [3, 4, 5], [6, -1, -1]]
+  assert mask.tolist() == [[True, True, False], [False, False, False], [True, True, True], [True, False, False]]
+
+def test_viterbi_matches_brute_force():
+  torch.manual_seed(0)
+  crf = CRF(len(LABEL_MAP), *iob_constraints(LABEL_MAP))
+  with torch.no_grad():
+    for parameter in crf.parameters():
+      parameter.normal_()
+
+  lengths = [1, 2, 3, 4]
+  emissions = torch.randn(len(lengths), max(lengths), len(LABEL_MAP))
+  mask = torch.arange(max(lengths))[None, :] < torch.tensor(lengths)[:, None]
+  decoded = crf.decode(emissions, mask)
+
+  for i, length in enumerate(lengths):
+    best = max(itertools.product(range(len(LABEL_MAP)), repeat=length), key=lambda tags: path_score(crf, emissions[i], tags))
+    assert decoded[i, :length].tolist() == list(best)
+    # no O -> I transition and no leading I
+    assert best[0] != LABEL_MAP['I']
+    assert all(not (a == LABEL_MAP['O'] and b == LABEL_MAP['I']) for a, b in zip(best[:-1], best[1:]))
+
+def test_neg_log_likelihood_matches_brute_force():
+  torch.manual_seed(1)
+  crf = CRF(3)
+  with torch.no_grad():
+    for parameter in crf.parameters():
+      parameter.normal_()
+
+  emissions = torch.randn(2, 3, 3)
+  mask = torch.tensor([[True, True, True], [True, True, False]])
+  tags = torch.tensor([[0, 1, 2], [2, 2, 0]])
+
+  expected = 0
+  for i, length in enumerate([3, 2]):
+    scores = torch.stack([path_score(crf, emissions[i], path) for path in itertools.product(range(3), repeat=length)])
+    expected += torch.logsumexp(scores, dim=0) - path_score(crf, emissions[i], tags[i, :length].tolist())
+  assert torch.allclose(crf.neg_log_likelihood(emissions, tags, mask), expected / 2, atol=1e-5)
@@ -0,0 +1,46 @@
+import numpy as np
+from hate_speech.dedup import MinHashIndex
+
+def make_texts(num_texts, num_words=30, seed=0):
+  rng = np.random.default_rng(seed)
+  return [' '.join(f'w{word}' for word in rng.integers(0, 10000, num_words)) for _ in range(num_texts)]
+
+def edit_one_word(text):
+  words = text.split()
+  words[len(words) // 2] = 'changed'
+  return ' '.join(words)
+
+def test_group():
+  texts = make_texts(4)
+  groups = MinHashIndex().group([texts[0], texts[1], texts[0], edit_one_word(texts[1]), texts[2], texts[3]])
+  assert groups[0] == groups[2]
+  assert groups[1] == groups[3]
+  assert len(set(groups[[0, 1, 4, 5]])) == 4
+
+def test_signatures_do_not_depend_on_the_batch():
+  texts = make_texts(5)
+  index = MinHashIndex(chunk_size=2)
+  assert (index.signatures(texts)[3] == index.signatures(texts[3:4])[0]).all()
+
+def test_filter_new_within_and_across_calls():
+  texts = make_texts(5)
+  index = MinHashIndex()
+  assert index.filter_new([texts[0], texts[1], edit_one_word(texts[0])]).tolist() == [True, True, False]
+  assert index.filter_new([texts[2], texts[1], edit_one_word(texts[1]), texts[3]]).tolist() == [True, False, False, True]
+  assert index.filter_new([]).tolist() == []
+
+def test_filter_new_forgets_beyond_max_seen():
+  texts = make_texts(4)
+  index = MinHashIndex(max_seen=2)
+  assert index.filter_new(texts[:3]).all()
+  # texts[0] fell out of the window of the last two kept texts, texts[2] did not
+  assert index.filter_new([texts[0]]).tolist() == [True]
+  assert index.filter_new([texts[2]]).tolist() == [False]
+
+def test_filter_new_memory_is_bounded():
+  index = MinHashIndex(max_seen=100)
+  for seed in range(30):
+    index.filter_new(make_texts(50, seed=seed))
+  assert index.num_seen == 1500
+  assert len(index.index[0]) <= 2 * 100 * index.bands
+  assert len(index.pending[0]) <= max(len(index.index[0]) // 8, 256 * index.bands)
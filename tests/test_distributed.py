@@ -0,0 +1,60 @@
+import socket
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, TensorDataset
+from hate_speech.distributed import launch, train_model_distributed
+from hate_speech.training import train_model
+
+NUM_EPOCHS = 3
+
+class BagOfWords(torch.nn.Module):
+  # masked mean of token embeddings and a linear head: (input_ids, attention_mask) -> logits, like Model
+  def __init__(self):
+    super(BagOfWords, self).__init__()
+    self.embedding = torch.nn.Embedding(20, 8)
+    self.linear = torch.nn.Linear(8, 1)
+
+  def forward(self, input_ids, attention_mask):
+    mask = attention_mask.unsqueeze(-1).float()
+    return self.linear((self.embedding(input_ids) * mask).sum(dim=1) / mask.sum(dim=1))
+
+def make_data_loaders():
+  generator = torch.Generator().manual_seed(0)
+  ids = torch.randint(0, 20, (48, 6), generator=generator)
+  mask = (torch.arange(6) < torch.randint(2, 7, (48, 1), generator=generator)).long()
+  labels = (ids[:, 0] < 10).long()
+  train = DataLoader(TensorDataset(ids[:32], mask[:32], labels[:32]), batch_size=8)
+  val = DataLoader(TensorDataset(ids[32:], mask[32:], labels[32:]), batch_size=4)
+  return train, val
+
+def fit(distributed):
+  # each rank starts from different weights: DDP has to copy rank 0's
+  torch.manual_seed(dist.get_rank() if distributed else 0)
+  model = BagOfWords()
+  criterion = torch.nn.BCEWithLogitsLoss()
+  optimizer = torch.optim.SGD(model.parameters(), lr=0.5)
+  train, val = make_data_loaders()
+  if not distributed:
+    _, val_losses, reports, _ = train_model(model, criterion, optimizer, train, val, NUM_EPOCHS, progress=False)
+    return model.state_dict(), val_losses, reports
+
+  _, val_losses, reports, _ = train_model_distributed(model, criterion, optimizer, train, val, NUM_EPOCHS, progress=False)
+  results = [None] * dist.get_world_size()
+  dist.all_gather_object(results, (model.state_dict(), val_losses, reports))
+  return results
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+def test_two_ranks_end_with_the_same_weights_and_report():
+  (weights, val_losses, reports), other = launch(fit, 2, (True,), port=free_port(), threads=1)
+  assert all(torch.equal(weights[name], other[0][name]) for name in weights)
+  assert other[1:] == (val_losses, reports)
+
+  # unshuffled, the 2 x 4 examples of a step are the 8 of the single-process batch, and
+  # DDP averages the gradients of the two halves: same training as one process
+  single_weights, _, single_reports = fit(False)
+  assert all(torch.allclose(weights[name], single_weights[name], atol=1e-6) for name in weights)
+  assert reports == single_reports
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+import torch
+from hate_speech.inference import Model, aggregate_windows, predict, predict_long, split_windows
+
+TEXTS = ['ciao', 'gli immigrati vanno rimandati tutti a casa loro', 'oggi mercato', 'bella giornata oggi al mercato con la gente',
+         'vergogna', 'governo', 'ciao mondo ciao mondo ciao mondo']
+
+def identity(text):
+  return text
+
+def test_predict_does_not_depend_on_batch_size_or_order(tiny_model):
+  model, tokenizer = tiny_model
+  probs = predict(TEXTS, model, batch_size=64, tokenizer=tokenizer, preprocess=identity)
+  assert probs.shape == (len(TEXTS),)
+  assert np.allclose(predict(TEXTS, model, batch_size=2, tokenizer=tokenizer, preprocess=identity), probs, atol=1e-5)
+  assert np.allclose(predict(TEXTS[::-1], model, batch_size=3, tokenizer=tokenizer, preprocess=identity)[::-1], probs, atol=1e-5)
+
+def test_predict_matches_unpadded_forward(tiny_model):
+  model, tokenizer = tiny_model
+  probs = predict(TEXTS, model, batch_size=4, tokenizer=tokenizer, preprocess=identity)
+  with torch.no_grad():
+    for text, prob in zip(TEXTS, probs):
+      encoded = tokenizer(text, return_tensors='pt')
+      assert torch.sigmoid(model(encoded['input_ids'], encoded['attention_mask'])).item() == pytest.approx(prob, abs=1e-5)
+
+def test_predict_dict_of_models(tiny_model):
+  model, tokenizer = tiny_model
+  probs = predict(TEXTS, {'hs': model, 'stereotype': model}, tokenizer=tokenizer, preprocess=identity)
+  assert np.allclose(probs['hs'], probs['stereotype'])
+  assert np.allclose(probs['hs'], predict(TEXTS, model, tokenizer=tokenizer, preprocess=identity))
+
+def test_predict_long_matches_predict_on_short_texts(tiny_model):
+  model, tokenizer = tiny_model
+  probs = predict(TEXTS, model, tokenizer=tokenizer, preprocess=identity)
+  for aggregation in ['max', 'mean', 'attention']:
+    windowed = predict_long(TEXTS, model, batch_size=3, tokenizer=tokenizer, preprocess=identity, window=32, stride=16, aggregation=aggregation)
+    assert np.allclose(windowed, probs, atol=1e-5)
+
+def test_split_windows_cover_every_token(tiny_model):
+  _, tokenizer = tiny_model
+  input_ids = [list(range(10, 30)), list(range(10, 13))]
+  windows, owners = split_windows(input_ids, tokenizer, window=8, stride=4)
+  assert owners.tolist() == [0, 0, 0, 0, 0, 1]
+  assert all(len(w) <= 8 and w[0] == tokenizer.cls_token_id and w[-1] == tokenizer.sep_token_id for w in windows)
+  assert sorted({token for w in windows[:5] for token in w[1:-1]}) == input_ids[0]
+  assert windows[4][1:-1] == input_ids[0][-6:]
+
+def test_aggregate_windows():
+  logits = np.array([1.0, 3.0, -2.0, 0.5, 0.5], dtype=np.float32)
+  owners = np.array([0, 0, 1, 2, 2])
+  assert aggregate_windows(logits, owners, 3, 'max').tolist() == [3.0, -2.0, 0.5]
+  assert aggregate_windows(logits, owners, 3, 'mean').tolist() == [2.0, -2.0, 0.5]
+  attention = aggregate_windows(logits, owners, 3, 'attention')
+  assert 2.0 < attention[0] < 3.0 and attention[1:].tolist() == [-2.0, 0.5]
+
+def test_mean_pooling_ignores_padding(tiny_bert, tiny_model):
+  _, tokenizer = tiny_model
+  torch.manual_seed(0)
+  model = Model(0.3, tiny_bert, pooling='mean').eval()
+  probs = predict(TEXTS, model, batch_size=64, tokenizer=tokenizer, preprocess=identity)
+  # every text alone, without padding
+  assert np.allclose(predict(TEXTS, model, batch_size=1, tokenizer=tokenizer, preprocess=identity), probs, atol=1e-5)
@@ -0,0 +1,36 @@
+import numpy as np
+from hate_speech.langid import LanguageIdentifier
+
+def make_identifier(min_margin=0.05):
+  corpora = {'it': ['aaaa aaa', 'aa aaaaa'], 'es': ['bbbb bbb', 'bb bbbbb']}
+  return LanguageIdentifier(['it', 'es'], num_buckets=2 ** 12, min_margin=min_margin).fit(corpora)
+
+def test_predict():
+  assert make_identifier().predict(['aaa aa', 'bbbbbb']).tolist() == ['it', 'es']
+  assert make_identifier().predict([]).tolist() == []
+
+def test_below_min_margin_is_unknown():
+  identifier = make_identifier()
+  scores = identifier.scores(['ab', 'aaab'])
+  margins = np.abs(scores[:, 0] - scores[:, 1])
+  # 'ab' is as Italian as it is Spanish, 'aaab' is clearly Italian
+  assert margins[0] < identifier.min_margin < margins[1]
+  assert identifier.predict(['ab', 'aaab']).tolist() == ['unknown', 'it']
+  assert make_identifier(min_margin=margins[1] + 1).predict(['aaab']).tolist() == ['unknown']
+
+def test_no_letters_is_unknown():
+  assert make_identifier().predict(['1234 !!', '']).tolist() == ['unknown', 'unknown']
+
+def test_save_and_load(tmp_path):
+  identifier = make_identifier()
+  identifier.save(str(tmp_path / 'langid.npz'))
+  loaded = LanguageIdentifier.load(str(tmp_path / 'langid.npz'))
+  assert np.array_equal(loaded.scores(['aaa', 'bab']), identifier.scores(['aaa', 'bab']))
+
+def test_scores_do_not_depend_on_the_neighbouring_texts():
+  identifier = make_identifier()
+  texts = ['ab', 'aaab', 'bba', '', 'b']
+  for i, text in enumerate(texts):
+    alone = identifier.scores([text])[0]
+    assert np.allclose(identifier.scores(texts)[i], alone, rtol=1e-6)
+    assert np.allclose(identifier.scores(['bbbbbbbb', text, 'aaaaaaaa'])[1], alone, rtol=1e-6)
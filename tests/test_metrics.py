@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import classification_report, f1_score
+from hate_speech.metrics import StreamingReport, best_threshold, iob_spans, span_report, threshold_sweep
+
+def assert_reports_equal(report, expected):
+  assert report.keys() == expected.keys()
+  for key, value in expected.items():
+    if isinstance(value, dict):
+      for metric, number in value.items():
+        assert report[key][metric] == pytest.approx(number), (key, metric)
+    else:
+      assert report[key] == pytest.approx(value), key
+
+def test_streaming_report_matches_classification_report():
+  rng = np.random.default_rng(0)
+  predictions, targets = rng.integers(0, 2, 500), rng.integers(0, 2, 500)
+  report = StreamingReport(labels=[0, 1])
+  for start in range(0, 500, 64):
+    report.update(torch.tensor(predictions[start:start + 64]), torch.tensor(targets[start:start + 64]).unsqueeze(1))
+  assert_reports_equal(report.report(), classification_report(targets, predictions, labels=[0, 1], output_dict=True, zero_division=0))
+
+def test_streaming_report_ignore_index_and_subset_of_labels():
+  # Task C: O=0, B=1, I=2 reported as B and I only, PAD=3 skipped
+  rng = np.random.default_rng(1)
+  targets, predictions = rng.integers(0, 4, 300), rng.integers(0, 3, 300)
+  report = StreamingReport(labels=[1, 2], num_classes=4, ignore_index=3)
+  report.update(torch.tensor(predictions), torch.tensor(targets))
+  kept = targets != 3
+  expected = classification_report(targets[kept], predictions[kept], labels=[1, 2], output_dict=True, zero_division=0)
+  assert_reports_equal(report.report(), expected)
+
+def test_streaming_report_no_updates():
+  report = StreamingReport(labels=[0, 1]).report()
+  assert report['macro avg']['f1-score'] == 0.0
+  assert report['0']['support'] == 0.0
+
+def test_threshold_sweep_matches_sklearn_at_every_threshold():
+  rng = np.random.default_rng(2)
+  # repeated logits, so several examples share a cut
+  logits = np.round(rng.normal(size=200), 1)
+  labels = rng.random(200) < 1 / (1 + np.exp(-logits))
+  sweep = threshold_sweep(torch.tensor(logits), torch.tensor(labels))
+  probs = 1 / (1 + np.exp(-logits))
+  for threshold, macro_f1, f1_1 in zip(sweep['threshold'], sweep['macro_f1'], sweep['f1_1']):
+    predictions = probs > threshold
+    assert macro_f1 == pytest.approx(f1_score(labels, predictions, labels=[0, 1], average='macro', zero_division=0))
+    assert f1_1 == pytest.approx(f1_score(labels, predictions, zero_division=0))
+
+def test_best_threshold_fixed_answer():
+  # negatives at logit -2 and 0, positives at 1 and 3: the best cut is between 0 and 1
+  threshold, sweep = best_threshold([-2.0, 0.0, 1.0, 3.0], [0, 0, 1, 1])
+  assert threshold == pytest.approx(1 / (1 + np.exp(-0.5)))
+  assert sweep['macro_f1'].max() == 1.0
+
+def test_iob_spans():
+  # sentences of 4 and 3 tokens; the I after O and the I starting the second sentence start spans
+  tags = [1, 2, 0, 2, 2, 2, 1]
+  starts, ends = iob_spans(tags, [4, 3])
+  assert starts.tolist() == [0, 3, 4, 6]
+  assert ends.tolist() == [2, 4, 6, 7]
+
+def test_span_report_fixed_answer():
+  # sentence 0: true [0, 2) and [3, 5), predicted [0, 2) exactly and [3, 4) partially
+  # sentence 1: true [5, 7), nothing predicted
+  true_tags = [1, 2, 0, 1, 2, 1, 2]
+  pred_tags = [1, 2, 0, 1, 0, 0, 0]
+  report, per_sentence = span_report(true_tags, pred_tags, [5, 2])
+  assert report['exact'] == pytest.approx({'precision': 0.5, 'recall': 1 / 3, 'f1-score': 0.4, 'support': 3.0})
+  assert report['partial'] == pytest.approx({'precision': 1.0, 'recall': 2 / 3, 'f1-score': 0.8, 'support': 3.0})
+  assert per_sentence['true_spans'].tolist() == [2, 1]
+  assert per_sentence['pred_spans'].tolist() == [2, 0]
+  assert per_sentence['exact_recall'].tolist() == [0.5, 0.0]
+  assert np.isnan(per_sentence['exact_precision'][1])
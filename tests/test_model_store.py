@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+import torch
+from hate_speech.inference import load_model, predict
+from hate_speech.model_store import is_store, load_store, save_store
+
+TEXTS = ['ciao mondo', 'gli immigrati vanno rimandati tutti a casa loro', 'bella giornata']
+
+def identity(text):
+  return text
+
+def test_store_round_trip_offline(tiny_model, tmp_path, monkeypatch):
+  model, tokenizer = tiny_model
+  with torch.no_grad():
+    model.linear.weight.normal_()
+  directory = str(tmp_path / 'model_hs')
+  save_store(model, directory, tokenizer, threshold=0.35)
+  assert is_store(directory)
+
+  monkeypatch.setenv('HF_HUB_OFFLINE', '1')
+  loaded, loaded_tokenizer = load_store(directory)
+  assert loaded.threshold == 0.35
+  assert not loaded.training
+  expected = predict(TEXTS, model, tokenizer=tokenizer, preprocess=identity)
+  assert np.allclose(predict(TEXTS, loaded, tokenizer=loaded_tokenizer, preprocess=identity), expected, atol=1e-6)
+  assert np.allclose(predict(TEXTS, load_model(directory, 0.3), tokenizer=tokenizer, preprocess=identity), expected, atol=1e-6)
+
+def test_load_store_rejects_other_directories(tmp_path):
+  with pytest.raises(ValueError):
+    load_store(str(tmp_path))
@@ -0,0 +1,63 @@
+import copy
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from hate_speech.pruning import (compute_head_importance, estimate_flops, head_gates, load_pruned_model, prune_model,
+                                 save_pruned_model, select_heads_to_prune)
+
+def make_data_loader(seed=0):
+  generator = torch.Generator().manual_seed(seed)
+  ids = torch.randint(5, 60, (8, 12), generator=generator)
+  mask = torch.ones_like(ids)
+  mask[::2, 8:] = 0
+  return DataLoader(TensorDataset(ids, mask, torch.arange(8) % 2), batch_size=4)
+
+def outputs(model, data_loader):
+  with torch.no_grad():
+    return torch.cat([model(ids, mask) for ids, mask, _ in data_loader])
+
+def test_pruning_equals_gating_the_heads_off(tiny_model):
+  model, _ = tiny_model
+  heads_to_prune = {0: [0, 3, 11], 1: [5]}
+  gates = torch.ones(2, 12)
+  for layer, heads in heads_to_prune.items():
+    gates[layer, heads] = 0
+
+  data_loader = make_data_loader()
+  hooks = head_gates(model, gates)
+  expected = outputs(model, data_loader)
+  for handle in hooks:
+    handle.remove()
+
+  pruned = prune_model(copy.deepcopy(model), heads_to_prune, [])
+  assert [layer.attention.self.num_attention_heads for layer in pruned.bert.encoder.layer] == [9, 11]
+  assert pruned.bert.encoder.layer[0].attention.self.query.weight.shape == (9 * 64, 768)
+  assert pruned.bert.encoder.layer[0].attention.output.dense.weight.shape == (768, 9 * 64)
+  assert torch.allclose(outputs(pruned, data_loader), expected, atol=1e-5)
+  assert estimate_flops(pruned, 12) < estimate_flops(model, 12)
+
+def test_head_importance_and_selection(tiny_model):
+  model, _ = tiny_model
+  head_importance, layer_importance = compute_head_importance(make_data_loader(), model, torch.nn.BCEWithLogitsLoss(), progress=False)
+  assert head_importance.shape == (2, 12) and layer_importance.shape == (2,)
+  assert (head_importance > 0).all()
+  assert not any(layer.attention.self._forward_hooks for layer in model.bert.encoder.layer)
+
+  heads_to_prune, layers_to_drop = select_heads_to_prune(head_importance, layer_importance, 0.5, num_layers_to_drop=1)
+  assert layers_to_drop == [int(layer_importance.argmin())]
+  kept_layer = 1 - layers_to_drop[0]
+  assert list(heads_to_prune) == [kept_layer] and len(heads_to_prune[kept_layer]) == 6
+  assert int(head_importance[kept_layer].argmax()) not in heads_to_prune[kept_layer]
+
+def test_pruned_model_reloads(tiny_bert, tiny_model, tmp_path):
+  from hate_speech.inference import Model
+
+  model, _ = tiny_model
+  pruned = prune_model(model, {0: [1, 2], 1: list(range(11))}, [0])
+  path = str(tmp_path / 'model_hs_pruned')
+  save_pruned_model(pruned, path)
+
+  reloaded = load_pruned_model(Model(0.3, tiny_bert), path).eval()
+  assert len(reloaded.bert.encoder.layer) == 1
+  assert reloaded.bert.encoder.layer[0].attention.self.num_attention_heads == 1
+  data_loader = make_data_loader(1)
+  assert torch.allclose(outputs(reloaded, data_loader), outputs(pruned, data_loader), atol=1e-6)
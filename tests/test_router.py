@@ -0,0 +1,49 @@
+import numpy as np
+import torch
+from hate_speech.router import ModelRouter
+
+class FakeRouter(ModelRouter):
+  # a 1 MB model per language instead of a fine-tuned BERT
+  def _load(self, language):
+    self.calls.append(language)
+    return {'model': torch.nn.Linear(250, 1000, bias=False), 'tokenizer': None, 'preprocess': None}
+
+def make_router(memory_limit_mb):
+  router = FakeRouter({'it': 'model_hs', 'es': 'model_spanish_hs', 'de': 'model_german_hs'}, memory_limit_mb=memory_limit_mb)
+  router.calls = []
+  return router
+
+def test_languages_are_loaded_lazily_once():
+  router = make_router(None)
+  assert router.stats()['loaded'] == []
+  entry = router.get('es')
+  assert router.get('es') is entry
+  assert router.calls == ['es']
+  assert router.stats()['loaded'] == ['es']
+
+def test_least_recently_used_language_is_evicted():
+  router = make_router(2.5)
+  router.get('it')
+  router.get('es')
+  router.get('it')
+  router.get('de')
+  stats = router.stats()
+  assert stats['loaded'] == ['it', 'de']
+  assert (stats['loads'], stats['evictions']) == (3, 1)
+  assert stats['memory_mb'] == 2.0
+
+  router.get('es')
+  assert router.calls == ['it', 'es', 'de', 'es']
+  assert router.stats()['loaded'] == ['de', 'es']
+
+def test_the_language_just_loaded_is_never_evicted():
+  router = make_router(0.5)
+  router.get('it')
+  router.get('de')
+  assert router.stats()['loaded'] == ['de']
+
+def test_unknown_languages_get_nan_without_loading():
+  router = make_router(None)
+  probs = router.predict(['hello', 'bonjour'], ['en', 'unknown'])
+  assert np.isnan(probs).all()
+  assert router.calls == []
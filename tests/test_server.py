@@ -0,0 +1,54 @@
+import asyncio
+import json
+from hate_speech.server import MicroBatcher, make_handler
+
+def fake_predict(texts):
+  if not all(isinstance(text, str) for text in texts):
+    raise TypeError('texts must be strings')
+  return [{'hs': len(text) / 100} for text in texts]
+
+def post(body):
+  return b'POST /predict HTTP/1.1\r\nConnection: close\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body)
+
+async def exchange(port, raw):
+  reader, writer = await asyncio.open_connection('127.0.0.1', port)
+  writer.write(raw)
+  await writer.drain()
+  response = await reader.read()
+  writer.close()
+  head, body = response.split(b'\r\n\r\n', 1)
+  return int(head.split(b' ')[1]), json.loads(body)
+
+def run_server(requests, max_latency_ms=50):
+  # sends the raw requests concurrently, so the valid ones share a micro-batch
+  async def main():
+    batcher = MicroBatcher(fake_predict, max_batch_size=16, max_latency_ms=max_latency_ms)
+    batch_task = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(make_handler(batcher), '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+      return await asyncio.gather(*(exchange(port, raw) for raw in requests)), batcher
+    finally:
+      server.close()
+      batch_task.cancel()
+  return asyncio.run(main())
+
+def test_invalid_text_does_not_poison_the_batch():
+  responses, batcher = run_server([post(b'{"text": 5}'), post(b'{"text": "ciao"}'), post(b'{"text": null}'),
+                                   post(b'[1]'), post(b'not json'), post(b'{"text": "buongiorno"}')])
+  assert [status for status, _ in responses] == [400, 200, 400, 400, 400, 200]
+  assert responses[1][1] == {'hs': 0.04}
+  assert responses[5][1] == {'hs': 0.1}
+  assert batcher.num_texts == 2
+
+def test_malformed_requests_get_400():
+  responses, _ = run_server([b'GARBAGE\r\n\r\n',
+                             b'POST /predict HTTP/1.1\r\nContent-Length: abc\r\n\r\n',
+                             b'GET /health HTTP/1.1\r\nno colon\r\n\r\n'])
+  assert [status for status, _ in responses] == [400, 400, 400]
+
+def test_health_and_not_found():
+  responses, _ = run_server([b'GET /health HTTP/1.1\r\nConnection: close\r\n\r\n',
+                             b'GET /other HTTP/1.1\r\nConnection: close\r\n\r\n'])
+  assert responses[0] == (200, {'status': 'ok', 'batches': 0, 'texts': 0})
+  assert responses[1][0] == 404
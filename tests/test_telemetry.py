@@ -0,0 +1,32 @@
+import pytest
+import torch
+from hate_speech.telemetry import CountingLoader, Telemetry, summarize
+
+def make_batches():
+  # (input_ids, attention_mask, labels) padded to 4 positions
+  masks = [torch.tensor([[1, 1, 1, 0], [1, 1, 0, 0]]), torch.tensor([[1, 0, 0, 0]])]
+  return [(mask * 7, mask, torch.zeros(len(mask))) for mask in masks]
+
+def test_counting_loader_padding():
+  loader = CountingLoader(make_batches())
+  assert [batch[1].shape for batch in loader] == [(2, 4), (1, 4)]
+  assert (loader.examples, loader.tokens, loader.positions) == (3, 6, 12)
+
+def test_counting_loader_trimmed_batches():
+  loader = CountingLoader(make_batches(), trim=True)
+  list(loader)
+  # batches are only as long as their longest sequence: 2 x 3 + 1 x 1 positions
+  assert (loader.tokens, loader.positions) == (6, 7)
+
+def test_epoch_record_padding_ratio(tmp_path):
+  telemetry = Telemetry(path=str(tmp_path / 'runs' / 'telemetry.jsonl'))
+  for epoch, trim in enumerate([False, True]):
+    telemetry.start_epoch(epoch)
+    for _ in telemetry.count(make_batches(), trim=trim):
+      pass
+    record = telemetry.end_epoch()
+  assert telemetry.records[0]['padding_ratio'] == pytest.approx(0.5)
+  assert record['padding_ratio'] == pytest.approx(1 / 7)
+  assert record['examples'] == 3 and record['peak_device_mb'] is None
+  assert len((tmp_path / 'runs' / 'telemetry.jsonl').read_text().splitlines()) == 2
+  assert summarize(telemetry.records)['padding_ratio'] == pytest.approx(1 - 12 / 19)